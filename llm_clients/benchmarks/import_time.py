@@ -0,0 +1,128 @@
+"""import にかかる時間と読み込まれる重い依存を計測する
+
+python benchmarks/import_time.py
+重い依存が読み込まれていたり、時間が上限を超えていたりした場合は終了コード 1 で終わる
+"""
+
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = (
+    "demucs",
+    "torch",
+    "faster_whisper",
+    "google.generativeai",
+    "openai",
+    "pydub",
+    "streamlit",
+)
+
+# import するモジュールと、そのときに読み込まれてはいけないモジュール
+TARGETS = {
+    "llm_clients": HEAVY_MODULES,
+    "llm_clients.openai": tuple(m for m in HEAVY_MODULES if m != "openai"),
+    "llm_clients.gemini": tuple(m for m in HEAVY_MODULES if m != "google.generativeai"),
+    "llm_clients.whisper": HEAVY_MODULES,
+    "llm_clients.whisper_models": HEAVY_MODULES,
+    "llm_clients.audio_store": HEAVY_MODULES,
+    "llm_clients.transcribe_batch": HEAVY_MODULES,
+    "llm_clients.separation": HEAVY_MODULES,
+    "llm_clients.separation_queue": HEAVY_MODULES,
+}
+
+# extras で入れる依存 入っていない場合はその import を飛ばす
+OPTIONAL_MODULES = (
+    "av",
+    "demucs",
+    "faster_whisper",
+    "ffmpeg",
+    "google",
+    "numpy",
+    "openai",
+    "pydub",
+    "soundfile",
+    "streamlit",
+    "torch",
+)
+
+_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(module: str) -> tuple[float, list[str]]:
+    """新しいプロセスで module を import し、かかった秒数と読み込まれたモジュールを返す
+
+    Parameters
+    ----------
+    module
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", _SCRIPT.format(module=module)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(output.splitlines()[-1])
+    return result["elapsed"], result["modules"]
+
+
+def missing_extra(stderr: str) -> str | None:
+    """import の失敗が extras の依存が入っていないためであれば、そのモジュール名を返す
+
+    Parameters
+    ----------
+    stderr
+    """
+    lines = stderr.strip().splitlines()
+    if not lines:
+        return None
+    match = re.fullmatch(r"ModuleNotFoundError: No module named '([\w.]+)'", lines[-1])
+    if match is None or match.group(1).split(".")[0] not in OPTIONAL_MODULES:
+        return None
+    return match.group(1)
+
+
+def main() -> int:
+    """計測して結果を表示する"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.0, help="import にかける秒数の上限")
+    args = parser.parse_args()
+
+    failed = False
+    for module, forbidden in TARGETS.items():
+        try:
+            runs = [measure(module) for _ in range(args.repeat)]
+        except subprocess.CalledProcessError as e:
+            missing = missing_extra(e.stderr)
+            if missing is not None:
+                print(f"{module}: skipped ({missing} is not installed)")
+            else:
+                print(f"{module}: import failed  NG")
+                if e.stderr.strip():
+                    print(e.stderr.strip())
+                failed = True
+            continue
+        elapsed = statistics.median(t for t, _ in runs)
+        loaded = [m for m in forbidden if any(n == m or n.startswith(f"{m}.") for n in runs[0][1])]
+        ok = elapsed <= args.budget and not loaded
+        failed |= not ok
+        print(
+            f"{module}: {elapsed * 1000:.0f} ms"
+            + (f", loaded {', '.join(loaded)}" if loaded else "")
+            + ("" if ok else "  NG")
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""窓ごとに分離したボーカルと、曲全体を分離したボーカルの差を計測する
+
+python benchmarks/separation_tolerance.py song.mp3 --window 60 --window-overlap 5
+曲全体の結果に対する SNR が --min-snr を下回った場合は終了コード 1 で終わる
+"""
+
+import argparse
+import math
+import sys
+import time
+
+import numpy
+
+from llm_clients import separation
+
+
+def snr(reference: numpy.ndarray, estimate: numpy.ndarray) -> float:
+    """reference に対する estimate の SNR (dB) を返す
+
+    Parameters
+    ----------
+    reference
+    estimate
+    """
+    noise = float(numpy.sum((reference - estimate).astype(numpy.float64) ** 2))
+    signal = float(numpy.sum(reference.astype(numpy.float64) ** 2))
+    return math.inf if noise == 0 else 10 * math.log10(signal / noise)
+
+
+def main() -> int:
+    """計測して結果を表示する"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("audio_paths", nargs="+")
+    parser.add_argument("--window", type=float, default=60.0)
+    parser.add_argument("--window-overlap", type=float, default=5.0)
+    parser.add_argument("--min-snr", type=float, default=20.0, help="許容する SNR の下限 (dB)")
+    args = parser.parse_args()
+
+    # shifts はランダムにずらすので、比べるときは 0 にする
+    full = separation.VocalSeparator(separation.SeparatorConfig(shifts=0))
+    windowed = separation.VocalSeparator(
+        separation.SeparatorConfig(shifts=0, window=args.window, window_overlap=args.window_overlap)
+    )
+
+    failed = False
+    for audio_path in args.audio_paths:
+        start = time.perf_counter()
+        (reference,) = full.separate([audio_path])
+        full_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        (estimate,) = windowed.separate([audio_path])
+        windowed_elapsed = time.perf_counter() - start
+
+        # デコーダーの違いで長さが数サンプル違うことがあるので、短い方に合わせる
+        n = min(len(reference), len(estimate))
+        value = snr(reference[:n], estimate[:n])
+        ok = value >= args.min_snr
+        failed |= not ok
+        print(
+            f"{audio_path}: SNR {value:.1f} dB, full {full_elapsed:.1f}s, "
+            f"windowed {windowed_elapsed:.1f}s" + ("" if ok else "  NG")
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,2 +1,23 @@
 # pyright: reportUnusedImport=false
-from llm_clients.util import vocal_extract
+import importlib
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from llm_clients.util import vocal_extract
+
+# import llm_clients で demucs (torch) などを読み込まないように、使われたときに import する
+_LAZY_ATTRIBUTES = {"vocal_extract": "llm_clients.util"}
+
+
+def __getattr__(name: str) -> Any:
+    """属性が使われたときにモジュールを import して返す
+
+    Parameters
+    ----------
+    name
+    """
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
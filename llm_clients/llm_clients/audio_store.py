@@ -0,0 +1,324 @@
+import dataclasses
+import os
+import re
+import threading
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
+
+from llm_clients import cache, filelock, logger
+
+if TYPE_CHECKING:
+    import av
+    import numpy
+
+# numpy と av (PyAV) は import が重いので、使うときに関数の中で import する
+
+SAMPLE_RATE = 16_000
+
+# デコード結果を .npy に変換するときに1回に読むサンプル数
+_BLOCK_SAMPLES = 1 << 20
+
+# デコード中の一時ファイル {保存先}.{pid}.tmp と、その PCM の {保存先}.{pid}.tmp.pcm
+_TMP_NAME = re.compile(r"(.+\.npy)\.\d+\.tmp(\.pcm)?")
+
+# 保存するデコード結果の合計サイズの上限 (バイト)
+MAX_BYTES = int(os.environ.get("LLM_CLIENTS_AUDIO_STORE_MAX_BYTES", 4 * 1024**3))
+
+
+@dataclasses.dataclass
+class AudioStoreStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+def _frames(
+    container: "av.container.InputContainer", resampler: "av.AudioResampler"
+) -> Iterator["av.AudioFrame"]:
+    """faster_whisper.decode_audio と同じく、壊れたフレームを飛ばし、500000 サンプルずつまとめて
+    リサンプリングしたフレームを返す
+
+    Parameters
+    ----------
+    container
+    resampler
+    """
+    import av
+
+    fifo = av.audio.fifo.AudioFifo()
+    frames = container.decode(audio=0)
+    while True:
+        try:
+            frame = next(frames)
+        except StopIteration:
+            break
+        except av.error.InvalidDataError:
+            continue
+        # タイムスタンプの確認をしない
+        frame.pts = None
+        fifo.write(frame)
+        if fifo.samples >= 500000:
+            yield from resampler.resample(fifo.read())
+    if fifo.samples > 0:
+        yield from resampler.resample(fifo.read())
+    # None を渡して resampler に残っている分を出す
+    yield from resampler.resample(None)
+
+
+def _decode(path: str, sample_rate: int, channels: int, npy_path: str) -> None:
+    """音声をデコードして float32 の配列を .npy に書き出す
+    faster_whisper.decode_audio と同じ手順で PyAV でデコードするが、全体をメモリに置かずに
+    少しずつファイルに書くので、長い音声でも使うメモリはフレームの分だけで済む
+
+    Parameters
+    ----------
+    path
+    sample_rate
+    channels
+        1 の場合は (サンプル数,)、2 の場合は (サンプル数, 2) の配列を書く
+    npy_path
+        書き出し先
+    """
+    import gc
+
+    import av
+    import numpy
+
+    if channels not in (1, 2):
+        raise ValueError(f"channels must be 1 or 2: {channels}")
+
+    # まず 16bit の PCM をそのまま書き、長さがわかってから .npy に変換する
+    pcm_path = f"{npy_path}.pcm"
+    try:
+        resampler = av.audio.resampler.AudioResampler(
+            format="s16", layout="mono" if channels == 1 else "stereo", rate=sample_rate
+        )
+        with (
+            av.open(path, mode="r", metadata_errors="ignore") as container,
+            open(pcm_path, "wb") as f,
+        ):
+            for frame in _frames(container, resampler):
+                f.write(frame.to_ndarray().tobytes())
+        # faster_whisper と同じく、resampler が解放されるように gc を呼ぶ
+        del resampler
+        gc.collect()
+
+        size = os.path.getsize(pcm_path) // 2
+        shape = (size,) if channels == 1 else (size // 2, 2)
+        audio = numpy.lib.format.open_memmap(npy_path, mode="w+", dtype=numpy.float32, shape=shape)
+        flat = audio.reshape(-1)
+        with open(pcm_path, "rb") as f:
+            for start in range(0, size, _BLOCK_SAMPLES):
+                block = numpy.fromfile(f, dtype=numpy.int16, count=_BLOCK_SAMPLES)
+                flat[start : start + len(block)] = block.astype(numpy.float32) / 32768.0
+        audio.flush()
+        del audio, flat
+    finally:
+        try:
+            os.unlink(pcm_path)
+        except FileNotFoundError:
+            pass
+
+
+class AudioStore:
+    """音声をファイルの中身・サンプリング周波数・チャンネル数ごとに1回だけデコードして .npy に保存し、
+    numpy.memmap で返す
+    2回目以降はデコードせずページキャッシュから読むだけになり、プロセス間でも使い回される
+    保存したファイルの合計が max_bytes を超えたら、最後に使ってから長いものから消す
+
+    Attributes
+    ----------
+    directory
+    max_bytes
+    stats
+        キャッシュにあった回数、デコードした回数、消したファイルの数
+    """
+
+    def __init__(self, directory: str | None = None, max_bytes: int = MAX_BYTES) -> None:
+        """init
+
+        Parameters
+        ----------
+        directory
+            保存先 None の場合は cache.CACHE_DIR 以下に作る
+        max_bytes
+            保存するファイルの合計サイズの上限
+        """
+        self.directory = (
+            directory if directory is not None else os.path.join(cache.CACHE_DIR, "audio")
+        )
+        self.max_bytes = max_bytes
+        self.stats = AudioStoreStats()
+        self._lock = threading.Lock()
+
+    def _path(self, path: str, sample_rate: int, channels: int) -> str:
+        """デコード結果の保存先を返す
+
+        Parameters
+        ----------
+        path
+        sample_rate
+        channels
+        """
+        digest = cache.file_digest(path)
+        return os.path.join(self.directory, f"{digest}-{sample_rate}-{channels}.npy")
+
+    def load(self, path: str, sample_rate: int = SAMPLE_RATE, channels: int = 1) -> "numpy.memmap":
+        """デコードした音声を読み取り専用の numpy.memmap で返す
+
+        Parameters
+        ----------
+        path
+            音声・動画ファイルのパス
+        sample_rate
+        channels
+            1 の場合は (サンプル数,)、2 の場合は (サンプル数, 2) の配列を返す
+        """
+        import numpy
+
+        store_path = self._path(path, sample_rate, channels)
+        try:
+            audio = numpy.load(store_path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            pass
+        else:
+            self._touch(store_path)
+            with self._lock:
+                self.stats.hits += 1
+            return audio
+
+        # 同じファイルを複数のプロセスで同時にデコードしないようにする
+        with filelock.FileLock(f"{store_path}.lock"):
+            if not os.path.exists(store_path):
+                logger.logger.debug(f"decode {path} to {store_path}")
+                os.makedirs(self.directory, exist_ok=True)
+                # 途中で落ちても壊れたファイルが残らないように一時ファイルから置き換える
+                tmp_path = f"{store_path}.{os.getpid()}.tmp"
+                try:
+                    _decode(path, sample_rate, channels, tmp_path)
+                    os.replace(tmp_path, store_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+                with self._lock:
+                    self.stats.misses += 1
+                self.evict(keep=store_path)
+            else:
+                with self._lock:
+                    self.stats.hits += 1
+        return numpy.load(store_path, mmap_mode="r")
+
+    def duration(self, path: str) -> float:
+        """デコードした音声の秒数を返す
+
+        Parameters
+        ----------
+        path
+        """
+        return len(self.load(path)) / SAMPLE_RATE
+
+    @staticmethod
+    def _touch(store_path: str) -> None:
+        """最後に使った時刻として更新時刻を今にする
+
+        Parameters
+        ----------
+        store_path
+        """
+        try:
+            os.utime(store_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove_stale(tmp_path: str, store_path: str) -> None:
+        """落ちたプロセスが残したデコード中の一時ファイルを消す
+        デコード中はファイルロックを持っているので、ロックを取れた場合は書いているプロセスがない
+
+        Parameters
+        ----------
+        tmp_path
+        store_path
+            一時ファイルを置き換える先
+        """
+        lock = filelock.FileLock(f"{store_path}.lock")
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            os.unlink(tmp_path)
+            logger.logger.debug(f"remove stale {tmp_path}")
+        except (FileNotFoundError, PermissionError):
+            # Windows では開いているファイルを消せないので残す
+            pass
+        finally:
+            lock.release()
+
+    def evict(self, keep: str | None = None) -> None:
+        """合計サイズが max_bytes 以下になるまで、最後に使ってから長いファイルから消す
+        開いている memmap は消した後も読める
+        落ちたプロセスが残した一時ファイルも消す
+
+        Parameters
+        ----------
+        keep
+            消さないファイル
+        """
+        files: list[tuple[float, int, str]] = []
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            match = _TMP_NAME.fullmatch(entry.name)
+            if match is not None:
+                self._remove_stale(entry.path, os.path.join(self.directory, match.group(1)))
+                continue
+            if not entry.name.endswith(".npy"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                # Windows では開いているファイルを消せないので残す
+                continue
+            total -= size
+            with self._lock:
+                self.stats.evictions += 1
+
+
+_default_store: AudioStore | None = None
+_default_store_lock = threading.Lock()
+
+
+def default_store() -> AudioStore:
+    """標準で使う AudioStore を返す 初回呼び出し時に作られる"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = AudioStore()
+        return _default_store
+
+
+def set_default_store(store: AudioStore) -> None:
+    """標準で使う AudioStore を差し替える
+
+    Parameters
+    ----------
+    store
+    """
+    global _default_store
+    with _default_store_lock:
+        _default_store = store
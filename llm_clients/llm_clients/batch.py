@@ -0,0 +1,691 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterator
+from typing import Any, Literal, Protocol
+
+import openai.types.chat
+
+import llm_clients.openai
+from llm_clients import cache, ledger, logger, types
+
+ItemStatus = Literal["pending", "submitted", "completed", "failed", "cached"]
+
+# プロバイダ側のバッチがこれ以上進まない状態
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# 結果を取り込むときに状態を書き出す間隔 件数か秒数のどちらかを超えたら書き出す
+INGEST_SAVE_ITEMS = 1000
+INGEST_SAVE_SECONDS = 10.0
+
+
+class BatchProvider(Protocol):
+    """バッチ実行を受け付けるプロバイダのインターフェース
+    リクエスト・結果の JSONL は OpenAI の Batch API の形式に合わせる
+    """
+
+    def submit(self, request_path: str, job_id: str) -> str:
+        """リクエストの JSONL を投入してプロバイダ側のバッチIDを返す
+        job_id はバッチに記録して find で探せるようにする
+
+        Parameters
+        ----------
+        request_path
+        job_id
+        """
+        ...
+
+    def find(self, job_id: str, since: float) -> str | None:
+        """submit で job_id を記録したバッチのIDを返す ない場合は None を返す
+
+        Parameters
+        ----------
+        job_id
+        since
+            投入を始めた UNIX 時刻 これより前に作られたバッチは探さない
+        """
+        ...
+
+    def status(self, batch_id: str) -> str:
+        """バッチの状態を返す 終了した場合は TERMINAL_STATUSES のいずれかになる
+
+        Parameters
+        ----------
+        batch_id
+        """
+        ...
+
+    def results(self, batch_id: str) -> Iterator[dict[str, Any]]:
+        """結果の JSONL を1行ずつ返す
+
+        Parameters
+        ----------
+        batch_id
+        """
+        ...
+
+
+class OpenAIBatchProvider:
+    """OpenAI の Batch API
+
+    Attributes
+    ----------
+    client
+    """
+
+    def __init__(self, client: llm_clients.openai.OpenAI) -> None:
+        """init
+
+        Parameters
+        ----------
+        client
+        """
+        self.client = client
+
+    def submit(self, request_path: str, job_id: str) -> str:
+        """リクエストの JSONL をアップロードしてバッチを作る job_id はバッチの metadata に入れる
+
+        Parameters
+        ----------
+        request_path
+        job_id
+        """
+        sdk_client = self.client.sdk_client()
+        with open(request_path, "rb") as f:
+            input_file = sdk_client.files.create(file=f, purpose="batch")
+        batch = sdk_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"job_id": job_id},
+        )
+        return batch.id
+
+    def find(self, job_id: str, since: float) -> str | None:
+        """metadata の job_id が一致するバッチを新しいものから探す
+
+        Parameters
+        ----------
+        job_id
+        since
+        """
+        for batch in self.client.sdk_client().batches.list(limit=100):
+            # 一覧は新しい順なので、時計のずれを見込んで since より前まで来たら打ち切る
+            if batch.created_at < since - 600:
+                break
+            if isinstance(batch.metadata, dict) and batch.metadata.get("job_id") == job_id:
+                return batch.id
+        return None
+
+    def status(self, batch_id: str) -> str:
+        """バッチの状態を返す
+
+        Parameters
+        ----------
+        batch_id
+        """
+        return self.client.sdk_client().batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> Iterator[dict[str, Any]]:
+        """成功・失敗した結果のファイルをダウンロードして1行ずつ返す
+
+        Parameters
+        ----------
+        batch_id
+        """
+        sdk_client = self.client.sdk_client()
+        batch = sdk_client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            for line in sdk_client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+class LocalBatchProvider:
+    """プロバイダのバッチ実行を手元で模倣する テストやバッチAPIがない環境向け
+    投入されたリクエストを別スレッドで handler に渡し、OpenAI の Batch API と同じ形式の結果を書き出す
+    結果のファイルができる前にプロセスが落ちた場合は、次に status を呼んだときにやり直す
+
+    Attributes
+    ----------
+    handler
+        リクエストの body を受け取ってレスポンスの body を返す関数
+    directory
+    """
+
+    def __init__(
+        self, handler: Callable[[dict[str, Any]], dict[str, Any]], directory: str | None = None
+    ) -> None:
+        """init
+
+        Parameters
+        ----------
+        handler
+        directory
+            結果を書き出すディレクトリ None の場合は cache.CACHE_DIR 以下に作る
+        """
+        self.handler = handler
+        self.directory = (
+            directory if directory is not None else os.path.join(cache.CACHE_DIR, "local_batches")
+        )
+        os.makedirs(self.directory, exist_ok=True)
+        self._threads: dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, batch_id: str, suffix: str) -> str:
+        """バッチごとのファイルのパスを返す
+
+        Parameters
+        ----------
+        batch_id
+        suffix
+        """
+        return os.path.join(self.directory, f"{batch_id}.{suffix}")
+
+    def _run(self, batch_id: str) -> None:
+        """リクエストを順に処理して結果を書き出す
+
+        Parameters
+        ----------
+        batch_id
+        """
+        output_path = self._path(batch_id, "output.jsonl")
+        with (
+            open(self._path(batch_id, "input.jsonl")) as f_in,
+            open(output_path + ".tmp", "w") as f_out,
+        ):
+            for line in f_in:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    result: dict[str, Any] = {
+                        "custom_id": request["custom_id"],
+                        "response": {"status_code": 200, "body": self.handler(request["body"])},
+                        "error": None,
+                    }
+                except Exception as e:
+                    result = {
+                        "custom_id": request["custom_id"],
+                        "response": None,
+                        "error": {"message": str(e)},
+                    }
+                f_out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        os.replace(output_path + ".tmp", output_path)
+
+    def _start(self, batch_id: str) -> None:
+        """処理を別スレッドで始める
+
+        Parameters
+        ----------
+        batch_id
+        """
+        thread = threading.Thread(target=self._run, args=(batch_id,), daemon=True)
+        self._threads[batch_id] = thread
+        thread.start()
+
+    def submit(self, request_path: str, job_id: str) -> str:
+        """リクエストの JSONL を受け付けて処理を始める
+
+        Parameters
+        ----------
+        request_path
+        job_id
+        """
+        batch_id = f"local-{uuid.uuid4().hex}"
+        with open(request_path) as f_in, open(self._path(batch_id, "input.jsonl"), "w") as f_out:
+            f_out.write(f_in.read())
+        with open(self._path(batch_id, "job_id"), "w") as f:
+            f.write(job_id)
+        with self._lock:
+            self._start(batch_id)
+        return batch_id
+
+    def find(self, job_id: str, since: float) -> str | None:
+        """job_id を記録したバッチを探す
+
+        Parameters
+        ----------
+        job_id
+        since
+            手元のバッチはすべて探すので使わない
+        """
+        for fname in os.listdir(self.directory):
+            if not fname.endswith(".job_id"):
+                continue
+            with open(os.path.join(self.directory, fname)) as f:
+                if f.read() == job_id:
+                    return fname.removesuffix(".job_id")
+        return None
+
+    def status(self, batch_id: str) -> str:
+        """バッチの状態を返す
+
+        Parameters
+        ----------
+        batch_id
+        """
+        if os.path.exists(self._path(batch_id, "output.jsonl")):
+            return "completed"
+        if not os.path.exists(self._path(batch_id, "input.jsonl")):
+            return "failed"
+        with self._lock:
+            thread = self._threads.get(batch_id)
+            if thread is None or not thread.is_alive():
+                self._start(batch_id)
+        return "in_progress"
+
+    def results(self, batch_id: str) -> Iterator[dict[str, Any]]:
+        """結果の JSONL を1行ずつ返す
+
+        Parameters
+        ----------
+        batch_id
+        """
+        with open(self._path(batch_id, "output.jsonl")) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _dump_messages(messages: tuple[types.TupleMessage, ...]) -> list[dict[str, Any]]:
+    """メッセージを JSON で保存できる形式にする
+
+    Parameters
+    ----------
+    messages
+    """
+    return [
+        {
+            "role": message.role,
+            "content": (
+                message.content
+                if isinstance(message.content, str)
+                else [[content.type, content.content] for content in message.content]
+            ),
+        }
+        for message in messages
+    ]
+
+
+def _load_messages(values: list[dict[str, Any]]) -> tuple[types.TupleMessage, ...]:
+    """_dump_messages で保存したメッセージを復元する
+
+    Parameters
+    ----------
+    values
+    """
+    messages: list[types.TupleMessage] = []
+    for value in values:
+        match value["role"]:
+            case "user":
+                if isinstance(value["content"], str):
+                    messages.append(types.TupleMessageUser(content=value["content"]))
+                else:
+                    messages.append(
+                        types.TupleMessageUser(
+                            content=tuple(
+                                types.TupleContentParam(type=t, content=c)
+                                for t, c in value["content"]
+                            )
+                        )
+                    )
+            case "assistant":
+                messages.append(types.TupleMessageAssistant(content=value["content"]))
+            case "system":
+                messages.append(types.TupleMessageSystem(content=value["content"]))
+            case "tool":
+                messages.append(types.TupleMessageTool(content=value["content"]))
+    return tuple(messages)
+
+
+class BatchJob:
+    """多数のメッセージをまとめてバッチ実行する
+    ジョブの状態は {directory}/{job_id}/ 以下に保存するので、プロセスが落ちても job_id から再開できる
+    結果はレスポンスのキャッシュとジョブの results.jsonl に書き込まれ、料金は client.fee に加算される
+    結果ごとの使用量は client.usage_ledger に、ジョブを作ったときのタグをつけて記録される
+
+    Attributes
+    ----------
+    job_id
+    client
+    provider
+    directory
+        ジョブのファイルを置くディレクトリ
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        client: llm_clients.openai.OpenAI,
+        provider: BatchProvider | None = None,
+        directory: str | None = None,
+    ) -> None:
+        """init 新しく作る場合は create を、再開する場合は resume を使う
+
+        Parameters
+        ----------
+        job_id
+        client
+        provider
+            None の場合は OpenAIBatchProvider を使う
+        directory
+            None の場合は cache.CACHE_DIR 以下に作る
+        """
+        self.job_id = job_id
+        self.client = client
+        self.provider = provider if provider is not None else OpenAIBatchProvider(client)
+        self.directory = os.path.join(
+            directory if directory is not None else os.path.join(cache.CACHE_DIR, "batches"),
+            job_id,
+        )
+        self._state: dict[str, Any] = {}
+
+    @classmethod
+    def create(
+        cls,
+        client: llm_clients.openai.OpenAI,
+        messages_list: list[tuple[types.TupleMessage, ...]],
+        provider: BatchProvider | None = None,
+        directory: str | None = None,
+    ) -> "BatchJob":
+        """ジョブのファイルを書き出してジョブを作る
+        キャッシュにすでに結果があるメッセージはバッチに含めない
+
+        Parameters
+        ----------
+        client
+        messages_list
+        provider
+        directory
+        """
+        job = cls(uuid.uuid4().hex, client, provider, directory)
+        os.makedirs(job.directory)
+
+        items: list[dict[str, Any]] = []
+        with (
+            open(job._path("messages.jsonl"), "w") as f_messages,
+            open(job._path("requests.jsonl"), "w") as f_requests,
+            open(job._path("results.jsonl"), "w") as f_results,
+        ):
+            for i, messages in enumerate(messages_list):
+                key = cache.make_key("openai", client.model, messages, None)
+                value = client.response_cache.get(key)
+                items.append(
+                    {
+                        "custom_id": str(i),
+                        "key": key,
+                        "status": "pending" if value is None else "cached",
+                    }
+                )
+                f_messages.write(json.dumps(_dump_messages(messages), ensure_ascii=False) + "\n")
+                if value is not None:
+                    # キャッシュから消えても results で返せるようにジョブにも書いておく
+                    f_results.write(job._result_line(str(i), json.loads(value)))
+                    continue
+                request = {
+                    "custom_id": str(i),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": client.model,
+                        "messages": llm_clients.openai.tuple2message(messages),
+                    },
+                }
+                f_requests.write(json.dumps(request, ensure_ascii=False) + "\n")
+
+        job._state = {
+            "job_id": job.job_id,
+            "model": client.model,
+            "batch_id": None,
+            "batch_status": None,
+            # 投入を始めた時刻 投入した後に落ちた場合は、再開したときにこれ以降のバッチから探す
+            "submitted_at": None,
+            # 再開したプロセスでも同じタグで記録できるように保存しておく
+            "tags": {**ledger.current_tags(), **client.tags},
+            "items": items,
+        }
+        job._save()
+        return job
+
+    @classmethod
+    def resume(
+        cls,
+        job_id: str,
+        client: llm_clients.openai.OpenAI,
+        provider: BatchProvider | None = None,
+        directory: str | None = None,
+    ) -> "BatchJob":
+        """保存されたジョブを読み込む
+
+        Parameters
+        ----------
+        job_id
+        client
+        provider
+        directory
+        """
+        job = cls(job_id, client, provider, directory)
+        with open(job._path("state.json")) as f:
+            job._state = json.load(f)
+        return job
+
+    def _path(self, fname: str) -> str:
+        """ジョブのファイルのパスを返す
+
+        Parameters
+        ----------
+        fname
+        """
+        return os.path.join(self.directory, fname)
+
+    def _save(self) -> None:
+        """状態を書き出す 途中で落ちても壊れないように一時ファイルから置き換える"""
+        tmp_path = self._path("state.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._state, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path("state.json"))
+
+    def _result_line(self, custom_id: str, body: dict[str, Any]) -> str:
+        """results.jsonl に書く1行を返す
+
+        Parameters
+        ----------
+        custom_id
+        body
+            ChatCompletion の JSON
+        """
+        return json.dumps({"custom_id": custom_id, "body": body}, ensure_ascii=False) + "\n"
+
+    @property
+    def statuses(self) -> list[ItemStatus]:
+        """メッセージごとの状態"""
+        return [item["status"] for item in self._state["items"]]
+
+    def submit(self) -> None:
+        """未投入のリクエストをプロバイダに投入する 投入済みの場合は何もしない"""
+        if self._state["batch_id"] is not None:
+            return
+        if all(item["status"] != "pending" for item in self._state["items"]):
+            self._state["batch_status"] = "completed"
+            self._save()
+            return
+
+        # 投入した後、batch_id を書き出す前に落ちて同じバッチを2回投入しないように、
+        # 投入を始めたことを先に書き出し、再開したときはプロバイダ側に投入済みのバッチがないか探す
+        batch_id = None
+        if self._state.get("submitted_at") is not None:
+            batch_id = self.provider.find(self.job_id, self._state["submitted_at"])
+        else:
+            self._state["submitted_at"] = time.time()
+            self._save()
+        if batch_id is None:
+            batch_id = self.provider.submit(self._path("requests.jsonl"), self.job_id)
+        self._state["batch_id"] = batch_id
+        self._state["batch_status"] = "submitted"
+        for item in self._state["items"]:
+            if item["status"] == "pending":
+                item["status"] = "submitted"
+        self._save()
+        logger.logger.debug(f"submit batch {self.job_id}: {self._state['batch_id']}")
+
+    def poll(self) -> str:
+        """プロバイダの状態を確認し、終了していれば結果を取り込む"""
+        self.submit()
+        if self._state["batch_status"] in TERMINAL_STATUSES:
+            self.ingest()
+            return self._state["batch_status"]
+
+        status = self.provider.status(self._state["batch_id"])
+        self._state["batch_status"] = status
+        self._save()
+        if status in TERMINAL_STATUSES:
+            self.ingest()
+        return status
+
+    def wait(self, interval: float = 60.0, timeout: float | None = None) -> str:
+        """終了するまで interval 秒ごとに poll する
+
+        Parameters
+        ----------
+        interval
+        timeout
+            待つ秒数の上限 None の場合は終了するまで待つ
+        """
+        start = time.monotonic()
+        while (status := self.poll()) not in TERMINAL_STATUSES:
+            if timeout is not None and time.monotonic() - start > timeout:
+                break
+            time.sleep(interval)
+        return status
+
+    def ingest(self) -> None:
+        """結果をレスポンスのキャッシュに書き込み、料金を加算して使用量を記録する
+        状態は INGEST_SAVE_ITEMS 件か INGEST_SAVE_SECONDS 秒ごとにまとめて書き出す
+        料金と使用量は取り込み済みにした状態を書き出してから記録するので、途中で落ちて
+        最後に書き出した後の結果をもう一度取り込んでも、重複して記録されない
+        """
+        items = {item["custom_id"]: item for item in self._state["items"]}
+        if all(item["status"] != "submitted" for item in items.values()):
+            return
+        with open(self._path("messages.jsonl")) as f:
+            messages_list = [_load_messages(json.loads(line)) for line in f]
+
+        # 状態を書き出すまで記録を待つ結果
+        unrecorded: list[
+            tuple[tuple[types.TupleMessage, ...], openai.types.chat.ChatCompletion]
+        ] = []
+        unsaved = 0
+        saved_at = time.monotonic()
+        self._truncate_results()
+        with open(self._path("results.jsonl"), "a") as f_results:
+            for result in self.provider.results(self._state["batch_id"]):
+                item = items.get(result["custom_id"])
+                if item is None or item["status"] != "submitted":
+                    continue
+                response = result.get("response")
+                if response is None or response["status_code"] != 200:
+                    item["status"] = "failed"
+                    item["error"] = result.get("error") or (response or {}).get("body")
+                else:
+                    body = response["body"]
+                    completion = openai.types.chat.ChatCompletion.model_validate(body)
+                    self.client.response_cache.set(
+                        item["key"], completion.model_dump_json().encode()
+                    )
+                    f_results.write(self._result_line(item["custom_id"], body))
+                    unrecorded.append((messages_list[int(item["custom_id"])], completion))
+                    item["status"] = "completed"
+                unsaved += 1
+                if (
+                    unsaved >= INGEST_SAVE_ITEMS
+                    or time.monotonic() - saved_at >= INGEST_SAVE_SECONDS
+                ):
+                    # 取り込み済みにした結果が results.jsonl に書かれてから状態を書き出す
+                    f_results.flush()
+                    self._save_and_record(unrecorded)
+                    unsaved = 0
+                    saved_at = time.monotonic()
+
+        if self._state["batch_status"] in TERMINAL_STATUSES:
+            for item in items.values():
+                if item["status"] == "submitted":
+                    item["status"] = "failed"
+                    item["error"] = {"message": f"batch {self._state['batch_status']}"}
+        self._save_and_record(unrecorded)
+
+    def _truncate_results(self) -> None:
+        """書いている途中で落ちた results.jsonl の最後の行を切り捨てる"""
+        with open(self._path("results.jsonl"), "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def _save_and_record(
+        self,
+        unrecorded: list[tuple[tuple[types.TupleMessage, ...], openai.types.chat.ChatCompletion]],
+    ) -> None:
+        """状態を書き出してから、取り込んだ結果の料金と使用量を記録する
+        書き出した後、記録する前に落ちた場合はその分が記録されないが、重複はしない
+
+        Parameters
+        ----------
+        unrecorded
+            記録する (メッセージ, 応答) 記録したものは取り除く
+        """
+        self._save()
+        for messages, completion in unrecorded:
+            self._record_usage(messages, completion)
+        unrecorded.clear()
+
+    def _record_usage(
+        self,
+        messages: tuple[types.TupleMessage, ...],
+        completion: openai.types.chat.ChatCompletion,
+    ) -> None:
+        """料金を client.fee に加算し、1件の結果の使用量を記録する
+
+        Parameters
+        ----------
+        messages
+        completion
+        """
+        record = ledger.UsageRecord(
+            provider="openai",
+            model=self._state["model"],
+            cache_hit=False,
+            cost=self.client.calc_fee(messages, completion, batch=True),
+            tags=dict(self._state.get("tags", {})),
+        )
+        if completion.usage is not None:
+            record.prompt_tokens = completion.usage.prompt_tokens
+            record.completion_tokens = completion.usage.completion_tokens
+        self.client.usage_ledger.record(record)
+
+    def results(self) -> list[str | None]:
+        """メッセージごとの応答を入力と同じ順番で返す 結果がないものは None になる
+        応答はジョブの results.jsonl から読むので、レスポンスのキャッシュから消えていても返せる
+        """
+        bodies: dict[str, dict[str, Any]] = {}
+        with open(self._path("results.jsonl")) as f:
+            for line in f:
+                # 落ちて取り込み直した結果は同じ custom_id で後ろに書かれる
+                if line.endswith("\n"):
+                    value = json.loads(line)
+                    bodies[value["custom_id"]] = value["body"]
+
+        ret: list[str | None] = []
+        for item in self._state["items"]:
+            body = (
+                bodies.get(item["custom_id"]) if item["status"] in ("completed", "cached") else None
+            )
+            if body is None:
+                ret.append(None)
+                continue
+            completion = openai.types.chat.ChatCompletion.model_validate(body)
+            ret.append(completion.choices[0].message.content)
+        return ret
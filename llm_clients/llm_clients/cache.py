@@ -0,0 +1,349 @@
+import asyncio
+import dataclasses
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from typing import Protocol
+
+import pydantic
+
+from llm_clients import logger, types
+
+# 環境変数で永続キャッシュの置き場所を変えられる
+CACHE_DIR = os.environ.get(
+    "LLM_CLIENTS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "llm_clients")
+)
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class ResponseCache(Protocol):
+    """LLMのレスポンスを保存するキャッシュのバックエンド
+
+    Attributes
+    ----------
+    stats
+        ヒット・ミス・削除の回数
+    """
+
+    stats: CacheStats
+
+    def get(self, key: str) -> bytes | None:
+        """キャッシュを取得する ない場合は None を返す
+
+        Parameters
+        ----------
+        key
+        """
+        ...
+
+    def set(self, key: str, value: bytes) -> None:
+        """キャッシュを保存する
+
+        Parameters
+        ----------
+        key
+        value
+        """
+        ...
+
+
+class SQLiteCache:
+    """SQLite に保存する永続キャッシュ
+    WAL モードで開くので複数プロセスから同じファイルを安全に共有できる
+
+    Attributes
+    ----------
+    path
+    max_bytes
+        保存する値の合計サイズの上限 超えた分は最終アクセスが古いものから削除する
+    ttl
+        保存してから有効な秒数 None の場合は期限なし
+    stats
+    """
+
+    def __init__(
+        self,
+        path: str | None = None,
+        max_bytes: int = 1 << 30,
+        ttl: float | None = 30 * 24 * 60 * 60,
+    ) -> None:
+        """init
+
+        Parameters
+        ----------
+        path
+            SQLite のファイルのパス None の場合は CACHE_DIR 以下に作る
+        max_bytes
+        ttl
+        """
+        self.path = path if path is not None else os.path.join(CACHE_DIR, "responses.sqlite3")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        """スレッド・プロセスごとのコネクションを返す"""
+        pid, conn = getattr(self._local, "conn", (None, None))
+        if conn is None or pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = (os.getpid(), conn)
+        return conn
+
+    def _count(self, name: str, n: int = 1):
+        """統計情報を加算する
+
+        Parameters
+        ----------
+        name
+        n
+        """
+        with self._stats_lock:
+            setattr(self.stats, name, getattr(self.stats, name) + n)
+
+    def get(self, key: str) -> bytes | None:
+        """キャッシュを取得する ない場合は None を返す
+
+        Parameters
+        ----------
+        key
+        """
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._count("evictions")
+            row = None
+        if row is None:
+            self._count("misses")
+            return None
+
+        conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        self._count("hits")
+        return row[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        """キャッシュを保存し、上限を超えた分を削除する
+
+        Parameters
+        ----------
+        key
+        value
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now, now),
+        )
+        evicted = 0
+        if self.ttl is not None:
+            evicted += conn.execute(
+                "DELETE FROM entries WHERE created_at < ?", (now - self.ttl,)
+            ).rowcount
+        evicted += conn.execute(
+            "DELETE FROM entries WHERE key IN ("
+            "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS total "
+            "FROM entries) WHERE total > ?)",
+            (self.max_bytes,),
+        ).rowcount
+        if evicted:
+            logger.logger.debug(f"evict {evicted} cache entries")
+            self._count("evictions", evicted)
+
+
+_default_cache: ResponseCache | None = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache() -> ResponseCache:
+    """クライアントが標準で使うキャッシュを返す 初回呼び出し時に作られる"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SQLiteCache()
+        return _default_cache
+
+
+def set_default_cache(backend: ResponseCache) -> None:
+    """クライアントが標準で使うキャッシュを差し替える
+
+    Parameters
+    ----------
+    backend
+    """
+    global _default_cache
+    with _default_cache_lock:
+        _default_cache = backend
+
+
+_digests: dict[tuple[str, int, int], str] = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(path: str) -> str:
+    """ファイルの中身の SHA-256 を返す
+    パス・更新時刻・サイズが変わらない間は計算結果を使い回す
+
+    Parameters
+    ----------
+    path
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _digests_lock:
+        digest = _digests.get(memo_key)
+    if digest is None:
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        with _digests_lock:
+            _digests[memo_key] = digest
+    return digest
+
+
+def _normalize_content(content: types.TupleContentParam) -> dict[str, str]:
+    """メッセージ中のコンテンツをキャッシュのキー用に正規化する
+    ローカルのファイルはパスではなく中身のハッシュで表す
+
+    Parameters
+    ----------
+    content
+    """
+    if content.type == "image_url" and os.path.isfile(content.content):
+        return {
+            "type": content.type,
+            "sha256": file_digest(content.content),
+            "suffix": os.path.splitext(content.content)[1].lower(),
+        }
+    return {"type": content.type, "content": content.content}
+
+
+def make_key(
+    provider: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: type[pydantic.BaseModel] | None,
+) -> str:
+    """キャッシュのキーを作る
+    APIキーは含めないので、キーを変えてもキャッシュは使い回される
+
+    Parameters
+    ----------
+    provider
+    model
+    messages
+    response_format
+    """
+    normalized: list[dict[str, str | list[dict[str, str]]]] = []
+    for message in messages:
+        if isinstance(message.content, str):
+            normalized.append({"role": message.role, "content": message.content})
+        else:
+            normalized.append(
+                {"role": message.role, "content": [_normalize_content(c) for c in message.content]}
+            )
+    payload = json.dumps(
+        {
+            "provider": provider,
+            "model": model,
+            "messages": normalized,
+            "response_format": (
+                None if response_format is None else response_format.model_json_schema()
+            ),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def cached_call[R](
+    backend: ResponseCache,
+    key: str,
+    fetch: Callable[[], R],
+    dump: Callable[[R], bytes],
+    load: Callable[[bytes], R],
+) -> R:
+    """キャッシュがある場合はキャッシュを返し、ない場合は fetch の結果を保存して返す
+
+    Parameters
+    ----------
+    backend
+    key
+    fetch
+        キャッシュがない場合に呼ぶ関数
+    dump
+        結果をバイト列に変換する関数
+    load
+        バイト列を結果に戻す関数
+    """
+    value = backend.get(key)
+    if value is not None:
+        try:
+            return load(value)
+        except Exception as e:
+            logger.logger.warning(f"ignore broken cache {key}: {e}")
+
+    logger.logger.debug("don't use cache")
+    response = fetch()
+    backend.set(key, dump(response))
+    return response
+
+
+async def cached_call_async[R](
+    backend: ResponseCache,
+    key: str,
+    fetch: Callable[[], Awaitable[R]],
+    dump: Callable[[R], bytes],
+    load: Callable[[bytes], R],
+) -> R:
+    """cached_call の非同期版
+    キャッシュの読み書きはイベントループを止めないように別スレッドで行う
+
+    Parameters
+    ----------
+    backend
+    key
+    fetch
+        キャッシュがない場合に呼ぶ関数
+    dump
+        結果をバイト列に変換する関数
+    load
+        バイト列を結果に戻す関数
+    """
+    value = await asyncio.to_thread(backend.get, key)
+    if value is not None:
+        try:
+            return load(value)
+        except Exception as e:
+            logger.logger.warning(f"ignore broken cache {key}: {e}")
+
+    logger.logger.debug("don't use cache")
+    response = await fetch()
+    await asyncio.to_thread(backend.set, key, dump(response))
+    return response
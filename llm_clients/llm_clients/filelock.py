@@ -0,0 +1,112 @@
+import os
+import time
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+class FileLock:
+    """ファイルを使ったプロセス間のロック
+    delete=True の場合は解放時にロックファイルを消す
+    消したファイルをつかんでしまった場合は取り直すので、消しても排他は崩れない
+
+    Attributes
+    ----------
+    path
+    delete
+    """
+
+    def __init__(self, path: str, delete: bool = True) -> None:
+        """init
+
+        Parameters
+        ----------
+        path
+        delete
+        """
+        self.path = path
+        self.delete = delete
+        self._fd: int | None = None
+
+    @staticmethod
+    def _lock(fd: int, blocking: bool) -> bool:
+        """fd をロックする blocking=False で取れなかった場合は False を返す
+
+        Parameters
+        ----------
+        fd
+        blocking
+        """
+        try:
+            if os.name == "nt":
+                msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            if blocking:
+                raise
+            return False
+        return True
+
+    def acquire(self, blocking: bool = True, timeout: float | None = None) -> bool:
+        """ロックを取る 取れなかった場合は False を返す
+
+        Parameters
+        ----------
+        blocking
+            False の場合は待たずに返す
+        timeout
+            待つ秒数の上限 None の場合は取れるまで待つ
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if deadline is None and blocking:
+                locked = self._lock(fd, True)
+            else:
+                locked = self._lock(fd, False)
+            if locked:
+                try:
+                    # 待っている間に他のプロセスがファイルを消していたら取り直す
+                    if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                        self._fd = fd
+                        return True
+                except FileNotFoundError:
+                    pass
+            os.close(fd)
+            if locked:
+                continue
+            if not blocking or (deadline is not None and time.monotonic() > deadline):
+                return False
+            time.sleep(0.05)
+
+    def release(self) -> None:
+        """ロックを解放する"""
+        if self._fd is None:
+            return
+        # Windows では開いているファイルを消せないので残す
+        if self.delete and os.name != "nt":
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        # ロックは close で解放される
+        os.close(self._fd)
+        self._fd = None
+
+    @property
+    def locked(self) -> bool:
+        """ロックを持っているかどうか"""
+        return self._fd is not None
+
+    def __enter__(self) -> "FileLock":
+        """with でロックを取る"""
+        self.acquire()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        """with を抜けるときにロックを解放する"""
+        self.release()
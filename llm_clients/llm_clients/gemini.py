@@ -1,23 +1,46 @@
+import asyncio
+import functools
+import json
 import mimetypes
+import os
+import threading
+import time
+from collections.abc import AsyncIterator, Callable, Iterator
 from typing import TypedDict, overload
 
+import google.ai.generativelanguage
+import google.api_core.exceptions
 import google.generativeai
 import google.generativeai.models
 import pydantic
-import pydub
-import streamlit
+from google.generativeai import client as genai_client
+from google.generativeai.types import content_types, generation_types, safety_types
 
-from llm_clients import logger, types
+from llm_clients import (
+    cache,
+    ledger,
+    logger,
+    media,
+    pool,
+    ratelimit,
+    singleflight,
+    tokens,
+    types,
+    uploads,
+)
 
 
 def tuple2message(
-    tuple_messages: tuple[types.TupleMessage, ...]
+    tuple_messages: tuple[types.TupleMessage, ...],
+    upload: Callable[[str], google.generativeai.types.File] | None = None,
 ) -> list[google.generativeai.types.ContentDict]:
     """types.TupleMessage を Gemini のメッセージの形式に変換する
 
     Parameters
     ----------
     tuple_messages
+    upload
+        ファイルをアップロードする関数 None の場合は毎回 google.generativeai.upload_file を呼ぶ
     """
     messages: list[google.generativeai.types.ContentDict] = []
     for tuple_message in tuple_messages:
@@ -36,7 +59,12 @@ def tuple2message(
                             case "text":
                                 contents.append(tuple_content.content)
                             case "image_url":
-                                file = google.generativeai.upload_file(path=tuple_content.content)
+                                if upload is not None:
+                                    file = upload(tuple_content.content)
+                                else:
+                                    file = google.generativeai.upload_file(
+                                        path=tuple_content.content
+                                    )
                                 contents.append(file)
                     messages.append(
                         google.generativeai.types.ContentDict(role="user", parts=contents)
@@ -74,12 +102,323 @@ def pydantic_to_typed_dict(model: type[pydantic.BaseModel]) -> type[TypedDict]:
     return TypedDict(model.__name__ + "Dict", class_dict)  # pyright: ignore
 
 
-@streamlit.cache_resource(show_spinner=False)
+def _media_paths(messages: tuple[types.TupleMessage, ...]) -> list[str]:
+    """メッセージに含まれるアップロード対象のファイルのパスを返す
+
+    Parameters
+    ----------
+    messages
+    """
+    return [
+        content.content
+        for message in messages
+        if message.role == "user" and not isinstance(message.content, str)
+        for content in message.content
+        if content.type == "image_url"
+    ]
+
+
+# Gemini は音声を1秒あたり32トークンとして数える
+AUDIO_TOKENS_PER_SECOND = 32
+
+
+def _attachments(messages: tuple[types.TupleMessage, ...]) -> tuple[float, int, float]:
+    """添付ファイルの音声の秒数、画像の枚数、動画の秒数を返す
+
+    Parameters
+    ----------
+    messages
+    """
+    audio_seconds = 0.0
+    images = 0
+    video_seconds = 0.0
+    for message in messages:
+        if message.role != "user" or isinstance(message.content, str):
+            continue
+        for content in message.content:
+            if content.type == "text":
+                continue
+            file_type, _ = mimetypes.guess_type(content.content)
+            if file_type is None:
+                continue
+            if file_type.startswith("audio/"):
+                audio_seconds += media.duration(content.content)
+            elif file_type.startswith("image/"):
+                images += 1
+            elif file_type.startswith("video/"):
+                video_seconds += media.duration(content.content)
+    return audio_seconds, images, video_seconds
+
+
+_SAFETY_SETTINGS = {
+    google.generativeai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: google.generativeai.types.HarmBlockThreshold.BLOCK_NONE,
+    google.generativeai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: google.generativeai.types.HarmBlockThreshold.BLOCK_NONE,
+    google.generativeai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: google.generativeai.types.HarmBlockThreshold.BLOCK_NONE,
+    google.generativeai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: google.generativeai.types.HarmBlockThreshold.BLOCK_NONE,
+}
+
+
+@functools.cache
+def _generation_config(
+    response_format: type[pydantic.BaseModel] | None,
+) -> google.generativeai.GenerationConfig | None:
+    """response_format ごとの生成設定を返す 一度作ったものは使い回す
+
+    Parameters
+    ----------
+    response_format
+    """
+    if response_format is None:
+        return None
+    return google.generativeai.GenerationConfig(
+        response_mime_type="application/json",
+        response_schema=pydantic_to_typed_dict(response_format),  # pyright: ignore
+    )
+
+
+def _client(
+    client_pool: pool.ClientPool, api_key: str
+) -> google.ai.generativelanguage.GenerativeServiceClient:
+    """APIキーごとの GenerativeServiceClient を返す
+    google.generativeai.configure はプロセス全体の設定なので使わず、クライアントごとにAPIキーを持たせる
+    gRPC の接続は SDK が持つので、PoolConfig のうち使うのは timeout だけ
+
+    Parameters
+    ----------
+    client_pool
+    api_key
+    """
+
+    def make(config: pool.PoolConfig) -> google.ai.generativelanguage.GenerativeServiceClient:
+        return google.ai.generativelanguage.GenerativeServiceClient(
+            client_options={"api_key": api_key}
+        )
+
+    return client_pool.get("gemini", api_key, "", make)
+
+
+def _file_client(client_pool: pool.ClientPool, api_key: str) -> genai_client.FileServiceClient:
+    """APIキーごとのファイルアップロード用のクライアントを返す
+
+    Parameters
+    ----------
+    client_pool
+    api_key
+    """
+
+    def make(config: pool.PoolConfig) -> genai_client.FileServiceClient:
+        return genai_client.FileServiceClient(client_options={"api_key": api_key})
+
+    return client_pool.get("gemini_files", api_key, "", make)
+
+
+def _request(
+    model: str,
+    contents: list[google.generativeai.types.ContentDict],
+    response_format: type[pydantic.BaseModel] | None,
+) -> google.generativeai.protos.GenerateContentRequest:
+    """GenerativeModel.generate_content と同じリクエストを作る
+
+    Parameters
+    ----------
+    model
+    contents
+    response_format
+    """
+    return google.generativeai.protos.GenerateContentRequest(
+        model=model if "/" in model else f"models/{model}",
+        contents=content_types.to_contents(contents),
+        generation_config=generation_types.to_generation_config_dict(
+            _generation_config(response_format)
+        ),
+        safety_settings=safety_types.normalize_safety_settings(_SAFETY_SETTINGS),
+    )
+
+
+def _upload_file(
+    client_pool: pool.ClientPool, api_key: str, path: str
+) -> google.generativeai.types.File:
+    """ファイルをアップロードする
+
+    Parameters
+    ----------
+    client_pool
+    api_key
+    path
+    """
+    mime_type, _ = mimetypes.guess_type(path)
+    if mime_type is None:
+        raise ValueError(f"cannot guess the mime type of {path}")
+    return google.generativeai.types.File(
+        _file_client(client_pool, api_key).create_file(
+            path=path, mime_type=mime_type, display_name=os.path.basename(path)
+        )
+    )
+
+
+def _uploader(
+    upload_registry: uploads.UploadRegistry, client_pool: pool.ClientPool, api_key: str
+) -> Callable[[str], google.generativeai.types.File]:
+    """tuple2message に渡すアップロード関数を返す
+    アップロード済みのファイルは upload_registry から使い回す
+
+    Parameters
+    ----------
+    upload_registry
+    client_pool
+    api_key
+    """
+
+    def upload(path: str) -> google.generativeai.types.File:
+        return upload_registry.upload(
+            path, api_key, lambda path: _upload_file(client_pool, api_key, path)
+        )
+
+    return upload
+
+
+def _stream_usage(
+    messages: tuple[types.TupleMessage, ...],
+    response: google.generativeai.types.GenerateContentResponse,
+    text: str,
+) -> types.Usage:
+    """ストリーミングのトークン数を返す
+    途中で打ち切られてトークン数を受け取れなかった場合は概算する
+
+    Parameters
+    ----------
+    messages
+    response
+    text
+        受け取った文字列をつなげたもの
+    """
+    usage_metadata = response.usage_metadata
+    prompt_tokens = usage_metadata.prompt_token_count
+    completion_tokens = usage_metadata.candidates_token_count
+    if prompt_tokens == 0:
+        prompt_tokens = tokens.estimate_message_tokens(messages)
+    if completion_tokens == 0:
+        completion_tokens = tokens.estimate_tokens(text)
+    return types.Usage(prompt_tokens, completion_tokens)
+
+
+def _chunk_text(
+    chunk: google.generativeai.types.GenerateContentResponse,
+) -> str:
+    """ストリーミングのチャンクの文字列を返す 文字列を含まないチャンクは空文字を返す
+
+    Parameters
+    ----------
+    chunk
+    """
+    if not chunk.candidates or not chunk.candidates[0].content.parts:
+        return ""
+    return chunk.text
+
+
+def _fetch(
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: type[pydantic.BaseModel] | None,
+    upload_registry: uploads.UploadRegistry,
+    client_pool: pool.ClientPool,
+) -> google.generativeai.types.GenerateContentResponse:
+    """fetch API
+    アップロード済みのファイルがサーバー側で消えていた場合はアップロードし直して一度だけやり直す
+
+    Parameters
+    ----------
+    api_key
+    model
+    messages
+    response_format
+    upload_registry
+    client_pool
+    """
+    client = _client(client_pool, api_key)
+
+    upload = _uploader(upload_registry, client_pool, api_key)
+
+    def generate() -> google.generativeai.types.GenerateContentResponse:
+        return google.generativeai.types.GenerateContentResponse.from_response(
+            client.generate_content(
+                _request(model, tuple2message(messages, upload), response_format),
+                timeout=client_pool.config.timeout,
+            )
+        )
+
+    try:
+        return generate()
+    except (google.api_core.exceptions.NotFound, google.api_core.exceptions.PermissionDenied):
+        paths = _media_paths(messages)
+        if not paths:
+            raise
+        logger.logger.warning("uploaded files may have expired, upload them again")
+        for path in paths:
+            upload_registry.invalidate(path, api_key)
+        return generate()
+
+
+async def _fetch_async(
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: type[pydantic.BaseModel] | None,
+    upload_registry: uploads.UploadRegistry,
+    client_pool: pool.ClientPool,
+) -> google.generativeai.types.GenerateContentResponse:
+    """fetch API の非同期版
+    SDK の非同期クライアントは作ったときのイベントループに紐づくので、同期のクライアントを別スレッドで呼ぶ
+
+    Parameters
+    ----------
+    api_key
+    model
+    messages
+    response_format
+    upload_registry
+    client_pool
+    """
+    return await asyncio.to_thread(
+        _fetch, api_key, model, messages, response_format, upload_registry, client_pool
+    )
+
+
+def _dump_response(
+    response: google.generativeai.types.GenerateContentResponse,
+) -> bytes:
+    """レスポンスをキャッシュに保存できるバイト列に変換する
+
+    Parameters
+    ----------
+    response
+    """
+    return json.dumps(response.to_dict(), ensure_ascii=False).encode()
+
+
+def _load_response(value: bytes) -> google.generativeai.types.GenerateContentResponse:
+    """キャッシュのバイト列からレスポンスを復元する
+
+    Parameters
+    ----------
+    value
+    """
+    return google.generativeai.types.GenerateContentResponse.from_response(
+        google.generativeai.protos.GenerateContentResponse(json.loads(value))
+    )
+
+
 def _cached_fetch(
     api_key: str,
     model: str,
     messages: tuple[types.TupleMessage, ...],
     response_format: type[pydantic.BaseModel] | None,
+    response_cache: cache.ResponseCache,
+    upload_registry: uploads.UploadRegistry,
+    client_pool: pool.ClientPool,
+    scheduler: ratelimit.Scheduler,
+    single_flight: singleflight.SingleFlight,
 ) -> google.generativeai.types.GenerateContentResponse:
     """fetch API
     キャッシュがある場合はキャッシュを返す
@@ -90,28 +429,75 @@ def _cached_fetch(
     model
     messages
     response_format
+    response_cache
+    upload_registry
+    client_pool
+    scheduler
+    single_flight
     """
-    logger.logger.debug("don't use cache")
-    google.generativeai.configure(api_key=api_key)
-    client = google.generativeai.GenerativeModel(model)
+    key = cache.make_key("gemini", model, messages, response_format)
+    return single_flight.do(
+        key,
+        lambda: cache.cached_call(
+            response_cache,
+            key,
+            lambda: scheduler.run(
+                api_key,
+                model,
+                tokens.estimate_message_tokens(messages),
+                lambda: _fetch(
+                    api_key, model, messages, response_format, upload_registry, client_pool
+                ),
+            ),
+            _dump_response,
+            _load_response,
+        ),
+    )
 
-    if response_format is not None:
-        generation_config = google.generativeai.GenerationConfig(
-            response_mime_type="application/json",
-            response_schema=pydantic_to_typed_dict(response_format),  # pyright: ignore
-        )
-    else:
-        generation_config = None
-
-    return client.generate_content(
-        contents=tuple2message(messages),
-        generation_config=generation_config,
-        safety_settings={
-            google.generativeai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: google.generativeai.types.HarmBlockThreshold.BLOCK_NONE,
-            google.generativeai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: google.generativeai.types.HarmBlockThreshold.BLOCK_NONE,
-            google.generativeai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: google.generativeai.types.HarmBlockThreshold.BLOCK_NONE,
-            google.generativeai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: google.generativeai.types.HarmBlockThreshold.BLOCK_NONE,
-        },
+
+async def _cached_fetch_async(
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: type[pydantic.BaseModel] | None,
+    response_cache: cache.ResponseCache,
+    upload_registry: uploads.UploadRegistry,
+    client_pool: pool.ClientPool,
+    scheduler: ratelimit.Scheduler,
+    single_flight: singleflight.SingleFlight,
+) -> google.generativeai.types.GenerateContentResponse:
+    """fetch API の非同期版
+    キャッシュがある場合はキャッシュを返す
+
+    Parameters
+    ----------
+    api_key
+    model
+    messages
+    response_format
+    response_cache
+    upload_registry
+    client_pool
+    scheduler
+    single_flight
+    """
+    key = cache.make_key("gemini", model, messages, response_format)
+    return await single_flight.do_async(
+        key,
+        lambda: cache.cached_call_async(
+            response_cache,
+            key,
+            lambda: scheduler.run_async(
+                api_key,
+                model,
+                tokens.estimate_message_tokens(messages),
+                lambda: _fetch_async(
+                    api_key, model, messages, response_format, upload_registry, client_pool
+                ),
+            ),
+            _dump_response,
+            _load_response,
+        ),
     )
 
 
@@ -122,21 +508,67 @@ class Gemini:
     ----------
     api_key
     model
+    response_cache
+    upload_registry
+    client_pool
+    scheduler
+    single_flight
+    usage_ledger
+    tags
+        呼び出しの記録につけるタグ
     fee
         LLM実行にかかった料金
     """
 
-    def __init__(self, api_key: str, model: str = "gemini-1.5-flash") -> None:
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "gemini-1.5-flash",
+        response_cache: cache.ResponseCache | None = None,
+        upload_registry: uploads.UploadRegistry | None = None,
+        client_pool: pool.ClientPool | None = None,
+        scheduler: ratelimit.Scheduler | None = None,
+        single_flight: singleflight.SingleFlight | None = None,
+        usage_ledger: ledger.Ledger | None = None,
+        tags: dict[str, str] | None = None,
+    ) -> None:
         """init
 
         Parameters
         ----------
         api_key
         model
+        response_cache
+            レスポンスのキャッシュ None の場合は cache.default_cache() を使う
+        upload_registry
+            アップロード済みファイルの管理 None の場合は uploads.default_registry() を使う
+        client_pool
+            SDK のクライアントの作り置き None の場合は pool.default_pool() を使う
+        scheduler
+            レート制限の管理 None の場合は ratelimit.default_scheduler() を使う
+        single_flight
+            同時に来た同じリクエストをまとめる None の場合は singleflight.default_single_flight() を使う
+        usage_ledger
+            呼び出しごとの使用量の記録 None の場合は ledger.default_ledger() を使う
+        tags
         """
         self.api_key = api_key
         self.model = model
+        self.response_cache = (
+            response_cache if response_cache is not None else cache.default_cache()
+        )
+        self.upload_registry = (
+            upload_registry if upload_registry is not None else uploads.default_registry()
+        )
+        self.client_pool = client_pool if client_pool is not None else pool.default_pool()
+        self.scheduler = scheduler if scheduler is not None else ratelimit.default_scheduler()
+        self.single_flight = (
+            single_flight if single_flight is not None else singleflight.default_single_flight()
+        )
+        self.usage_ledger = usage_ledger if usage_ledger is not None else ledger.default_ledger()
+        self.tags = tags if tags is not None else {}
         self.fee = 0.0
+        self._fee_lock = threading.Lock()
 
     @overload
     def fetch(self, messages: tuple[types.TupleMessage, ...], response_format: None) -> str: ...
@@ -162,26 +594,326 @@ class Gemini:
             指定した場合はJSONモードで実行し、指示したモデルの形状で返す
             None の場合は文字列を返す
         """
-        response = _cached_fetch(self.api_key, self.model, messages, response_format)
-        logger.logger.debug(response)
-        self.calc_fee(messages, response)
+        with ledger.track(self.usage_ledger, "gemini", self.model, self.tags) as record:
+            response = _cached_fetch(
+                self.api_key,
+                self.model,
+                messages,
+                response_format,
+                self.response_cache,
+                self.upload_registry,
+                self.client_pool,
+                self.scheduler,
+                self.single_flight,
+            )
+            logger.logger.debug(response)
+            self._record_usage(record, messages, response)
         if response_format is not None:
             return response_format.model_validate_json(response.text)
         else:
             return response.text
 
-    def calc_fee(
+    @overload
+    async def fetch_async(
+        self, messages: tuple[types.TupleMessage, ...], response_format: None
+    ) -> str: ...
+
+    @overload
+    async def fetch_async(self, messages: tuple[types.TupleMessage, ...]) -> str: ...
+
+    @overload
+    async def fetch_async[
+        T: type[pydantic.BaseModel]
+    ](self, messages: tuple[types.TupleMessage, ...], response_format: T) -> T: ...
+
+    async def fetch_async[
+        T: type[pydantic.BaseModel]
+    ](self, messages: tuple[types.TupleMessage, ...], response_format: T | None = None) -> T | str:
+        """fetch API の非同期版
+
+        Parameters
+        ----------
+        messages
+        response_format
+            出力の形式を指定したい場合に与える
+            指定した場合はJSONモードで実行し、指示したモデルの形状で返す
+            None の場合は文字列を返す
+        """
+        with ledger.track(self.usage_ledger, "gemini", self.model, self.tags) as record:
+            response = await _cached_fetch_async(
+                self.api_key,
+                self.model,
+                messages,
+                response_format,
+                self.response_cache,
+                self.upload_registry,
+                self.client_pool,
+                self.scheduler,
+                self.single_flight,
+            )
+            logger.logger.debug(response)
+            await asyncio.to_thread(self._record_usage, record, messages, response)
+        if response_format is not None:
+            return response_format.model_validate_json(response.text)
+        else:
+            return response.text
+
+    @overload
+    async def fetch_many(
+        self,
+        messages_list: list[tuple[types.TupleMessage, ...]],
+        response_format: None,
+        max_concurrency: int = 8,
+    ) -> list[str]: ...
+
+    @overload
+    async def fetch_many(
+        self, messages_list: list[tuple[types.TupleMessage, ...]], *, max_concurrency: int = 8
+    ) -> list[str]: ...
+
+    @overload
+    async def fetch_many[
+        T: type[pydantic.BaseModel]
+    ](
+        self,
+        messages_list: list[tuple[types.TupleMessage, ...]],
+        response_format: T,
+        max_concurrency: int = 8,
+    ) -> list[T]: ...
+
+    async def fetch_many[
+        T: type[pydantic.BaseModel]
+    ](
+        self,
+        messages_list: list[tuple[types.TupleMessage, ...]],
+        response_format: T | None = None,
+        max_concurrency: int = 8,
+    ) -> (list[str] | list[T]):
+        """複数の fetch を並行して実行し、入力と同じ順番で結果を返す
+
+        Parameters
+        ----------
+        messages_list
+        response_format
+            出力の形式を指定したい場合に与える
+        max_concurrency
+            同時に実行するリクエストの上限
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch(messages: tuple[types.TupleMessage, ...]):
+            async with semaphore:
+                return await self.fetch_async(messages, response_format)
+
+        return list(await asyncio.gather(*(fetch(messages) for messages in messages_list)))
+
+    def _stream(
+        self, request: google.generativeai.protos.GenerateContentRequest
+    ) -> google.generativeai.types.GenerateContentResponse:
+        """ストリーミングで生成を始め、チャンクを順に返すレスポンスを返す
+
+        Parameters
+        ----------
+        request
+        """
+        return google.generativeai.types.GenerateContentResponse.from_iterator(
+            _client(self.client_pool, self.api_key).stream_generate_content(
+                request, timeout=self.client_pool.config.timeout
+            )
+        )
+
+    def fetch_stream(self, messages: tuple[types.TupleMessage, ...]) -> Iterator[str | types.Usage]:
+        """fetch API のストリーミング版
+        文字列の差分を順に返し、最後に types.Usage を返す
+        最後まで受け取った場合はキャッシュに保存する
+        途中で close した場合もそこまでの料金を fee に加算する
+
+        Parameters
+        ----------
+        messages
+        """
+        with ledger.track(
+            self.usage_ledger, "gemini", self.model, self.tags, bind_record=False
+        ) as record:
+            key = cache.make_key("gemini", self.model, messages, None)
+            value = self.response_cache.get(key)
+            if value is not None:
+                response = _load_response(value)
+                self._record_usage(record, messages, response)
+                yield response.text
+                yield types.Usage(
+                    response.usage_metadata.prompt_token_count,
+                    response.usage_metadata.candidates_token_count,
+                )
+                return
+
+            logger.logger.debug("don't use cache")
+            request = _request(
+                self.model,
+                tuple2message(
+                    messages, _uploader(self.upload_registry, self.client_pool, self.api_key)
+                ),
+                None,
+            )
+            start = time.perf_counter()
+            with ledger.bind(record):
+                response = self.scheduler.run(
+                    self.api_key,
+                    self.model,
+                    tokens.estimate_message_tokens(messages),
+                    lambda: self._stream(request),
+                )
+            texts: list[str] = []
+            completed = False
+            try:
+                for chunk in response:
+                    text = _chunk_text(chunk)
+                    if text:
+                        if record.time_to_first_token is None:
+                            record.time_to_first_token = time.perf_counter() - start
+                        texts.append(text)
+                        yield text
+                completed = True
+            finally:
+                usage = _stream_usage(messages, response, "".join(texts))
+                self._record_stream_usage(record, messages, usage)
+
+            if completed:
+                self.response_cache.set(key, _dump_response(response))
+            yield usage
+
+    async def fetch_stream_async(
+        self, messages: tuple[types.TupleMessage, ...]
+    ) -> AsyncIterator[str | types.Usage]:
+        """fetch_stream の非同期版
+
+        Parameters
+        ----------
+        messages
+        """
+        with ledger.track(
+            self.usage_ledger, "gemini", self.model, self.tags, bind_record=False
+        ) as record:
+            key = cache.make_key("gemini", self.model, messages, None)
+            value = await asyncio.to_thread(self.response_cache.get, key)
+            if value is not None:
+                response = _load_response(value)
+                await asyncio.to_thread(self._record_usage, record, messages, response)
+                yield response.text
+                yield types.Usage(
+                    response.usage_metadata.prompt_token_count,
+                    response.usage_metadata.candidates_token_count,
+                )
+                return
+
+            logger.logger.debug("don't use cache")
+            contents = await asyncio.to_thread(
+                tuple2message,
+                messages,
+                _uploader(self.upload_registry, self.client_pool, self.api_key),
+            )
+            request = _request(self.model, contents, None)
+            start = time.perf_counter()
+            # fetch_async と同じく同期のクライアントを別スレッドで呼び、チャンクも別スレッドで受け取る
+            with ledger.bind(record):
+                response = await self.scheduler.run_async(
+                    self.api_key,
+                    self.model,
+                    tokens.estimate_message_tokens(messages),
+                    lambda: asyncio.to_thread(self._stream, request),
+                )
+            chunks = iter(response)
+            texts: list[str] = []
+            completed = False
+            try:
+                while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                    text = _chunk_text(chunk)
+                    if text:
+                        if record.time_to_first_token is None:
+                            record.time_to_first_token = time.perf_counter() - start
+                        texts.append(text)
+                        yield text
+                completed = True
+            finally:
+                usage = _stream_usage(messages, response, "".join(texts))
+                await asyncio.to_thread(self._record_stream_usage, record, messages, usage)
+
+            if completed:
+                await asyncio.to_thread(self.response_cache.set, key, _dump_response(response))
+            yield usage
+
+    def _record_usage(
         self,
+        record: ledger.UsageRecord,
         messages: tuple[types.TupleMessage, ...],
         response: google.generativeai.types.GenerateContentResponse,
     ):
-        """料金を計算する
+        """料金を fee に加算し、呼び出しの記録にトークン数・添付ファイルの秒数・料金を書き込む
 
         Parameters
         ----------
+        record
         messages
         response
         """
+        fee = self.calc_fee(messages, response)
+        audio_seconds, _, video_seconds = _attachments(messages)
+        record.prompt_tokens = response.usage_metadata.prompt_token_count
+        record.completion_tokens = response.usage_metadata.candidates_token_count
+        record.audio_tokens = round(audio_seconds * AUDIO_TOKENS_PER_SECOND)
+        record.media_seconds = audio_seconds + video_seconds
+        record.cost = 0.0 if record.cache_hit else fee
+
+    def _record_stream_usage(
+        self,
+        record: ledger.UsageRecord,
+        messages: tuple[types.TupleMessage, ...],
+        usage: types.Usage,
+    ):
+        """ストリーミングの料金を fee に加算し、呼び出しの記録に書き込む
+
+        Parameters
+        ----------
+        record
+        messages
+        usage
+        """
+        audio_seconds, _, video_seconds = _attachments(messages)
+        record.prompt_tokens = usage.prompt_tokens
+        record.completion_tokens = usage.completion_tokens
+        record.audio_tokens = round(audio_seconds * AUDIO_TOKENS_PER_SECOND)
+        record.media_seconds = audio_seconds + video_seconds
+        record.cost = self._add_fee(messages, usage.prompt_tokens, usage.completion_tokens)
+
+    def calc_fee(
+        self,
+        messages: tuple[types.TupleMessage, ...],
+        response: google.generativeai.types.GenerateContentResponse,
+    ) -> float:
+        """料金を計算して fee に加算し、加算した料金を返す
+
+        Parameters
+        ----------
+        messages
+        response
+        """
+        return self._add_fee(
+            messages,
+            response.usage_metadata.prompt_token_count,
+            response.usage_metadata.candidates_token_count,
+        )
+
+    def _add_fee(
+        self, messages: tuple[types.TupleMessage, ...], prompt_tokens: int, completion_tokens: int
+    ) -> float:
+        """トークン数と添付ファイルから料金を計算して fee に加算し、加算した料金を返す
+
+        Parameters
+        ----------
+        messages
+        prompt_tokens
+        completion_tokens
+        """
         if self.model.startswith("gemini-1.5-flash"):
             input_token_price = 0.00001875 / 1_000
             output_token_price = 0.000075 / 1_000
@@ -201,27 +933,10 @@ class Gemini:
             image_price = 0
             video_price = 0
 
-        for message in messages:
-            if message.role != "user" or isinstance(message.content, str):
-                continue
-            for content in message.content:
-                if content.type == "text":
-                    continue
-                file_type, _ = mimetypes.guess_type(content.content)
-                if file_type is None:
-                    continue
-                if file_type.startswith("audio/"):
-                    self.fee += (
-                        audio_price * pydub.AudioSegment.from_file(content.content).duration_seconds
-                    )
-                elif file_type.startswith("image/"):
-                    self.fee += image_price
-                elif file_type.startswith("video/"):
-                    self.fee += (
-                        video_price * pydub.AudioSegment.from_file(content.content).duration_seconds
-                    )
-
-        self.fee += (
-            response.usage_metadata.prompt_token_count * input_token_price
-            + response.usage_metadata.candidates_token_count * output_token_price
-        )
+        audio_seconds, images, video_seconds = _attachments(messages)
+        fee = audio_price * audio_seconds + image_price * images + video_price * video_seconds
+        fee += prompt_tokens * input_token_price + completion_tokens * output_token_price
+        # 並行して呼ばれても加算が失われないようにロックする
+        with self._fee_lock:
+            self.fee += fee
+        return fee
@@ -0,0 +1,369 @@
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Iterator
+
+# 環境変数でパスを指定すると、標準の Ledger が記録を保存する (.jsonl なら JSONL、それ以外は SQLite)
+LEDGER_PATH = os.environ.get("LLM_CLIENTS_LEDGER")
+
+
+# キャッシュから返した呼び出しは、トークン数はレスポンスのものを入れ、cost は 0 にする
+@dataclasses.dataclass
+class UsageRecord:
+    provider: str
+    model: str
+    cache_hit: bool = True
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    audio_tokens: int = 0
+    media_seconds: float = 0.0
+    latency: float = 0.0
+    time_to_first_token: float | None = None
+    retries: int = 0
+    cost: float = 0.0
+    error: str | None = None
+    tags: dict[str, str] = dataclasses.field(default_factory=dict)
+    created_at: float = dataclasses.field(default_factory=time.time)
+
+
+@dataclasses.dataclass
+class UsageSummary:
+    calls: int = 0
+    cache_hits: int = 0
+    errors: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    audio_tokens: int = 0
+    media_seconds: float = 0.0
+    latency: float = 0.0
+    retries: int = 0
+    cost: float = 0.0
+
+    def add(self, record: UsageRecord) -> None:
+        """記録を集計に加える
+
+        Parameters
+        ----------
+        record
+        """
+        self.calls += 1
+        self.cache_hits += record.cache_hit
+        self.errors += record.error is not None
+        self.prompt_tokens += record.prompt_tokens
+        self.completion_tokens += record.completion_tokens
+        self.audio_tokens += record.audio_tokens
+        self.media_seconds += record.media_seconds
+        self.latency += record.latency
+        self.retries += record.retries
+        self.cost += record.cost
+
+
+_current: contextvars.ContextVar[UsageRecord | None] = contextvars.ContextVar(
+    "llm_clients_usage_record", default=None
+)
+_tags: contextvars.ContextVar[dict[str, str]] = contextvars.ContextVar(
+    "llm_clients_usage_tags", default={}
+)
+
+
+def current() -> UsageRecord | None:
+    """実行中の呼び出しの記録を返す リトライの回数などを下の層から書き込むのに使う"""
+    return _current.get()
+
+
+def current_tags() -> dict[str, str]:
+    """tags() でつけているタグを返す"""
+    return dict(_tags.get())
+
+
+@contextlib.contextmanager
+def bind(record: UsageRecord) -> Iterator[UsageRecord]:
+    """with の中で current() が record を返すようにする
+
+    Parameters
+    ----------
+    record
+    """
+    token = _current.set(record)
+    try:
+        yield record
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def tags(**values: str) -> Iterator[None]:
+    """with の中の呼び出しの記録にタグをつける 入れ子にした場合は外側のタグも引き継ぐ
+
+    Parameters
+    ----------
+    values
+        content_id や処理の段階など
+    """
+    token = _tags.set({**_tags.get(), **values})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def _escape(value: str) -> str:
+    """Prometheus のラベルの値をエスケープする
+
+    Parameters
+    ----------
+    value
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Ledger:
+    """呼び出しごとの使用量・レイテンシ・料金を記録する
+    記録はスレッドセーフに追加され、path を指定すると JSONL か SQLite に保存される
+
+    Attributes
+    ----------
+    path
+    labels
+        Prometheus の出力でラベルにするタグ
+    """
+
+    def __init__(
+        self,
+        path: str | None = None,
+        labels: tuple[str, ...] = (),
+        max_records: int | None = 100_000,
+    ) -> None:
+        """init
+
+        Parameters
+        ----------
+        path
+            保存先 .jsonl なら JSONL、それ以外は SQLite None の場合は保存しない
+        labels
+        max_records
+            メモリに残す記録の件数 None の場合は全て残す
+            summary はこの範囲で集計し、Prometheus の値は件数によらず累積する
+        """
+        self.path = path
+        self.labels = labels
+        self._records: collections.deque[UsageRecord] = collections.deque(maxlen=max_records)
+        self._totals: dict[tuple[str, ...], UsageSummary] = {}
+        self._first_token: dict[tuple[str, ...], tuple[int, float]] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            if not self._jsonl:
+                self._connect().execute(
+                    "CREATE TABLE IF NOT EXISTS usage ("
+                    "created_at REAL NOT NULL, record TEXT NOT NULL)"
+                )
+
+    @property
+    def _jsonl(self) -> bool:
+        """JSONL に保存するかどうか"""
+        return self.path is not None and self.path.endswith(".jsonl")
+
+    def _connect(self) -> sqlite3.Connection:
+        """スレッド・プロセスごとのコネクションを返す"""
+        pid, conn = getattr(self._local, "conn", (None, None))
+        if conn is None or pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)  # pyright: ignore
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = (os.getpid(), conn)
+        return conn
+
+    def record(self, record: UsageRecord) -> None:
+        """記録を追加する
+
+        Parameters
+        ----------
+        record
+        """
+        key = (
+            record.provider,
+            record.model,
+            "hit" if record.cache_hit else "miss",
+            *(record.tags.get(label, "") for label in self.labels),
+        )
+        with self._lock:
+            self._records.append(record)
+            self._totals.setdefault(key, UsageSummary()).add(record)
+            if record.time_to_first_token is not None:
+                count, total = self._first_token.get(key, (0, 0.0))
+                self._first_token[key] = (count + 1, total + record.time_to_first_token)
+
+        if self.path is None:
+            return
+        line = json.dumps(dataclasses.asdict(record), ensure_ascii=False)
+        if self._jsonl:
+            # 追記モードの1回の書き込みなので、他のプロセスと行が混ざらない
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+        else:
+            self._connect().execute(
+                "INSERT INTO usage (created_at, record) VALUES (?, ?)", (record.created_at, line)
+            )
+
+    def records(self) -> list[UsageRecord]:
+        """メモリに残っている記録を返す"""
+        with self._lock:
+            return list(self._records)
+
+    @classmethod
+    def load(cls, path: str, labels: tuple[str, ...] = ()) -> "Ledger":
+        """保存された記録を読み込んだ Ledger を返す 返した Ledger は保存しない
+
+        Parameters
+        ----------
+        path
+        labels
+        """
+        ledger = cls(labels=labels, max_records=None)
+        if path.endswith(".jsonl"):
+            with open(path) as f:
+                lines = [line for line in f if line.strip()]
+        else:
+            with contextlib.closing(sqlite3.connect(path)) as conn:
+                lines = [r[0] for r in conn.execute("SELECT record FROM usage ORDER BY created_at")]
+        for line in lines:
+            ledger.record(UsageRecord(**json.loads(line)))
+        return ledger
+
+    def summary(self, by: str | None = None) -> dict[str, UsageSummary]:
+        """タグの値ごとに集計する
+
+        Parameters
+        ----------
+        by
+            集計に使うタグ None の場合は全体を "" に集計する タグがない記録も "" に入る
+        """
+        ret: dict[str, UsageSummary] = {}
+        for record in self.records():
+            key = record.tags.get(by, "") if by is not None else ""
+            ret.setdefault(key, UsageSummary()).add(record)
+        return ret
+
+    def to_prometheus(self) -> str:
+        """累積の値を Prometheus のテキスト形式で返す"""
+        with self._lock:
+            totals = dict(self._totals)
+            first_token = dict(self._first_token)
+
+        names = ("provider", "model", "cache", *self.labels)
+
+        def labels(key: tuple[str, ...], **extra: str) -> str:
+            pairs = [*zip(names, key), *extra.items()]
+            return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+        metrics: list[tuple[str, str, str, list[str]]] = [
+            ("llm_clients_requests_total", "counter", "Number of calls", []),
+            ("llm_clients_errors_total", "counter", "Number of failed calls", []),
+            ("llm_clients_tokens_total", "counter", "Number of tokens", []),
+            ("llm_clients_media_seconds_total", "counter", "Seconds of attached media", []),
+            ("llm_clients_retries_total", "counter", "Number of retries", []),
+            ("llm_clients_cost_usd_total", "counter", "Cost in USD", []),
+            ("llm_clients_latency_seconds", "summary", "Wall latency of calls", []),
+            ("llm_clients_time_to_first_token_seconds", "summary", "Time to first token", []),
+        ]
+        samples = {name: lines for name, _, _, lines in metrics}
+        for key, total in sorted(totals.items()):
+            samples["llm_clients_requests_total"].append(f"{labels(key)} {total.calls}")
+            samples["llm_clients_errors_total"].append(f"{labels(key)} {total.errors}")
+            for kind, value in (
+                ("prompt", total.prompt_tokens),
+                ("completion", total.completion_tokens),
+                ("audio", total.audio_tokens),
+            ):
+                samples["llm_clients_tokens_total"].append(f"{labels(key, kind=kind)} {value}")
+            samples["llm_clients_media_seconds_total"].append(
+                f"{labels(key)} {total.media_seconds}"
+            )
+            samples["llm_clients_retries_total"].append(f"{labels(key)} {total.retries}")
+            samples["llm_clients_cost_usd_total"].append(f"{labels(key)} {total.cost}")
+            samples["llm_clients_latency_seconds"] += [
+                f"_sum{labels(key)} {total.latency}",
+                f"_count{labels(key)} {total.calls}",
+            ]
+            if key in first_token:
+                count, seconds = first_token[key]
+                samples["llm_clients_time_to_first_token_seconds"] += [
+                    f"_sum{labels(key)} {seconds}",
+                    f"_count{labels(key)} {count}",
+                ]
+
+        lines: list[str] = []
+        for name, metric_type, help_text, metric_lines in metrics:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+            lines += [f"{name}{line}" for line in metric_lines]
+        return "\n".join(lines) + "\n"
+
+
+_default_ledger: Ledger | None = None
+_default_ledger_lock = threading.Lock()
+
+
+def default_ledger() -> Ledger:
+    """クライアントが標準で使う Ledger を返す 初回呼び出し時に作られる"""
+    global _default_ledger
+    with _default_ledger_lock:
+        if _default_ledger is None:
+            _default_ledger = Ledger(LEDGER_PATH)
+        return _default_ledger
+
+
+def set_default_ledger(ledger: Ledger) -> None:
+    """クライアントが標準で使う Ledger を差し替える
+
+    Parameters
+    ----------
+    ledger
+    """
+    global _default_ledger
+    with _default_ledger_lock:
+        _default_ledger = ledger
+
+
+@contextlib.contextmanager
+def track(
+    ledger: Ledger,
+    provider: str,
+    model: str,
+    extra_tags: dict[str, str] | None = None,
+    bind_record: bool = True,
+) -> Iterator[UsageRecord]:
+    """with の中の1回の呼び出しを記録する 抜けるときにレイテンシを入れて ledger に追加する
+
+    Parameters
+    ----------
+    ledger
+    provider
+    model
+    extra_tags
+        tags() のタグに加えるタグ
+    bind_record
+        with の中で current() が記録を返すようにするかどうか
+        ジェネレーターの中で使う場合は呼び出し元に漏れないように False にして、必要な所だけ bind する
+    """
+    record = UsageRecord(provider=provider, model=model, tags={**_tags.get(), **(extra_tags or {})})
+    start = time.perf_counter()
+    try:
+        if bind_record:
+            with bind(record):
+                yield record
+        else:
+            yield record
+    except Exception as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.latency = time.perf_counter() - start
+        ledger.record(record)
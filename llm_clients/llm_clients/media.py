@@ -0,0 +1,405 @@
+import json
+import os
+import struct
+import subprocess
+import threading
+from collections.abc import Callable, Iterator
+from typing import BinaryIO, NamedTuple
+
+from llm_clients import audio_store, logger
+
+
+class MediaInfo(NamedTuple):
+    duration: float
+    sample_rate: int | None
+    channels: int | None
+
+
+# MPEG のバージョンごとのサンプリング周波数
+_MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+# (MPEG1 かどうか, レイヤー) ごとのビットレート (kbps)
+_MP3_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+
+def _probe_wav(f: BinaryIO, size: int) -> MediaInfo | None:
+    """WAV (RIFF, RF64) のヘッダーを読む
+
+    Parameters
+    ----------
+    f
+    size
+        ファイルのバイト数
+    """
+    header = f.read(12)
+    if len(header) < 12 or header[:4] not in (b"RIFF", b"RF64") or header[8:12] != b"WAVE":
+        return None
+
+    channels = sample_rate = byte_rate = None
+    ds64_data_size = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, chunk_size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if chunk_id == b"ds64":
+            # RF64 では 4GB を超えるサイズを ds64 チャンクに持つ
+            ds64_data_size = struct.unpack("<Q", f.read(16)[8:16])[0]
+            f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+        elif chunk_id == b"fmt ":
+            fmt = f.read(chunk_size + chunk_size % 2)
+            channels, sample_rate, byte_rate = struct.unpack("<HII", fmt[2:12])
+        elif chunk_id == b"data":
+            if not byte_rate:
+                return None
+            if chunk_size == 0xFFFFFFFF and ds64_data_size is not None:
+                chunk_size = ds64_data_size
+            # 書き込み途中などでヘッダーのサイズが実際より大きい場合はファイルの末尾までとする
+            data_size = min(chunk_size, size - f.tell())
+            return MediaInfo(data_size / byte_rate, sample_rate, channels)
+        else:
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def _skip_id3(f: BinaryIO) -> int:
+    """先頭の ID3v2 タグを読み飛ばして音声の開始位置を返す
+
+    Parameters
+    ----------
+    f
+    """
+    header = f.read(10)
+    offset = 0
+    if len(header) == 10 and header[:3] == b"ID3":
+        # サイズは各バイトの下位7ビットを使う syncsafe integer
+        tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        offset = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+    f.seek(offset)
+    return offset
+
+
+def _probe_flac(f: BinaryIO, size: int) -> MediaInfo | None:
+    """FLAC の STREAMINFO を読む
+
+    Parameters
+    ----------
+    f
+    size
+        ファイルのバイト数
+    """
+    _skip_id3(f)
+    if f.read(4) != b"fLaC":
+        return None
+    block_header = f.read(4)
+    # 最初のメタデータブロックは必ず STREAMINFO
+    if len(block_header) < 4 or block_header[0] & 0x7F != 0:
+        return None
+    info = f.read(34)
+    if len(info) < 34:
+        return None
+    value = int.from_bytes(info[10:18], "big")
+    sample_rate = value >> 44
+    channels = ((value >> 41) & 0x7) + 1
+    total_samples = value & 0xFFFFFFFFF
+    if sample_rate == 0 or total_samples == 0:
+        return None
+    return MediaInfo(total_samples / sample_rate, sample_rate, channels)
+
+
+def _probe_mp3(f: BinaryIO, size: int) -> MediaInfo | None:
+    """MP3 の最初のフレームのヘッダーと Xing・VBRI ヘッダーを読む
+    どちらもない場合は固定ビットレートとしてファイルサイズから求める
+
+    Parameters
+    ----------
+    f
+    size
+        ファイルのバイト数
+    """
+    start = _skip_id3(f)
+    # ID3 のあとに詰め物があることがあるので、先頭の少しの範囲でフレームの同期を探す
+    buffer = f.read(64 * 1024)
+    for i in range(len(buffer) - 4):
+        if buffer[i] != 0xFF or buffer[i + 1] & 0xE0 != 0xE0:
+            continue
+        version = (buffer[i + 1] >> 3) & 0x3
+        layer = 4 - ((buffer[i + 1] >> 1) & 0x3)
+        bitrate_index = buffer[i + 2] >> 4
+        sample_rate_index = (buffer[i + 2] >> 2) & 0x3
+        if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            continue
+        break
+    else:
+        return None
+
+    mpeg1 = version == 3
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    channels = 1 if buffer[i + 3] >> 6 == 3 else 2
+    if layer == 1:
+        samples_per_frame = 384
+    elif layer == 2 or mpeg1:
+        samples_per_frame = 1152
+    else:
+        samples_per_frame = 576
+
+    # 可変ビットレートの場合は Xing (Info) か VBRI ヘッダーにフレーム数がある
+    side_info_size = (32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9)
+    xing = buffer[i + 4 + side_info_size : i + 4 + side_info_size + 12]
+    frames = None
+    if xing[:4] in (b"Xing", b"Info") and struct.unpack(">I", xing[4:8])[0] & 0x1:
+        frames = struct.unpack(">I", xing[8:12])[0]
+    elif buffer[i + 36 : i + 40] == b"VBRI":
+        frames = struct.unpack(">I", buffer[i + 50 : i + 54])[0]
+    if frames:
+        return MediaInfo(frames * samples_per_frame / sample_rate, sample_rate, channels)
+
+    audio_size = size - start - i
+    f.seek(-128, os.SEEK_END)
+    if f.read(3) == b"TAG":
+        audio_size -= 128
+    return MediaInfo(audio_size * 8 / bitrate, sample_rate, channels)
+
+
+def _mp4_atoms(
+    data: bytes, start: int = 0, end: int | None = None
+) -> Iterator[tuple[bytes, int, int]]:
+    """MP4 のボックスを (種類, 中身の開始位置, 終了位置) で順に返す
+
+    Parameters
+    ----------
+    data
+    start
+    end
+    """
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        atom_size, atom_type = struct.unpack(">I4s", data[start : start + 8])
+        header_size = 8
+        if atom_size == 1:
+            atom_size = struct.unpack(">Q", data[start + 8 : start + 16])[0]
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = end - start
+        if atom_size < header_size:
+            return
+        yield atom_type, start + header_size, min(start + atom_size, end)
+        start += atom_size
+
+
+def _probe_mp4(f: BinaryIO, size: int) -> MediaInfo | None:
+    """MP4 (m4a, mov) の moov ボックスから長さと音声トラックの情報を読む
+    mdat は読まずに飛ばす
+
+    Parameters
+    ----------
+    f
+    size
+        ファイルのバイト数
+    """
+    header = f.read(8)
+    if len(header) < 8 or header[4:8] not in (b"ftyp", b"moov", b"mdat", b"wide", b"free"):
+        return None
+
+    offset = 0
+    moov = None
+    while offset + 8 <= size:
+        f.seek(offset)
+        atom_header = f.read(16)
+        atom_size, atom_type = struct.unpack(">I4s", atom_header[:8])
+        header_size = 8
+        if atom_size == 1:
+            atom_size = struct.unpack(">Q", atom_header[8:16])[0]
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = size - offset
+        if atom_size < header_size:
+            return None
+        if atom_type == b"moov":
+            f.seek(offset + header_size)
+            moov = f.read(atom_size - header_size)
+            break
+        offset += atom_size
+    if moov is None:
+        return None
+
+    duration = None
+    sample_rate = channels = None
+    for atom_type, start, end in _mp4_atoms(moov):
+        if atom_type == b"mvhd":
+            if moov[start] == 1:
+                timescale, length = struct.unpack(">IQ", moov[start + 20 : start + 32])
+            else:
+                timescale, length = struct.unpack(">II", moov[start + 12 : start + 20])
+            if timescale:
+                duration = length / timescale
+        elif atom_type == b"trak" and sample_rate is None:
+            sample_rate, channels = _mp4_audio_entry(moov, start, end)
+    if duration is None:
+        return None
+    return MediaInfo(duration, sample_rate, channels)
+
+
+def _mp4_audio_entry(data: bytes, start: int, end: int) -> tuple[int | None, int | None]:
+    """trak ボックスが音声トラックならサンプリング周波数とチャンネル数を返す
+
+    Parameters
+    ----------
+    data
+    start
+        trak の中身の開始位置
+    end
+    """
+
+    def find(path: tuple[bytes, ...], start: int, end: int) -> tuple[int, int] | None:
+        for atom_type, child_start, child_end in _mp4_atoms(data, start, end):
+            if atom_type == path[0]:
+                return (
+                    (child_start, child_end)
+                    if len(path) == 1
+                    else find(path[1:], child_start, child_end)
+                )
+        return None
+
+    hdlr = find((b"mdia", b"hdlr"), start, end)
+    if hdlr is None or data[hdlr[0] + 8 : hdlr[0] + 12] != b"soun":
+        return None, None
+    stsd = find((b"mdia", b"minf", b"stbl", b"stsd"), start, end)
+    if stsd is None:
+        return None, None
+    # stsd の中身は version/flags, エントリ数のあとに最初のサンプルエントリが続く
+    entry = stsd[0] + 8
+    channels, _, _, _, sample_rate = struct.unpack(">HHHHI", data[entry + 24 : entry + 36])
+    return sample_rate >> 16, channels
+
+
+def _probe_ffprobe(path: str) -> MediaInfo | None:
+    """ヘッダーを読めない形式を ffprobe で調べる ffprobe もデコードはしない
+
+    Parameters
+    ----------
+    path
+    """
+    try:
+        output = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration:stream=codec_type,sample_rate,channels",
+                "-of",
+                "json",
+                path,
+            ],
+            check=True,
+            capture_output=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    result = json.loads(output)
+    if "duration" not in result.get("format", {}):
+        return None
+    audio = next((s for s in result.get("streams", []) if s.get("codec_type") == "audio"), {})
+    return MediaInfo(
+        float(result["format"]["duration"]),
+        int(audio["sample_rate"]) if "sample_rate" in audio else None,
+        audio.get("channels"),
+    )
+
+
+_PROBES: dict[str, Callable[[BinaryIO, int], MediaInfo | None]] = {
+    ".wav": _probe_wav,
+    ".flac": _probe_flac,
+    ".mp3": _probe_mp3,
+    ".mp4": _probe_mp4,
+    ".m4a": _probe_mp4,
+    ".mov": _probe_mp4,
+}
+
+_infos: dict[tuple[str, int, int], MediaInfo] = {}
+_infos_lock = threading.Lock()
+
+
+def _probe(path: str) -> MediaInfo:
+    """ヘッダー、ffprobe、デコードの順に試して長さを調べる
+
+    Parameters
+    ----------
+    path
+    """
+    size = os.path.getsize(path)
+    probe_header = _PROBES.get(os.path.splitext(path)[1].lower())
+    # 拡張子に合う形式を先に試し、だめならマジックナンバーで判定できる形式を試す
+    # MP3 はマジックナンバーがなく誤判定しやすいので拡張子が合う場合だけ試す
+    probes = [probe_header] if probe_header is not None else []
+    probes += [p for p in (_probe_wav, _probe_flac, _probe_mp4) if p is not probe_header]
+    with open(path, "rb") as f:
+        for probe_header in probes:
+            f.seek(0)
+            try:
+                info = probe_header(f, size)
+            except (struct.error, IndexError, ValueError, OSError):
+                info = None
+            if info is not None:
+                return info
+
+    info = _probe_ffprobe(path)
+    if info is not None:
+        return info
+
+    logger.logger.warning(f"decode {path} to get the duration")
+    try:
+        # デコード結果は保存されるので、Whisper など他の処理でも使い回される
+        return MediaInfo(audio_store.default_store().duration(path), None, None)
+    except ImportError:
+        pass
+    # audio_store を使えない場合は pydub でデコードする どちらも whisper の extras に入っている
+    try:
+        import pydub
+    except ImportError:
+        raise ImportError(
+            f"cannot read the duration of {path} from its header or ffprobe, "
+            "install llm_clients[whisper] to decode it"
+        ) from None
+    audio: pydub.AudioSegment = pydub.AudioSegment.from_file(path)
+    return MediaInfo(audio.duration_seconds, audio.frame_rate, audio.channels)
+
+
+def probe(path: str) -> MediaInfo:
+    """音声・動画ファイルの長さ、サンプリング周波数、チャンネル数をデコードせずに返す
+    パス・更新時刻・サイズが変わらない間は結果を使い回す
+
+    Parameters
+    ----------
+    path
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _infos_lock:
+        info = _infos.get(memo_key)
+    if info is None:
+        info = _probe(path)
+        with _infos_lock:
+            _infos[memo_key] = info
+    return info
+
+
+def duration(path: str) -> float:
+    """音声・動画ファイルの秒数を返す
+
+    Parameters
+    ----------
+    path
+    """
+    return probe(path).duration
@@ -1,11 +1,19 @@
+import asyncio
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
 from typing import overload
 
+import httpx
 import openai
 import openai.types.chat
 import pydantic
-import streamlit
 
-from llm_clients import logger, types
+from llm_clients import cache, ledger, logger, pool, ratelimit, singleflight, tokens, types
+
+
+# Batch API の料金は通常の半額
+BATCH_PRICE_RATE = 0.5
 
 
 def tuple2message(
@@ -67,9 +75,196 @@ def tuple2message(
     return messages
 
 
+def _limits(config: pool.PoolConfig) -> httpx.Limits:
+    """コネクションプールの上限を httpx の形式で返す
+
+    Parameters
+    ----------
+    config
+    """
+    return httpx.Limits(
+        max_connections=config.max_connections,
+        max_keepalive_connections=config.max_keepalive_connections,
+        keepalive_expiry=config.keepalive_expiry,
+    )
+
+
+def _make_client(api_key: str, config: pool.PoolConfig) -> openai.OpenAI:
+    """コネクションを使い回すクライアントを作る
+    リトライは ratelimit.Scheduler が行うので、SDK ではやり直さない
+
+    Parameters
+    ----------
+    api_key
+    config
+    """
+    return openai.OpenAI(
+        api_key=api_key,
+        timeout=config.timeout,
+        max_retries=0,
+        http_client=openai.DefaultHttpxClient(limits=_limits(config)),
+    )
+
+
+def _make_async_client(api_key: str, config: pool.PoolConfig) -> openai.AsyncOpenAI:
+    """コネクションを使い回す非同期クライアントを作る
+    リトライは ratelimit.Scheduler が行うので、SDK ではやり直さない
+
+    Parameters
+    ----------
+    api_key
+    config
+    """
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        timeout=config.timeout,
+        max_retries=0,
+        http_client=openai.DefaultAsyncHttpxClient(limits=_limits(config)),
+    )
+
+
+def _fetch[
+    T: type[pydantic.BaseModel]
+](
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: T | None,
+    client_pool: pool.ClientPool,
+) -> (openai.types.chat.ParsedChatCompletion[T] | openai.types.chat.ChatCompletion):
+    """fetch API
+
+    Parameters
+    ----------
+    api_key
+    model
+    messages
+    response_format
+    client_pool
+    """
+    client = client_pool.get("openai", api_key, "", lambda config: _make_client(api_key, config))
+
+    if response_format is not None:
+        return client.beta.chat.completions.parse(
+            model=model, messages=tuple2message(messages), response_format=response_format
+        )
+    else:
+        return client.chat.completions.create(model=model, messages=tuple2message(messages))
+
+
+async def _fetch_async[
+    T: type[pydantic.BaseModel]
+](
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: T | None,
+    client_pool: pool.ClientPool,
+) -> (openai.types.chat.ParsedChatCompletion[T] | openai.types.chat.ChatCompletion):
+    """fetch API の非同期版
+
+    Parameters
+    ----------
+    api_key
+    model
+    messages
+    response_format
+    client_pool
+    """
+    client = client_pool.get_async(
+        "openai", api_key, "", lambda config: _make_async_client(api_key, config)
+    )
+
+    if response_format is not None:
+        return await client.beta.chat.completions.parse(
+            model=model, messages=tuple2message(messages), response_format=response_format
+        )
+    else:
+        return await client.chat.completions.create(model=model, messages=tuple2message(messages))
+
+
+def _response_type(
+    response_format: type[pydantic.BaseModel] | None,
+) -> type[openai.types.chat.ChatCompletion]:
+    """キャッシュから復元するときのレスポンスの型を返す
+
+    Parameters
+    ----------
+    response_format
+    """
+    if response_format is not None:
+        return openai.types.chat.ParsedChatCompletion[response_format]
+    else:
+        return openai.types.chat.ChatCompletion
+
+
+def _stream_completion(
+    chunk: openai.types.chat.ChatCompletionChunk, text: str, usage: types.Usage
+) -> openai.types.chat.ChatCompletion:
+    """ストリーミングで受け取った内容を fetch と同じ形式のレスポンスにまとめる
+
+    Parameters
+    ----------
+    chunk
+        最後に受け取ったチャンク
+    text
+        受け取った文字列をつなげたもの
+    usage
+    """
+    return openai.types.chat.ChatCompletion.model_validate(
+        {
+            "id": chunk.id,
+            "object": "chat.completion",
+            "created": chunk.created,
+            "model": chunk.model,
+            "system_fingerprint": chunk.system_fingerprint,
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": text},
+                }
+            ],
+            "usage": {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "total_tokens": usage.prompt_tokens + usage.completion_tokens,
+            },
+        }
+    )
+
+
+def _stream_usage(
+    messages: tuple[types.TupleMessage, ...],
+    chunk: openai.types.chat.ChatCompletionChunk | None,
+    text: str,
+) -> types.Usage:
+    """ストリーミングのトークン数を返す
+    途中で打ち切られて usage を受け取れなかった場合は概算する
+
+    Parameters
+    ----------
+    messages
+    chunk
+        最後に受け取ったチャンク
+    text
+        受け取った文字列をつなげたもの
+    """
+    if chunk is not None and chunk.usage is not None:
+        return types.Usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+    return types.Usage(tokens.estimate_message_tokens(messages), tokens.estimate_tokens(text))
+
+
 @overload
 def _cached_fetch(
-    api_key: str, model: str, messages: tuple[types.TupleMessage, ...], response_format: None
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: None,
+    response_cache: cache.ResponseCache,
+    client_pool: pool.ClientPool,
+    scheduler: ratelimit.Scheduler,
+    single_flight: singleflight.SingleFlight,
 ) -> openai.types.chat.ChatCompletion: ...
 
 
@@ -77,15 +272,28 @@ def _cached_fetch(
 def _cached_fetch[
     T: type[pydantic.BaseModel]
 ](
-    api_key: str, model: str, messages: tuple[types.TupleMessage, ...], response_format: T
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: T,
+    response_cache: cache.ResponseCache,
+    client_pool: pool.ClientPool,
+    scheduler: ratelimit.Scheduler,
+    single_flight: singleflight.SingleFlight,
 ) -> openai.types.chat.ParsedChatCompletion[T]: ...
 
 
-@streamlit.cache_resource(show_spinner=False)
 def _cached_fetch[
     T: type[pydantic.BaseModel]
 ](
-    api_key: str, model: str, messages: tuple[types.TupleMessage, ...], response_format: T | None
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: T | None,
+    response_cache: cache.ResponseCache,
+    client_pool: pool.ClientPool,
+    scheduler: ratelimit.Scheduler,
+    single_flight: singleflight.SingleFlight,
 ) -> (openai.types.chat.ParsedChatCompletion[T] | openai.types.chat.ChatCompletion):
     """fetch API
     キャッシュがある場合はキャッシュを返す
@@ -96,16 +304,99 @@ def _cached_fetch[
     model
     messages
     response_format
+    response_cache
+    client_pool
+    scheduler
+    single_flight
     """
-    logger.logger.debug("don't use cache")
-    client = openai.OpenAI(api_key=api_key)
+    key = cache.make_key("openai", model, messages, response_format)
+    return single_flight.do(
+        key,
+        lambda: cache.cached_call(
+            response_cache,
+            key,
+            lambda: scheduler.run(
+                api_key,
+                model,
+                tokens.estimate_message_tokens(messages),
+                lambda: _fetch(api_key, model, messages, response_format, client_pool),
+            ),
+            lambda response: response.model_dump_json().encode(),
+            _response_type(response_format).model_validate_json,
+        ),
+    )
 
-    if response_format is not None:
-        return client.beta.chat.completions.parse(
-            model=model, messages=tuple2message(messages), response_format=response_format
-        )
-    else:
-        return client.chat.completions.create(model=model, messages=tuple2message(messages))
+
+@overload
+async def _cached_fetch_async(
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: None,
+    response_cache: cache.ResponseCache,
+    client_pool: pool.ClientPool,
+    scheduler: ratelimit.Scheduler,
+    single_flight: singleflight.SingleFlight,
+) -> openai.types.chat.ChatCompletion: ...
+
+
+@overload
+async def _cached_fetch_async[
+    T: type[pydantic.BaseModel]
+](
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: T,
+    response_cache: cache.ResponseCache,
+    client_pool: pool.ClientPool,
+    scheduler: ratelimit.Scheduler,
+    single_flight: singleflight.SingleFlight,
+) -> openai.types.chat.ParsedChatCompletion[T]: ...
+
+
+async def _cached_fetch_async[
+    T: type[pydantic.BaseModel]
+](
+    api_key: str,
+    model: str,
+    messages: tuple[types.TupleMessage, ...],
+    response_format: T | None,
+    response_cache: cache.ResponseCache,
+    client_pool: pool.ClientPool,
+    scheduler: ratelimit.Scheduler,
+    single_flight: singleflight.SingleFlight,
+) -> (openai.types.chat.ParsedChatCompletion[T] | openai.types.chat.ChatCompletion):
+    """fetch API の非同期版
+    キャッシュがある場合はキャッシュを返す
+
+    Parameters
+    ----------
+    api_key
+    model
+    messages
+    response_format
+    response_cache
+    client_pool
+    scheduler
+    single_flight
+    """
+    key = cache.make_key("openai", model, messages, response_format)
+    return await single_flight.do_async(
+        key,
+        lambda: cache.cached_call_async(
+            response_cache,
+            key,
+            lambda: scheduler.run_async(
+                api_key,
+                model,
+                tokens.estimate_message_tokens(messages),
+                lambda: _fetch_async(api_key, model, messages, response_format, client_pool),
+            ),
+            lambda response: response.model_dump_json().encode(),
+            _response_type(response_format).model_validate_json,
+        ),
+    )
 
 
 class OpenAI:
@@ -115,21 +406,70 @@ class OpenAI:
     ----------
     api_key
     model
+    response_cache
+    client_pool
+    scheduler
+    single_flight
+    usage_ledger
+    tags
+        呼び出しの記録につけるタグ
     fee
         LLM実行にかかった料金
     """
 
-    def __init__(self, api_key: str, model: str = "gpt-4o-2024-08-06") -> None:
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "gpt-4o-2024-08-06",
+        response_cache: cache.ResponseCache | None = None,
+        client_pool: pool.ClientPool | None = None,
+        scheduler: ratelimit.Scheduler | None = None,
+        single_flight: singleflight.SingleFlight | None = None,
+        usage_ledger: ledger.Ledger | None = None,
+        tags: dict[str, str] | None = None,
+    ) -> None:
         """init
 
         Parameters
         ----------
         api_key
         model
+        response_cache
+            レスポンスのキャッシュ None の場合は cache.default_cache() を使う
+        client_pool
+            SDK のクライアントの作り置き None の場合は pool.default_pool() を使う
+        scheduler
+            レート制限の管理 None の場合は ratelimit.default_scheduler() を使う
+        single_flight
+            同時に来た同じリクエストをまとめる None の場合は singleflight.default_single_flight() を使う
+        usage_ledger
+            呼び出しごとの使用量の記録 None の場合は ledger.default_ledger() を使う
+        tags
         """
         self.api_key = api_key
         self.model = model
+        self.response_cache = (
+            response_cache if response_cache is not None else cache.default_cache()
+        )
+        self.client_pool = client_pool if client_pool is not None else pool.default_pool()
+        self.scheduler = scheduler if scheduler is not None else ratelimit.default_scheduler()
+        self.single_flight = (
+            single_flight if single_flight is not None else singleflight.default_single_flight()
+        )
+        self.usage_ledger = usage_ledger if usage_ledger is not None else ledger.default_ledger()
+        self.tags = tags if tags is not None else {}
         self.fee = 0.0
+        self._fee_lock = threading.Lock()
+
+    def sdk_client(self) -> openai.OpenAI:
+        """Batch API のファイルの呼び出しなど、ratelimit.Scheduler を通さない呼び出しに使う
+        openai.OpenAI を返す SDK が PoolConfig.max_retries 回までやり直すので、scheduler を通す
+        呼び出しには使わない
+        """
+        client = self.client_pool.get(
+            "openai", self.api_key, "", lambda config: _make_client(self.api_key, config)
+        )
+        return client.with_options(max_retries=self.client_pool.config.max_retries)
 
     @overload
     def fetch(self, messages: tuple[types.TupleMessage, ...], response_format: None) -> str: ...
@@ -157,35 +497,353 @@ class OpenAI:
             指定した場合はJSONモードで実行し、指示したモデルの形状で返す
             None の場合は文字列を返す
         """
-        if response_format is not None:
-            response = _cached_fetch(self.api_key, self.model, messages, response_format)
-            logger.logger.debug(response)
-            self.calc_fee(messages, response)
-            return response.choices[0].message.parsed
-        else:
-            response = _cached_fetch(self.api_key, self.model, messages, response_format)
-            logger.logger.debug(response)
-            self.calc_fee(messages, response)
-            return response.choices[0].message.content
+        with ledger.track(self.usage_ledger, "openai", self.model, self.tags) as record:
+            if response_format is not None:
+                response = _cached_fetch(
+                    self.api_key,
+                    self.model,
+                    messages,
+                    response_format,
+                    self.response_cache,
+                    self.client_pool,
+                    self.scheduler,
+                    self.single_flight,
+                )
+                logger.logger.debug(response)
+                self._record_usage(record, messages, response)
+                return response.choices[0].message.parsed
+            else:
+                response = _cached_fetch(
+                    self.api_key,
+                    self.model,
+                    messages,
+                    response_format,
+                    self.response_cache,
+                    self.client_pool,
+                    self.scheduler,
+                    self.single_flight,
+                )
+                logger.logger.debug(response)
+                self._record_usage(record, messages, response)
+                return response.choices[0].message.content
 
-    def calc_fee(
+    @overload
+    async def fetch_async(
+        self, messages: tuple[types.TupleMessage, ...], response_format: None
+    ) -> str: ...
+
+    @overload
+    async def fetch_async(self, messages: tuple[types.TupleMessage, ...]) -> str: ...
+
+    @overload
+    async def fetch_async[
+        T: type[pydantic.BaseModel]
+    ](self, messages: tuple[types.TupleMessage, ...], response_format: T) -> T | None: ...
+
+    async def fetch_async[
+        T: type[pydantic.BaseModel]
+    ](self, messages: tuple[types.TupleMessage, ...], response_format: T | None = None) -> (
+        str | T | None
+    ):
+        """fetch API の非同期版
+
+        Parameters
+        ----------
+        messages
+        response_format
+            出力の形式を指定したい場合に与える
+            指定した場合はJSONモードで実行し、指示したモデルの形状で返す
+            None の場合は文字列を返す
+        """
+        with ledger.track(self.usage_ledger, "openai", self.model, self.tags) as record:
+            if response_format is not None:
+                response = await _cached_fetch_async(
+                    self.api_key,
+                    self.model,
+                    messages,
+                    response_format,
+                    self.response_cache,
+                    self.client_pool,
+                    self.scheduler,
+                    self.single_flight,
+                )
+                logger.logger.debug(response)
+                self._record_usage(record, messages, response)
+                return response.choices[0].message.parsed
+            else:
+                response = await _cached_fetch_async(
+                    self.api_key,
+                    self.model,
+                    messages,
+                    response_format,
+                    self.response_cache,
+                    self.client_pool,
+                    self.scheduler,
+                    self.single_flight,
+                )
+                logger.logger.debug(response)
+                self._record_usage(record, messages, response)
+                return response.choices[0].message.content
+
+    @overload
+    async def fetch_many(
+        self,
+        messages_list: list[tuple[types.TupleMessage, ...]],
+        response_format: None,
+        max_concurrency: int = 8,
+    ) -> list[str]: ...
+
+    @overload
+    async def fetch_many(
+        self, messages_list: list[tuple[types.TupleMessage, ...]], *, max_concurrency: int = 8
+    ) -> list[str]: ...
+
+    @overload
+    async def fetch_many[
+        T: type[pydantic.BaseModel]
+    ](
+        self,
+        messages_list: list[tuple[types.TupleMessage, ...]],
+        response_format: T,
+        max_concurrency: int = 8,
+    ) -> list[T | None]: ...
+
+    async def fetch_many[
+        T: type[pydantic.BaseModel]
+    ](
+        self,
+        messages_list: list[tuple[types.TupleMessage, ...]],
+        response_format: T | None = None,
+        max_concurrency: int = 8,
+    ) -> (list[str] | list[T | None]):
+        """複数の fetch を並行して実行し、入力と同じ順番で結果を返す
+
+        Parameters
+        ----------
+        messages_list
+        response_format
+            出力の形式を指定したい場合に与える
+        max_concurrency
+            同時に実行するリクエストの上限
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch(messages: tuple[types.TupleMessage, ...]):
+            async with semaphore:
+                return await self.fetch_async(messages, response_format)
+
+        return list(await asyncio.gather(*(fetch(messages) for messages in messages_list)))
+
+    def fetch_stream(self, messages: tuple[types.TupleMessage, ...]) -> Iterator[str | types.Usage]:
+        """fetch API のストリーミング版
+        文字列の差分を順に返し、最後に types.Usage を返す
+        最後まで受け取った場合はキャッシュに保存する
+        途中で close した場合もそこまでの料金を fee に加算する
+
+        Parameters
+        ----------
+        messages
+        """
+        with ledger.track(
+            self.usage_ledger, "openai", self.model, self.tags, bind_record=False
+        ) as record:
+            key = cache.make_key("openai", self.model, messages, None)
+            value = self.response_cache.get(key)
+            if value is not None:
+                response = openai.types.chat.ChatCompletion.model_validate_json(value)
+                self._record_usage(record, messages, response)
+                yield response.choices[0].message.content or ""
+                if response.usage is not None:
+                    yield types.Usage(
+                        response.usage.prompt_tokens, response.usage.completion_tokens
+                    )
+                return
+
+            logger.logger.debug("don't use cache")
+            # やり直しは scheduler に任せるので、SDK がやり直さないクライアントを使う
+            client = self.client_pool.get(
+                "openai", self.api_key, "", lambda config: _make_client(self.api_key, config)
+            )
+            start = time.perf_counter()
+            with ledger.bind(record):
+                stream = self.scheduler.run(
+                    self.api_key,
+                    self.model,
+                    tokens.estimate_message_tokens(messages),
+                    lambda: client.chat.completions.create(
+                        model=self.model,
+                        messages=tuple2message(messages),
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    ),
+                )
+            texts: list[str] = []
+            chunk = None
+            completed = False
+            try:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if record.time_to_first_token is None:
+                            record.time_to_first_token = time.perf_counter() - start
+                        texts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+                completed = True
+            finally:
+                stream.close()
+                usage = _stream_usage(messages, chunk, "".join(texts))
+                self._record_stream_usage(record, messages, usage)
+
+            if completed and chunk is not None:
+                response = _stream_completion(chunk, "".join(texts), usage)
+                self.response_cache.set(key, response.model_dump_json().encode())
+            yield usage
+
+    async def fetch_stream_async(
+        self, messages: tuple[types.TupleMessage, ...]
+    ) -> AsyncIterator[str | types.Usage]:
+        """fetch_stream の非同期版
+
+        Parameters
+        ----------
+        messages
+        """
+        with ledger.track(
+            self.usage_ledger, "openai", self.model, self.tags, bind_record=False
+        ) as record:
+            key = cache.make_key("openai", self.model, messages, None)
+            value = await asyncio.to_thread(self.response_cache.get, key)
+            if value is not None:
+                response = openai.types.chat.ChatCompletion.model_validate_json(value)
+                self._record_usage(record, messages, response)
+                yield response.choices[0].message.content or ""
+                if response.usage is not None:
+                    yield types.Usage(
+                        response.usage.prompt_tokens, response.usage.completion_tokens
+                    )
+                return
+
+            logger.logger.debug("don't use cache")
+            client = self.client_pool.get_async(
+                "openai", self.api_key, "", lambda config: _make_async_client(self.api_key, config)
+            )
+            start = time.perf_counter()
+            with ledger.bind(record):
+                stream = await self.scheduler.run_async(
+                    self.api_key,
+                    self.model,
+                    tokens.estimate_message_tokens(messages),
+                    lambda: client.chat.completions.create(
+                        model=self.model,
+                        messages=tuple2message(messages),
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    ),
+                )
+            texts: list[str] = []
+            chunk = None
+            completed = False
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if record.time_to_first_token is None:
+                            record.time_to_first_token = time.perf_counter() - start
+                        texts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+                completed = True
+            finally:
+                await stream.close()
+                usage = _stream_usage(messages, chunk, "".join(texts))
+                self._record_stream_usage(record, messages, usage)
+
+            if completed and chunk is not None:
+                response = _stream_completion(chunk, "".join(texts), usage)
+                await asyncio.to_thread(
+                    self.response_cache.set, key, response.model_dump_json().encode()
+                )
+            yield usage
+
+    def _record_usage(
         self,
+        record: ledger.UsageRecord,
         messages: tuple[types.TupleMessage, ...],
         response: (
             openai.types.chat.ParsedChatCompletion[pydantic.BaseModel]
             | openai.types.chat.ChatCompletion
         ),
     ):
-        """料金を計算する
+        """料金を fee に加算し、呼び出しの記録にトークン数と料金を書き込む
 
         Parameters
         ----------
+        record
         messages
         response
         """
+        fee = self.calc_fee(messages, response)
+        if response.usage is not None:
+            record.prompt_tokens = response.usage.prompt_tokens
+            record.completion_tokens = response.usage.completion_tokens
+        record.cost = 0.0 if record.cache_hit else fee
+
+    def _record_stream_usage(
+        self,
+        record: ledger.UsageRecord,
+        messages: tuple[types.TupleMessage, ...],
+        usage: types.Usage,
+    ):
+        """ストリーミングの料金を fee に加算し、呼び出しの記録にトークン数と料金を書き込む
+
+        Parameters
+        ----------
+        record
+        messages
+        usage
+        """
+        record.prompt_tokens = usage.prompt_tokens
+        record.completion_tokens = usage.completion_tokens
+        record.cost = self._add_fee(messages, usage.prompt_tokens, usage.completion_tokens)
+
+    def calc_fee(
+        self,
+        messages: tuple[types.TupleMessage, ...],
+        response: (
+            openai.types.chat.ParsedChatCompletion[pydantic.BaseModel]
+            | openai.types.chat.ChatCompletion
+        ),
+        batch: bool = False,
+    ) -> float:
+        """料金を計算して fee に加算し、加算した料金を返す
+
+        Parameters
+        ----------
+        messages
+        response
+        batch
+            Batch API で実行した場合は True 料金が半額になる
+        """
         if response.usage is None:
-            return
+            return 0.0
+        return self._add_fee(
+            messages, response.usage.prompt_tokens, response.usage.completion_tokens, batch
+        )
 
+    def _add_fee(
+        self,
+        messages: tuple[types.TupleMessage, ...],
+        prompt_tokens: int,
+        completion_tokens: int,
+        batch: bool = False,
+    ) -> float:
+        """トークン数から料金を計算して fee に加算し、加算した料金を返す
+
+        Parameters
+        ----------
+        messages
+        prompt_tokens
+        completion_tokens
+        batch
+            Batch API で実行した場合は True 料金が半額になる
+        """
         if self.model == "gpt-4o-2024-08-06":
             input_token_price = 2.5 / 1_000_000
             output_token_price = 10.0 / 1_000_000
@@ -195,15 +853,19 @@ class OpenAI:
             output_token_price = 0
             image_price = 0
 
+        fee = 0.0
         for message in messages:
             if message.role != "user" or isinstance(message.content, str):
                 continue
             for content in message.content:
                 if content.type == "text":
                     continue
-                self.fee += image_price
+                fee += image_price
 
-        self.fee += (
-            response.usage.prompt_tokens * input_token_price
-            + response.usage.completion_tokens * output_token_price
-        )
+        fee += prompt_tokens * input_token_price + completion_tokens * output_token_price
+        if batch:
+            fee *= BATCH_PRICE_RATE
+        # 並行して呼ばれても加算が失われないようにロックする
+        with self._fee_lock:
+            self.fee += fee
+        return fee
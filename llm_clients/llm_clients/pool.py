@@ -0,0 +1,124 @@
+import asyncio
+import dataclasses
+import threading
+import weakref
+from collections.abc import Callable
+from typing import Any
+
+
+# コネクション数と keep-alive の設定は OpenAI の httpx のクライアントにだけ効く
+# Gemini は SDK が gRPC の接続を持つので timeout だけを使う
+# max_retries は Scheduler を通さない呼び出し (OpenAI.sdk_client) で SDK がやり直す回数
+@dataclasses.dataclass(frozen=True)
+class PoolConfig:
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 60.0
+    timeout: float = 600.0
+    max_retries: int = 2
+
+
+class ClientPool:
+    """(provider, api_key, model) ごとに SDK のクライアントを作り置きして使い回す
+    HTTP のコネクションプールや生成設定を呼び出しのたびに作り直さないようにする
+
+    Attributes
+    ----------
+    config
+        コネクション数の上限やタイムアウト
+    """
+
+    def __init__(self, config: PoolConfig | None = None) -> None:
+        """init
+
+        Parameters
+        ----------
+        config
+        """
+        self.config = config if config is not None else PoolConfig()
+        self._clients: dict[tuple[str, str, str], Any] = {}
+        # 非同期クライアントはイベントループに紐づくのでループごとに持つ
+        self._async_clients: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, dict[tuple[str, str, str], Any]
+        ] = weakref.WeakKeyDictionary()
+        # factory の中から別のクライアントを取得できるように RLock にする
+        self._lock = threading.RLock()
+
+    def get[C](
+        self, provider: str, api_key: str, model: str, factory: Callable[[PoolConfig], C]
+    ) -> C:
+        """クライアントを返す なければ factory で作って保持する
+
+        Parameters
+        ----------
+        provider
+        api_key
+        model
+        factory
+            config を受け取ってクライアントを作る関数
+        """
+        key = (provider, api_key, model)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = factory(self.config)
+                self._clients[key] = client
+        return client
+
+    def get_async[C](
+        self, provider: str, api_key: str, model: str, factory: Callable[[PoolConfig], C]
+    ) -> C:
+        """実行中のイベントループ用の非同期クライアントを返す なければ factory で作って保持する
+
+        Parameters
+        ----------
+        provider
+        api_key
+        model
+        factory
+            config を受け取ってクライアントを作る関数
+        """
+        loop = asyncio.get_running_loop()
+        key = (provider, api_key, model)
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(key)
+            if client is None:
+                client = factory(self.config)
+                clients[key] = client
+        return client
+
+    def close(self) -> None:
+        """同期クライアントを閉じて破棄する"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            close = getattr(client, "close", None)
+            if callable(close):
+                close()
+
+
+_default_pool: ClientPool | None = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool() -> ClientPool:
+    """クライアントが標準で使う ClientPool を返す 初回呼び出し時に作られる"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ClientPool()
+        return _default_pool
+
+
+def set_default_pool(client_pool: ClientPool) -> None:
+    """クライアントが標準で使う ClientPool を差し替える
+
+    Parameters
+    ----------
+    client_pool
+    """
+    global _default_pool
+    with _default_pool_lock:
+        _default_pool = client_pool
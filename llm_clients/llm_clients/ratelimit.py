@@ -0,0 +1,447 @@
+import asyncio
+import dataclasses
+import email.utils
+import itertools
+import random
+import threading
+import time
+from collections.abc import Awaitable, Callable
+
+from llm_clients import ledger, logger
+
+# 待っている間に状態が変わることがあるので、これより長くは眠らずに確認し直す
+_POLL_INTERVAL = 1.0
+
+
+@dataclasses.dataclass(frozen=True)
+class RateLimit:
+    requests_per_minute: int | None = None
+    tokens_per_minute: int | None = None
+
+
+@dataclasses.dataclass
+class SchedulerStats:
+    requests: int = 0
+    throttled: int = 0
+    wait_seconds: float = 0.0
+    rate_limited: int = 0
+    retries: int = 0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+
+
+class _Bucket:
+    """トークンバケット capacity まで貯まり、1秒に per_second ずつ回復する
+
+    Attributes
+    ----------
+    capacity
+    per_second
+    level
+        今使える量
+    """
+
+    def __init__(self, capacity: float, per_second: float) -> None:
+        """init
+
+        Parameters
+        ----------
+        capacity
+        per_second
+        """
+        self.capacity = capacity
+        self.per_second = per_second
+        self.level = capacity
+        self._updated_at = time.monotonic()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """amount を使えるようになるまでの秒数を返す
+
+        Parameters
+        ----------
+        amount
+            capacity を超える場合は capacity として扱う
+        now
+        """
+        self.level = min(self.capacity, self.level + (now - self._updated_at) * self.per_second)
+        self._updated_at = now
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.per_second)
+
+    def take(self, amount: float) -> None:
+        """amount を使う
+
+        Parameters
+        ----------
+        amount
+        """
+        self.level -= min(amount, self.capacity)
+
+
+@dataclasses.dataclass
+class _KeyState:
+    requests: _Bucket | None
+    tokens: _Bucket | None
+    blocked_until: float = 0.0
+    # 待っているリクエストの (推定トークン数, 待ち始めた時刻)
+    waiting: dict[int, tuple[int, float]] = dataclasses.field(default_factory=dict)
+
+
+def _buckets(limit: RateLimit) -> tuple[_Bucket | None, _Bucket | None]:
+    """上限からリクエスト数とトークン数のバケットを作る 上限がない方は None になる
+
+    Parameters
+    ----------
+    limit
+    """
+    return (
+        (
+            _Bucket(limit.requests_per_minute, limit.requests_per_minute / 60)
+            if limit.requests_per_minute is not None
+            else None
+        ),
+        (
+            _Bucket(limit.tokens_per_minute, limit.tokens_per_minute / 60)
+            if limit.tokens_per_minute is not None
+            else None
+        ),
+    )
+
+
+def _status_code(error: BaseException) -> int | None:
+    """例外から HTTP のステータスコードを取り出す
+    openai は status_code、google.api_core は code に持っている
+
+    Parameters
+    ----------
+    error
+    """
+    for name in ("status_code", "code"):
+        value = getattr(error, name, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def _retry_after(error: BaseException) -> float | None:
+    """レスポンスの Retry-After ヘッダーから待つ秒数を取り出す
+
+    Parameters
+    ----------
+    error
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        return None
+    # OpenAI はミリ秒単位のヘッダーも返す
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _track_attempt(attempt: int) -> None:
+    """実行中の呼び出しの記録に、API を呼んだこととリトライの回数を書き込む
+
+    Parameters
+    ----------
+    attempt
+    """
+    record = ledger.current()
+    if record is not None:
+        record.cache_hit = False
+        record.retries = attempt
+
+
+class Scheduler:
+    """(api_key, model) ごとに RPM・TPM の上限を守るようにリクエストを待たせる
+    予算が足りないときは、収まる小さいリクエストを先に通す
+    ただし max_bypass 秒以上待っているリクエストがあれば、それより後のリクエストは追い越さない
+    429 と 5xx のエラーは Retry-After を尊重しつつ、ジッター付きの指数バックオフでやり直す
+
+    Attributes
+    ----------
+    limits
+        モデルごとの上限 ないモデルは上限なしとして扱い、リトライだけ行う
+    max_retries
+    base_delay
+    max_delay
+    max_bypass
+    stats
+        待ち行列の長さ、待ち時間、スロットリングの回数
+    """
+
+    def __init__(
+        self,
+        limits: dict[str, RateLimit] | None = None,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        max_bypass: float = 30.0,
+    ) -> None:
+        """init
+
+        Parameters
+        ----------
+        limits
+        max_retries
+        base_delay
+            1回目のリトライまでの最大秒数 リトライごとに倍になる
+        max_delay
+            リトライまでの秒数の上限
+        max_bypass
+        """
+        self.limits = dict(limits) if limits is not None else {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_bypass = max_bypass
+        self.stats = SchedulerStats()
+        self._states: dict[tuple[str, str], _KeyState] = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def set_limit(self, model: str, limit: RateLimit) -> None:
+        """モデルの上限を設定する すでに作られたバケットは作り直す
+
+        Parameters
+        ----------
+        model
+        limit
+        """
+        with self._lock:
+            self.limits[model] = limit
+            for (_, state_model), state in self._states.items():
+                if state_model == model:
+                    state.requests, state.tokens = _buckets(limit)
+
+    def _state(self, api_key: str, model: str) -> _KeyState:
+        """(api_key, model) の状態を返す なければ作る ロックを取って呼ぶ
+
+        Parameters
+        ----------
+        api_key
+        model
+        """
+        state = self._states.get((api_key, model))
+        if state is None:
+            state = _KeyState(*_buckets(self.limits.get(model, RateLimit())))
+            self._states[(api_key, model)] = state
+        return state
+
+    def _enqueue(self, api_key: str, model: str, tokens: int) -> int:
+        """待ち行列に入れて番号を返す
+
+        Parameters
+        ----------
+        api_key
+        model
+        tokens
+        """
+        with self._lock:
+            sequence = next(self._sequence)
+            self._state(api_key, model).waiting[sequence] = (tokens, time.monotonic())
+            self.stats.requests += 1
+            self.stats.queue_depth += 1
+            self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.stats.queue_depth)
+        return sequence
+
+    def _try_acquire(self, api_key: str, model: str, sequence: int) -> float:
+        """予算があれば使って待ち行列から外し 0 を返す なければ待つ秒数を返す
+
+        Parameters
+        ----------
+        api_key
+        model
+        sequence
+        """
+        with self._lock:
+            state = self._state(api_key, model)
+            tokens, _ = state.waiting[sequence]
+            now = time.monotonic()
+
+            if state.blocked_until > now:
+                return min(state.blocked_until - now, _POLL_INTERVAL)
+            # 長く待っているリクエストを追い越さない
+            for other, (_, since) in state.waiting.items():
+                if other < sequence and now - since > self.max_bypass:
+                    return _POLL_INTERVAL
+
+            wait = 0.0
+            if state.requests is not None:
+                wait = max(wait, state.requests.wait_time(1, now))
+            if state.tokens is not None:
+                wait = max(wait, state.tokens.wait_time(tokens, now))
+            if wait > 0:
+                return min(wait, _POLL_INTERVAL)
+
+            if state.requests is not None:
+                state.requests.take(1)
+            if state.tokens is not None:
+                state.tokens.take(tokens)
+            del state.waiting[sequence]
+            self.stats.queue_depth -= 1
+        return 0.0
+
+    def _record_wait(self, waited: float) -> None:
+        """待った時間を記録する
+
+        Parameters
+        ----------
+        waited
+        """
+        if waited <= 0:
+            return
+        with self._lock:
+            self.stats.throttled += 1
+            self.stats.wait_seconds += waited
+
+    def _cancel(self, api_key: str, model: str, sequence: int) -> None:
+        """待っている途中で中断されたリクエストを待ち行列から外す
+
+        Parameters
+        ----------
+        api_key
+        model
+        sequence
+        """
+        with self._lock:
+            if self._state(api_key, model).waiting.pop(sequence, None) is not None:
+                self.stats.queue_depth -= 1
+
+    def _retry_delay(
+        self, api_key: str, model: str, attempt: int, error: BaseException
+    ) -> float | None:
+        """やり直すまでの秒数を返す やり直さないエラーの場合は None を返す
+        429 の場合は同じ (api_key, model) の他のリクエストもその間止める
+
+        Parameters
+        ----------
+        api_key
+        model
+        attempt
+            何回目のリトライか (0始まり)
+        error
+        """
+        status_code = _status_code(error)
+        if status_code is None or (status_code != 429 and status_code < 500):
+            return None
+        if attempt >= self.max_retries:
+            return None
+
+        delay = _retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        with self._lock:
+            self.stats.rate_limited += 1
+            self.stats.retries += 1
+            if status_code == 429:
+                state = self._state(api_key, model)
+                state.blocked_until = max(state.blocked_until, time.monotonic() + delay)
+        logger.logger.warning(f"{status_code} from {model}, retry after {delay:.1f}s")
+        return delay
+
+    def run[R](self, api_key: str, model: str, tokens: int, call: Callable[[], R]) -> R:
+        """上限に収まるまで待ってから call を実行する
+
+        Parameters
+        ----------
+        api_key
+        model
+        tokens
+            リクエストの推定トークン数
+        call
+        """
+        attempt = 0
+        while True:
+            sequence = self._enqueue(api_key, model, tokens)
+            waited = 0.0
+            try:
+                while (wait := self._try_acquire(api_key, model, sequence)) > 0:
+                    time.sleep(wait)
+                    waited += wait
+            finally:
+                self._cancel(api_key, model, sequence)
+            self._record_wait(waited)
+            _track_attempt(attempt)
+
+            try:
+                return call()
+            except Exception as e:
+                delay = self._retry_delay(api_key, model, attempt, e)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def run_async[R](
+        self, api_key: str, model: str, tokens: int, call: Callable[[], Awaitable[R]]
+    ) -> R:
+        """run の非同期版
+
+        Parameters
+        ----------
+        api_key
+        model
+        tokens
+            リクエストの推定トークン数
+        call
+        """
+        attempt = 0
+        while True:
+            sequence = self._enqueue(api_key, model, tokens)
+            waited = 0.0
+            try:
+                while (wait := self._try_acquire(api_key, model, sequence)) > 0:
+                    await asyncio.sleep(wait)
+                    waited += wait
+            finally:
+                self._cancel(api_key, model, sequence)
+            self._record_wait(waited)
+            _track_attempt(attempt)
+
+            try:
+                return await call()
+            except Exception as e:
+                delay = self._retry_delay(api_key, model, attempt, e)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+_default_scheduler: Scheduler | None = None
+_default_scheduler_lock = threading.Lock()
+
+
+def default_scheduler() -> Scheduler:
+    """クライアントが標準で使う Scheduler を返す 初回呼び出し時に作られる"""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = Scheduler()
+        return _default_scheduler
+
+
+def set_default_scheduler(scheduler: Scheduler) -> None:
+    """クライアントが標準で使う Scheduler を差し替える
+
+    Parameters
+    ----------
+    scheduler
+    """
+    global _default_scheduler
+    with _default_scheduler_lock:
+        _default_scheduler = scheduler
@@ -0,0 +1,348 @@
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+from collections.abc import Iterable, Iterator
+from typing import TYPE_CHECKING
+
+from llm_clients import cache, filelock, logger
+
+if TYPE_CHECKING:
+    import numpy
+    import torch
+
+# demucs は torch を読み込むので、モデルを読み込むときに関数の中で import する
+
+
+# segment は1回にモデルに入れる秒数 None の場合はモデルの学習時の長さを使う
+# shifts を増やすと時間をずらして平均するので少し良くなるが、その回数分遅くなる
+# window を指定すると曲全体ではなく window 秒ずつ分離し、隣の窓と window_overlap 秒重ねて
+# クロスフェードでつなぐ 長い音声でも使うメモリは窓の長さの分で済む
+@dataclasses.dataclass(frozen=True)
+class SeparatorConfig:
+    model_name: str = "htdemucs"
+    device: str = "cpu"
+    cpu_threads: int = 0
+    segment: float | None = None
+    shifts: int = 1
+    overlap: float = 0.25
+    window: float | None = None
+    window_overlap: float = 5.0
+
+
+def _max_segment(model: "torch.nn.Module") -> float:
+    """モデルに1回に入れられる秒数を返す
+
+    Parameters
+    ----------
+    model
+    """
+    import demucs.apply
+    import demucs.htdemucs
+
+    if isinstance(model, demucs.apply.BagOfModels):
+        return model.max_allowed_segment
+    if isinstance(model, demucs.htdemucs.HTDemucs):
+        return float(model.segment)
+    return float("inf")
+
+
+def _normalization(audio: "numpy.ndarray", block: int = 1 << 20) -> tuple[float, float]:
+    """demucs.separate.main と同じく、チャンネルの平均の平均と標準偏差を返す
+    配列を block サンプルずつ読むので、memmap でも全体をメモリに読み込まない
+
+    Parameters
+    ----------
+    audio
+        (サンプル数, チャンネル数) の配列
+    block
+    """
+    total = 0.0
+    squares = 0.0
+    for start in range(0, len(audio), block):
+        ref = audio[start : start + block].mean(axis=1, dtype="float64")
+        total += float(ref.sum())
+        squares += float((ref * ref).sum())
+    n = len(audio)
+    mean = total / n
+    # torch.std と同じく不偏分散を使う
+    std = ((squares - n * mean * mean) / max(n - 1, 1)) ** 0.5
+    return mean, std
+
+
+class VocalSeparator:
+    """demucs のモデルを1回だけ読み込み、複数の曲のボーカル抽出に使い回す
+    以前の demucs.separate.main と同じく、音量を正規化して分離し、ボーカルだけを取り出す
+    モデルは複数のスレッドから同時に使わないようにロックする
+
+    Attributes
+    ----------
+    config
+    """
+
+    def __init__(self, config: SeparatorConfig = SeparatorConfig()) -> None:
+        """init
+
+        Parameters
+        ----------
+        config
+        """
+        self.config = config
+        self._model: "torch.nn.Module | None" = None
+        self._lock = threading.Lock()
+
+    def _load_model(self) -> "torch.nn.Module":
+        """モデルを読み込む 読み込み済みの場合はそれを返す ロックを取ってから呼ぶ"""
+        if self._model is not None:
+            return self._model
+
+        import demucs.pretrained
+        import torch
+
+        logger.logger.debug(f"load demucs model: {self.config}")
+        if self.config.cpu_threads > 0:
+            # torch のスレッド数はプロセス全体の設定になる
+            torch.set_num_threads(self.config.cpu_threads)
+        model = demucs.pretrained.get_model(self.config.model_name)
+        if "vocals" not in model.sources:
+            raise ValueError(f"{self.config.model_name} has no vocals stem: {model.sources}")
+        if self.config.segment is not None and self.config.segment > _max_segment(model):
+            raise ValueError(
+                f"segment must be at most {_max_segment(model)}: {self.config.segment}"
+            )
+        model.cpu()
+        model.eval()
+        self._model = model
+        return model
+
+    def preload(self) -> None:
+        """モデルを読み込んでおく"""
+        with self._lock:
+            self._load_model()
+
+    @property
+    def samplerate(self) -> int:
+        """分離した音声のサンプリング周波数"""
+        with self._lock:
+            return self._load_model().samplerate
+
+    def _apply(self, model: "torch.nn.Module", wav: "torch.Tensor") -> "torch.Tensor":
+        """正規化した (チャンネル数, サンプル数) の音声からボーカルを分離する ロックを取ってから呼ぶ
+
+        Parameters
+        ----------
+        model
+        wav
+        """
+        import demucs.apply
+        import torch
+
+        with torch.no_grad():
+            sources = demucs.apply.apply_model(
+                model,
+                wav[None],
+                shifts=self.config.shifts,
+                overlap=self.config.overlap,
+                device=self.config.device,
+                segment=self.config.segment,
+            )[0]
+        return sources[model.sources.index("vocals")]
+
+    def _separate(self, audio_path: str) -> "torch.Tensor":
+        """音声全体を読み込んでボーカルを分離し、(チャンネル数, サンプル数) の Tensor を返す
+
+        Parameters
+        ----------
+        audio_path
+        """
+        import demucs.separate
+
+        with self._lock:
+            model = self._load_model()
+            logger.logger.debug(f"separate vocals: {audio_path}")
+            wav = demucs.separate.load_track(audio_path, model.audio_channels, model.samplerate)
+            ref = wav.mean(0)
+            wav = (wav - ref.mean()) / ref.std()
+            return self._apply(model, wav) * ref.std() + ref.mean()
+
+    def _window_sizes(self, model: "torch.nn.Module") -> tuple[int, int]:
+        """窓の長さと隣の窓と重ねる長さをサンプル数で返す
+        窓をずらす幅を demucs が窓の中で区切る幅の倍数にして、重なり以外では
+        曲全体を分離した場合と同じ区切りでモデルに入れる
+
+        Parameters
+        ----------
+        model
+        """
+        assert self.config.window is not None
+        window = int(self.config.window * model.samplerate)
+        fade = int(self.config.window_overlap * model.samplerate)
+        if not 0 < fade < window:
+            raise ValueError(f"window_overlap must be in (0, window): {self.config.window_overlap}")
+        segment = self.config.segment or _max_segment(model)
+        if segment != float("inf"):
+            stride = int((1 - self.config.overlap) * int(segment * model.samplerate))
+            step = max((window - fade) // stride, 1) * stride
+            window = max(window, step + fade)
+            fade = window - step
+        return window, fade
+
+    def _separate_windows(self, audio_path: str) -> Iterator["numpy.ndarray"]:
+        """window 秒ずつボーカルを分離し、(サンプル数, チャンネル数) の配列を時刻の順に返す
+        音声は audio_store の memmap から窓の分だけ読み、重なった部分は直線のクロスフェードでつなぐ
+        全体の音量の正規化は曲全体で求めるので、曲全体を分離した場合と同じ値になる
+
+        Parameters
+        ----------
+        audio_path
+        """
+        import numpy
+        import torch
+
+        from llm_clients import audio_store
+
+        with self._lock:
+            model = self._load_model()
+        audio = audio_store.default_store().load(audio_path, model.samplerate, channels=2)
+        if len(audio) == 0:
+            return
+        mean, std = _normalization(audio)
+        window, fade = self._window_sizes(model)
+        ramp = ((numpy.arange(fade, dtype=numpy.float32) + 0.5) / fade)[:, None]
+
+        tail: numpy.ndarray | None = None
+        start = 0
+        while True:
+            end = min(start + window, len(audio))
+            logger.logger.debug(f"separate vocals: {audio_path} [{start}:{end}]")
+            chunk = (numpy.asarray(audio[start:end], dtype=numpy.float32) - mean) / std
+            with self._lock:
+                vocals = self._apply(model, torch.from_numpy(numpy.ascontiguousarray(chunk.T)))
+            out = vocals.numpy().T * std + mean
+            if tail is not None:
+                out[:fade] = tail * (1 - ramp) + out[:fade] * ramp
+            if end >= len(audio):
+                yield out
+                return
+            yield out[:-fade]
+            tail = out[-fade:].copy()
+            start += window - fade
+
+    def separate(self, audio_paths: Iterable[str]) -> Iterator["numpy.ndarray"]:
+        """ボーカルを分離して (サンプル数, チャンネル数) の配列を順に返す
+        サンプリング周波数は samplerate
+
+        Parameters
+        ----------
+        audio_paths
+        """
+        import numpy
+
+        for audio_path in audio_paths:
+            if self.config.window is None:
+                yield self._separate(audio_path).numpy().T
+            else:
+                blocks = list(self._separate_windows(audio_path))
+                yield numpy.concatenate(blocks) if blocks else numpy.zeros((0, 2), "float32")
+
+    def _write_windows(self, audio_path: str, path: str) -> None:
+        """窓ごとに分離したボーカルを、終わった部分から順に float32 の WAV に書き出す
+
+        Parameters
+        ----------
+        audio_path
+        path
+        """
+        import soundfile
+
+        with soundfile.SoundFile(
+            path, "w", samplerate=self.samplerate, channels=2, format="WAV", subtype="FLOAT"
+        ) as f:
+            for block in self._separate_windows(audio_path):
+                f.write(block)
+
+    def vocal_path(self, audio_path: str, dirname: str) -> str:
+        """ボーカルのファイルのパスを返す
+        {dirname}/{モデル名}/{キー}/vocals.wav で、キーは音声の中身のハッシュと結果が変わる設定から作る
+        別のディレクトリにある同じ名前のファイルは別のパスに、中身が同じファイルは同じパスになる
+
+        Parameters
+        ----------
+        audio_path
+        dirname
+        """
+        # device と cpu_threads は結果を変えないのでキーに含めない
+        options = dataclasses.asdict(self.config)
+        del options["device"], options["cpu_threads"]
+        payload = json.dumps(
+            {"audio": cache.file_digest(audio_path), **options},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        key = hashlib.sha256(payload.encode()).hexdigest()
+        return os.path.join(dirname, self.config.model_name, key, "vocals.wav")
+
+    def extract(self, audio_paths: Iterable[str], dirname: str) -> list[str]:
+        """ボーカルを分離してファイルに書き出し、そのパスを返す
+        ファイルのパスは vocal_path で、既にあれば分離しない
+        window を指定した場合は、窓ごとに少しずつ float32 の WAV に書き出す
+        同じファイルを複数のプロセスで同時に分離しないように、ファイルロックを取ってから分離する
+        後から来た呼び出しは、先に始めた分離が終わるのを待ってその結果を返す
+
+        Parameters
+        ----------
+        audio_paths
+        dirname
+        """
+        vocal_paths = []
+        for audio_path in audio_paths:
+            vocal_path = self.vocal_path(audio_path, dirname)
+            vocal_paths.append(vocal_path)
+            if os.path.exists(vocal_path):
+                continue
+            os.makedirs(os.path.dirname(vocal_path), exist_ok=True)
+            with filelock.FileLock(f"{vocal_path}.lock"):
+                if os.path.exists(vocal_path):
+                    continue
+                # 途中で落ちても書きかけのファイルが残らないように一時ファイルから置き換える
+                # demucs.audio.save_audio は拡張子で形式を決めるので .wav で終わる名前にする
+                tmp_path = f"{vocal_path}.{os.getpid()}.tmp.wav"
+                try:
+                    if self.config.window is None:
+                        import demucs.audio
+
+                        vocals = self._separate(audio_path)
+                        demucs.audio.save_audio(vocals, tmp_path, samplerate=self.samplerate)
+                    else:
+                        self._write_windows(audio_path, tmp_path)
+                    os.replace(tmp_path, vocal_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+        return vocal_paths
+
+
+_default_separator: VocalSeparator | None = None
+_default_separator_lock = threading.Lock()
+
+
+def default_separator() -> VocalSeparator:
+    """標準で使う VocalSeparator を返す 初回呼び出し時に作られる"""
+    global _default_separator
+    with _default_separator_lock:
+        if _default_separator is None:
+            _default_separator = VocalSeparator()
+        return _default_separator
+
+
+def set_default_separator(separator: VocalSeparator) -> None:
+    """標準で使う VocalSeparator を差し替える
+
+    Parameters
+    ----------
+    separator
+    """
+    global _default_separator
+    with _default_separator_lock:
+        _default_separator = separator
@@ -0,0 +1,316 @@
+import concurrent.futures
+import concurrent.futures.process
+import dataclasses
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+from llm_clients import logger, separation
+
+# 数字が小さいほど先に処理する
+INTERACTIVE = 0
+BACKFILL = 10
+
+
+@dataclasses.dataclass
+class SeparationQueueStats:
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    cancelled: int = 0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    running: int = 0
+    # キューで待った時間と、ワーカーで分離にかかった時間の合計
+    wait_seconds: float = 0.0
+    run_seconds: float = 0.0
+
+
+# ワーカープロセスの中で使い回す VocalSeparator
+_worker_separator: separation.VocalSeparator | None = None
+
+
+def _init_worker(config: separation.SeparatorConfig) -> None:
+    """ワーカープロセスを起動したときにモデルを読み込んでおく
+
+    Parameters
+    ----------
+    config
+    """
+    global _worker_separator
+    _worker_separator = separation.VocalSeparator(config)
+    separation.set_default_separator(_worker_separator)
+    _worker_separator.preload()
+
+
+def _extract(audio_path: str, dirname: str) -> str:
+    """ワーカープロセスの中でボーカル抽出する
+
+    Parameters
+    ----------
+    audio_path
+    dirname
+    """
+    assert _worker_separator is not None
+    return _worker_separator.extract([audio_path], dirname)[0]
+
+
+@dataclasses.dataclass
+class _Job:
+    key: tuple[str, str]
+    audio_path: str
+    dirname: str
+    priority: int
+    future: concurrent.futures.Future[str]
+    submitted_at: float
+    started_at: float | None = None
+
+
+class SeparationQueue:
+    """ボーカル抽出をワーカープロセスのプールで実行するジョブキュー
+    ワーカーは起動時に demucs のモデルを読み込み、プロセスが終わるまで使い回す
+    priority の小さいジョブから、空いたワーカーに1つずつ渡す
+    同じファイルを待っている間に再び投入した場合は同じ Future を返し、priority が小さければ繰り上げる
+
+    Attributes
+    ----------
+    config
+    workers
+        ワーカープロセスの数
+    stats
+    """
+
+    def __init__(self, config: separation.SeparatorConfig | None = None, workers: int = 1) -> None:
+        """init
+
+        Parameters
+        ----------
+        config
+            cpu_threads が 0 の場合は CPU のコア数をワーカーで分ける
+        workers
+        """
+        if config is None:
+            config = separation.SeparatorConfig()
+        if config.cpu_threads == 0:
+            config = dataclasses.replace(
+                config, cpu_threads=max((os.cpu_count() or 1) // workers, 1)
+            )
+        self.config = config
+        self.workers = workers
+        self.stats = SeparationQueueStats()
+        self._heap: list[tuple[int, int, _Job]] = []
+        self._jobs: dict[tuple[str, str], _Job] = {}
+        self._sequence = itertools.count()
+        # _done から _dispatch を呼ぶので RLock にする
+        self._lock = threading.RLock()
+        self._executor = self._new_executor()
+        self._started_at = time.monotonic()
+        # 終わったジョブが使った時間の合計 実行中のジョブの分は utilization で足す
+        self._busy_seconds = 0.0
+        self._closed = False
+
+    def _new_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        """ワーカープロセスのプールを作る
+        streamlit などスレッドのあるプロセスから fork しないように spawn で起動する
+        """
+        return concurrent.futures.ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.config,),
+        )
+
+    def submit(
+        self, audio_path: str, dirname: str, priority: int = BACKFILL
+    ) -> concurrent.futures.Future[str]:
+        """ボーカル抽出のジョブを投入し、ボーカルのファイルのパスを返す Future を返す
+        asyncio からは asyncio.wrap_future で待てる
+
+        Parameters
+        ----------
+        audio_path
+        dirname
+            separation.VocalSeparator.extract に渡す出力先
+        priority
+            INTERACTIVE や BACKFILL 小さいほど先に処理する
+        """
+        key = (os.path.abspath(audio_path), os.path.abspath(dirname))
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("cannot submit to a closed SeparationQueue")
+            job = self._jobs.get(key)
+            if job is not None and not job.future.done():
+                if job.started_at is None and priority < job.priority:
+                    job.priority = priority
+                    heapq.heappush(self._heap, (priority, next(self._sequence), job))
+                return job.future
+
+            future: concurrent.futures.Future[str] = concurrent.futures.Future()
+            job = _Job(key, audio_path, dirname, priority, future, time.monotonic())
+            self._jobs[key] = job
+            heapq.heappush(self._heap, (priority, next(self._sequence), job))
+            self.stats.submitted += 1
+            self.stats.queue_depth += 1
+            self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.stats.queue_depth)
+        self._dispatch()
+        return future
+
+    def _forget(self, job: _Job) -> None:
+        """終わったジョブを同じファイルの投入をまとめる対象から外す ロックを取ってから呼ぶ
+
+        Parameters
+        ----------
+        job
+        """
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+
+    def _dispatch(self) -> None:
+        """空いているワーカーに priority の小さいジョブから渡す"""
+        with self._lock:
+            while self._heap and self.stats.running < self.workers:
+                priority, _, job = heapq.heappop(self._heap)
+                # 繰り上げた場合は古い方のエントリが残っているので飛ばす
+                if priority != job.priority or job.started_at is not None:
+                    continue
+                self.stats.queue_depth -= 1
+                if not job.future.set_running_or_notify_cancel():
+                    self._forget(job)
+                    self.stats.cancelled += 1
+                    continue
+                job.started_at = time.monotonic()
+                self.stats.wait_seconds += job.started_at - job.submitted_at
+                self.stats.running += 1
+                try:
+                    worker_future = self._submit(job)
+                except RuntimeError as e:
+                    # インタープリターの終了時などでプールが止まっている場合
+                    self._forget(job)
+                    self.stats.running -= 1
+                    self.stats.failed += 1
+                    job.future.set_exception(e)
+                    continue
+                worker_future.add_done_callback(lambda f, job=job: self._done(job, f))
+
+    def _submit(self, job: _Job) -> concurrent.futures.Future[str]:
+        """ワーカープロセスのプールにジョブを渡す ロックを取ってから呼ぶ
+
+        Parameters
+        ----------
+        job
+        """
+        try:
+            return self._executor.submit(_extract, job.audio_path, job.dirname)
+        except concurrent.futures.process.BrokenProcessPool:
+            # ワーカーが落ちた場合はプールを作り直す 実行中だったジョブは失敗になる
+            logger.logger.warning("separation worker pool is broken, restarting")
+            self._executor.shutdown(wait=False)
+            self._executor = self._new_executor()
+            return self._executor.submit(_extract, job.audio_path, job.dirname)
+
+    def _done(self, job: _Job, worker_future: concurrent.futures.Future[str]) -> None:
+        """ワーカーのジョブが終わったときに結果を渡し、次のジョブを渡す
+
+        Parameters
+        ----------
+        job
+        worker_future
+        """
+        assert job.started_at is not None
+        elapsed = time.monotonic() - job.started_at
+        error = worker_future.exception()
+        with self._lock:
+            self._forget(job)
+            self.stats.running -= 1
+            self.stats.run_seconds += elapsed
+            self._busy_seconds += elapsed
+            if error is None:
+                self.stats.completed += 1
+            else:
+                self.stats.failed += 1
+        logger.logger.info(
+            f"separated {job.audio_path} in {elapsed:.1f}s "
+            f"(waited {job.started_at - job.submitted_at:.1f}s, priority {job.priority})"
+        )
+        if error is None:
+            job.future.set_result(worker_future.result())
+        else:
+            job.future.set_exception(error)
+        # shutdown した後も、残っているジョブは最後まで渡す
+        self._dispatch()
+        self._stop_if_idle()
+
+    def utilization(self) -> float:
+        """起動してからワーカーが分離していた時間の割合を返す"""
+        now = time.monotonic()
+        with self._lock:
+            busy = self._busy_seconds + sum(
+                now - job.started_at for job in self._jobs.values() if job.started_at is not None
+            )
+        return busy / max(self.workers * (now - self._started_at), 1e-9)
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False) -> None:
+        """新しいジョブを受け付けないようにして、ワーカープロセスを止める
+
+        Parameters
+        ----------
+        wait
+            ジョブが終わるまで待つかどうか
+            False の場合は待たずに返し、残りのジョブが終わったところでワーカープロセスを止める
+        cancel_futures
+            まだ始まっていないジョブを取り消すかどうか
+            False の場合は残りのジョブも実行してから止める
+        """
+        with self._lock:
+            self._closed = True
+            if cancel_futures:
+                # 繰り上げたジョブはエントリが2つあるので1つにまとめる
+                pending = {id(job): job for _, _, job in self._heap if job.started_at is None}
+                for job in pending.values():
+                    self._forget(job)
+                    self.stats.queue_depth -= 1
+                    if job.future.cancel():
+                        self.stats.cancelled += 1
+                self._heap.clear()
+            jobs = list(self._jobs.values())
+        if wait:
+            # 残りのジョブは _done から続けてワーカーに渡される
+            concurrent.futures.wait([job.future for job in jobs])
+            self._executor.shutdown(wait=True)
+        else:
+            self._stop_if_idle()
+
+    def _stop_if_idle(self) -> None:
+        """shutdown した後で、待っているジョブも実行中のジョブもなければワーカープロセスを止める"""
+        with self._lock:
+            idle = self._closed and self.stats.queue_depth == 0 and self.stats.running == 0
+        if idle:
+            self._executor.shutdown(wait=False)
+
+
+_default_queue: SeparationQueue | None = None
+_default_queue_lock = threading.Lock()
+
+
+def default_queue() -> SeparationQueue:
+    """標準で使う SeparationQueue を返す 初回呼び出し時に作られる"""
+    global _default_queue
+    with _default_queue_lock:
+        if _default_queue is None:
+            _default_queue = SeparationQueue()
+        return _default_queue
+
+
+def set_default_queue(queue: SeparationQueue) -> None:
+    """標準で使う SeparationQueue を差し替える
+
+    Parameters
+    ----------
+    queue
+    """
+    global _default_queue
+    with _default_queue_lock:
+        _default_queue = queue
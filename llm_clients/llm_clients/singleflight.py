@@ -0,0 +1,177 @@
+import asyncio
+import concurrent.futures
+import dataclasses
+import os
+import threading
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from llm_clients import cache, filelock
+
+
+@dataclasses.dataclass
+class SingleFlightStats:
+    calls: int = 0
+    coalesced: int = 0
+    process_waits: int = 0
+
+
+class SingleFlight:
+    """同じキーの呼び出しが同時に来たら1回だけ実行し、結果や例外を共有する
+    processes=True の場合はキャッシュのディレクトリのロックファイルでプロセス間でも1回にする
+    プロセス間では結果を直接渡せないので、後から来たプロセスはロックが外れるのを待ってから実行する
+    実行する関数がキャッシュを確認していれば、先に実行したプロセスの結果が使われる
+
+    Attributes
+    ----------
+    processes
+    lock_dir
+    stats
+        実行した回数と、相乗りした回数
+    """
+
+    def __init__(self, processes: bool = False, lock_dir: str | None = None) -> None:
+        """init
+
+        Parameters
+        ----------
+        processes
+            プロセス間でもまとめるかどうか
+        lock_dir
+            ロックファイルを置くディレクトリ None の場合は cache.CACHE_DIR 以下に作る
+        """
+        self.processes = processes
+        self.lock_dir = lock_dir if lock_dir is not None else os.path.join(cache.CACHE_DIR, "locks")
+        self.stats = SingleFlightStats()
+        self._calls: dict[str, concurrent.futures.Future[Any]] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: str) -> tuple[concurrent.futures.Future[Any], bool]:
+        """実行中の呼び出しがあればその Future を、なければ新しい Future を返す
+
+        Parameters
+        ----------
+        key
+
+        Returns
+        -------
+        future
+        leader
+            自分が実行する場合は True
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.stats.coalesced += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._calls[key] = future
+            self.stats.calls += 1
+            return future, True
+
+    def _finish(self, key: str) -> None:
+        """実行中の呼び出しの記録を消す
+
+        Parameters
+        ----------
+        key
+        """
+        with self._lock:
+            self._calls.pop(key, None)
+
+    def _process_lock(self, key: str) -> filelock.FileLock | None:
+        """プロセス間のロックを取る processes=False の場合は None を返す
+
+        Parameters
+        ----------
+        key
+        """
+        if not self.processes:
+            return None
+        lock = filelock.FileLock(os.path.join(self.lock_dir, f"{key}.lock"))
+        if not lock.acquire(blocking=False):
+            with self._lock:
+                self.stats.process_waits += 1
+            lock.acquire()
+        return lock
+
+    def do[R](self, key: str, func: Callable[[], R]) -> R:
+        """key の呼び出しが実行中なら結果を待って返し、なければ func を実行する
+
+        Parameters
+        ----------
+        key
+        func
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+
+        try:
+            lock = self._process_lock(key)
+            try:
+                result = func()
+            finally:
+                if lock is not None:
+                    lock.release()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._finish(key)
+
+    async def do_async[R](self, key: str, func: Callable[[], Awaitable[R]]) -> R:
+        """do の非同期版 別のスレッドやイベントループで実行中の呼び出しにも相乗りする
+
+        Parameters
+        ----------
+        key
+        func
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+
+        try:
+            lock = await asyncio.to_thread(self._process_lock, key)
+            try:
+                result = await func()
+            finally:
+                if lock is not None:
+                    lock.release()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._finish(key)
+
+
+_default_single_flight: SingleFlight | None = None
+_default_single_flight_lock = threading.Lock()
+
+
+def default_single_flight() -> SingleFlight:
+    """クライアントが標準で使う SingleFlight を返す 初回呼び出し時に作られる"""
+    global _default_single_flight
+    with _default_single_flight_lock:
+        if _default_single_flight is None:
+            _default_single_flight = SingleFlight()
+        return _default_single_flight
+
+
+def set_default_single_flight(single_flight: SingleFlight) -> None:
+    """クライアントが標準で使う SingleFlight を差し替える
+
+    Parameters
+    ----------
+    single_flight
+    """
+    global _default_single_flight
+    with _default_single_flight_lock:
+        _default_single_flight = single_flight
@@ -0,0 +1,39 @@
+from llm_clients import types
+
+# 画像1枚あたりのトークン数 (OpenAI の detail="low" 相当)
+IMAGE_TOKENS = 85
+# メッセージ1件ごとにかかる役割などのトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """文字列のトークン数を概算する
+    ASCII は4文字で1トークン、それ以外 (日本語など) は1文字1トークンとして数える
+
+    Parameters
+    ----------
+    text
+    """
+    ascii_count = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_count) + (ascii_count + 3) // 4
+
+
+def estimate_message_tokens(messages: tuple[types.TupleMessage, ...]) -> int:
+    """メッセージ全体の入力トークン数を概算する
+
+    Parameters
+    ----------
+    messages
+    """
+    tokens = 0
+    for message in messages:
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        if isinstance(message.content, str):
+            tokens += estimate_tokens(message.content)
+            continue
+        for content in message.content:
+            if content.type == "text":
+                tokens += estimate_tokens(content.content)
+            else:
+                tokens += IMAGE_TOKENS
+    return tokens
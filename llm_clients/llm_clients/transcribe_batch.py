@@ -0,0 +1,396 @@
+"""ディレクトリやマニフェストの音声をまとめて文字起こしする
+
+python -m llm_clients.transcribe_batch downloads/music -o outputs --workers 2 --format jsonl srt
+終わったファイルは出力先の checkpoint.jsonl に記録し、途中で止めても続きから再開する
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections.abc import Iterator
+from typing import TextIO
+
+from llm_clients import cache, media, types, util, whisper, whisper_models
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".m4a", ".mp4", ".ogg", ".opus", ".webm", ".aac")
+CHECKPOINT_FNAME = "checkpoint.jsonl"
+
+
+@dataclasses.dataclass(frozen=True)
+class Job:
+    audio_path: str
+    # 出力先のディレクトリからの相対パス (拡張子なし)
+    name: str
+
+
+# 1ファイル分の結果 スキップした場合は elapsed が 0 になる
+@dataclasses.dataclass
+class JobResult:
+    job: Job
+    audio_seconds: float
+    elapsed: float
+    segments: int
+    skipped: bool = False
+
+
+def _manifest(path: str) -> Iterator[str]:
+    """マニフェストのファイルから音声のパスを返す
+    .jsonl の場合は各行の audio_path、それ以外は1行に1つのパスとして読む
+    相対パスはマニフェストのディレクトリからのパスとして扱う
+
+    Parameters
+    ----------
+    path
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            audio_path = json.loads(line)["audio_path"] if path.endswith(".jsonl") else line
+            yield os.path.join(base, audio_path)
+
+
+def _unique_names(jobs: list[Job]) -> list[Job]:
+    """同じファイルを1つにまとめ、出力先の名前が重なるファイルは名前にパスのハッシュをつける
+    song.mp3 と song.wav や、別のディレクトリの同じ名前のファイルが同じ出力に書かないようにする
+
+    Parameters
+    ----------
+    jobs
+    """
+    by_path: dict[str, Job] = {}
+    for job in jobs:
+        by_path.setdefault(os.path.abspath(job.audio_path), job)
+    counts = collections.Counter(job.name for job in by_path.values())
+    ret: list[Job] = []
+    for path, job in by_path.items():
+        if counts[job.name] > 1:
+            digest = hashlib.sha256(path.encode()).hexdigest()[:8]
+            job = Job(job.audio_path, f"{job.name}-{digest}")
+        ret.append(job)
+    return ret
+
+
+def collect_jobs(inputs: list[str]) -> list[Job]:
+    """入力のディレクトリ・マニフェスト・音声ファイルから処理するファイルを集める
+    ディレクトリの中のファイルは、出力先でもディレクトリの構造を保つ
+    出力先の名前が重なる場合は _unique_names で名前を変える
+
+    Parameters
+    ----------
+    inputs
+    """
+    jobs: list[Job] = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, _, fnames in os.walk(path):
+                for fname in sorted(fnames):
+                    if os.path.splitext(fname)[1].lower() in AUDIO_EXTENSIONS:
+                        audio_path = os.path.join(root, fname)
+                        name = os.path.splitext(os.path.relpath(audio_path, path))[0]
+                        jobs.append(Job(audio_path, name))
+        elif os.path.splitext(path)[1].lower() in AUDIO_EXTENSIONS:
+            jobs.append(Job(path, os.path.splitext(os.path.basename(path))[0]))
+        else:
+            for audio_path in _manifest(path):
+                jobs.append(Job(audio_path, os.path.splitext(os.path.basename(audio_path))[0]))
+    return sorted(_unique_names(jobs), key=lambda job: job.name)
+
+
+def _srt_time(second: float) -> str:
+    """秒をSRT形式の時刻 (hh:mm:ss,xxx) に変換する
+
+    Parameters
+    ----------
+    second
+    """
+    ms = round(second * 1000)
+    return f"{ms // 3_600_000:02}:{ms // 60_000 % 60:02}:{ms // 1000 % 60:02},{ms % 1000:03}"
+
+
+class Checkpoint:
+    """終わったファイルを JSONL に追記して、再開するときにスキップする
+    音声の絶対パスごとに中身のハッシュも記録するので、同じパスのファイルを置き換えた場合はやり直す
+
+    Attributes
+    ----------
+    path
+    """
+
+    def __init__(self, path: str) -> None:
+        """init
+
+        Parameters
+        ----------
+        path
+        """
+        self.path = path
+        self._done: dict[str, str] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    # 書き込み中に止まった最後の行は読み飛ばす
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._done[os.path.abspath(row["audio_path"])] = row["digest"]
+
+    def done(self, job: Job, digest: str) -> bool:
+        """job が終わっているかどうか
+
+        Parameters
+        ----------
+        job
+        digest
+        """
+        return self._done.get(os.path.abspath(job.audio_path)) == digest
+
+    def add(self, result: JobResult, digest: str) -> None:
+        """終わったファイルを記録する
+
+        Parameters
+        ----------
+        result
+        digest
+        """
+        row = {
+            "name": result.job.name,
+            "audio_path": os.path.abspath(result.job.audio_path),
+            "digest": digest,
+            "audio_seconds": result.audio_seconds,
+            "elapsed": result.elapsed,
+            "segments": result.segments,
+        }
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self._done[os.path.abspath(result.job.audio_path)] = digest
+
+
+class BatchTranscriber:
+    """ファイルごとに文字起こしして、区間が終わるたびに JSONL・SRT に書き出す
+
+    Attributes
+    ----------
+    client
+    output_dir
+    formats
+    model_name
+    use_vad
+    vocal_extract
+    checkpoint
+    """
+
+    def __init__(
+        self,
+        client: whisper.Whisper,
+        output_dir: str,
+        formats: tuple[str, ...] = ("jsonl",),
+        model_name: str = "large-v2",
+        use_vad: bool = True,
+        vocal_extract: bool = False,
+    ) -> None:
+        """init
+
+        Parameters
+        ----------
+        client
+        output_dir
+        formats
+            jsonl と srt から選ぶ
+        model_name
+        use_vad
+        vocal_extract
+            文字起こしの前にボーカル抽出し、VADにボーカルを使うかどうか
+        """
+        self.client = client
+        self.output_dir = output_dir
+        self.formats = formats
+        self.model_name = model_name
+        self.use_vad = use_vad
+        self.vocal_extract = vocal_extract
+        self.checkpoint = Checkpoint(os.path.join(output_dir, CHECKPOINT_FNAME))
+
+    def _vocal_path(self, audio_path: str) -> str:
+        """VADに使う音声のパスを返す
+
+        Parameters
+        ----------
+        audio_path
+        """
+        if not self.vocal_extract:
+            return audio_path
+        # demucs のモデルは標準の VocalSeparator に1回だけ読み込まれ、ファイル間で使い回される
+        return util.vocal_extract(audio_path, os.path.join(self.output_dir, "vocals"))
+
+    def run(self, job: Job) -> JobResult:
+        """1ファイルを文字起こしする 終わっている場合はスキップする
+
+        Parameters
+        ----------
+        job
+        """
+        digest = cache.file_digest(job.audio_path)
+        audio_seconds = media.duration(job.audio_path)
+        if self.checkpoint.done(job, digest):
+            return JobResult(job, audio_seconds, 0.0, 0, skipped=True)
+
+        started = time.perf_counter()
+        vocal_path = self._vocal_path(job.audio_path)
+        base_path = os.path.join(self.output_dir, job.name)
+        os.makedirs(os.path.dirname(base_path), exist_ok=True)
+        # 途中で止めた場合に書きかけのファイルが残らないように、一時ファイルに書いてから置き換える
+        tmp_paths = {fmt: f"{base_path}.{fmt}.tmp" for fmt in self.formats}
+        segments = 0
+        try:
+            files = {fmt: open(tmp_path, "w") for fmt, tmp_path in tmp_paths.items()}
+            try:
+                for segment, words in self.client.transcribe_words_stream(
+                    job.audio_path, vocal_path, self.model_name, self.use_vad
+                ):
+                    segments += 1
+                    self._write(files, segments, segment, words)
+            finally:
+                for f in files.values():
+                    f.close()
+            for fmt, tmp_path in tmp_paths.items():
+                os.replace(tmp_path, f"{base_path}.{fmt}")
+        finally:
+            for tmp_path in tmp_paths.values():
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+
+        result = JobResult(job, audio_seconds, time.perf_counter() - started, segments)
+        self.checkpoint.add(result, digest)
+        return result
+
+    @staticmethod
+    def _write(
+        files: dict[str, TextIO],
+        number: int,
+        segment: types.Transcript,
+        words: list[types.Word],
+    ) -> None:
+        """1区間を書き出す
+
+        Parameters
+        ----------
+        files
+            形式ごとの書き出し先
+        number
+            1から始まる区間の番号
+        segment
+        words
+        """
+        if "jsonl" in files:
+            row = {**segment._asdict(), "words": [w._asdict() for w in words]}
+            files["jsonl"].write(json.dumps(row, ensure_ascii=False) + "\n")
+            files["jsonl"].flush()
+        if "srt" in files:
+            files["srt"].write(
+                f"{number}\n{_srt_time(segment.start)} --> {_srt_time(segment.end)}\n"
+                f"{segment.text}\n\n"
+            )
+            files["srt"].flush()
+
+
+def main(argv: list[str] | None = None) -> int:
+    """コマンドラインから実行する
+
+    Parameters
+    ----------
+    argv
+    """
+    parser = argparse.ArgumentParser(description="音声をまとめて文字起こしする")
+    parser.add_argument("inputs", nargs="+", help="ディレクトリ、マニフェスト、音声ファイル")
+    parser.add_argument("-o", "--output-dir", required=True)
+    parser.add_argument("--format", nargs="+", choices=("jsonl", "srt"), default=["jsonl"])
+    parser.add_argument("--model", default="large-v2")
+    parser.add_argument("--compute-type", default="int8", help="CPU では int8 が速い")
+    parser.add_argument("--device", default="auto")
+    parser.add_argument("--cpu-threads", type=int, default=0)
+    parser.add_argument(
+        "--num-workers", type=int, default=1, help="1ファイルの区間を並列に処理する数"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="同時に処理するファイルの数")
+    parser.add_argument("--regex", default="[a-zA-Zぁ-んァ-ン！？ ]+")
+    parser.add_argument("--no-vad", action="store_true")
+    parser.add_argument("--vocal-extract", action="store_true", help="先にボーカル抽出する")
+    args = parser.parse_args(argv)
+
+    jobs = collect_jobs(args.inputs)
+    os.makedirs(args.output_dir, exist_ok=True)
+    # 同時に処理するファイルの区間も並列に処理できるように、モデルの同時実行数を合わせる
+    client = whisper.Whisper(
+        regex=args.regex,
+        compute_type=args.compute_type,
+        device=args.device,
+        cpu_threads=args.cpu_threads,
+        num_workers=max(args.num_workers, args.workers),
+        model_registry=whisper_models.default_registry(),
+    )
+    client.preload(args.model)
+    transcriber = BatchTranscriber(
+        client,
+        args.output_dir,
+        tuple(args.format),
+        args.model,
+        use_vad=not args.no_vad,
+        vocal_extract=args.vocal_extract,
+    )
+
+    started = time.perf_counter()
+    results: list[JobResult] = []
+    failed = 0
+    executor = concurrent.futures.ThreadPoolExecutor(args.workers)
+    # 途中で止めた場合はまだ始まっていないファイルを取り消す 終わったファイルは次の実行でスキップされる
+    try:
+        futures = {executor.submit(transcriber.run, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"[failed] {job.audio_path}: {type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            results.append(result)
+            if result.skipped:
+                print(f"[skip] {job.name}")
+            else:
+                print(
+                    f"[done] {job.name}: {result.segments} segments, "
+                    f"{result.audio_seconds:.1f}s audio in {result.elapsed:.1f}s "
+                    f"(RTF {result.elapsed / max(result.audio_seconds, 1e-9):.3f})"
+                )
+    finally:
+        executor.shutdown(cancel_futures=True)
+    elapsed = time.perf_counter() - started
+
+    processed = [r for r in results if not r.skipped]
+    audio_seconds = sum(r.audio_seconds for r in processed)
+    print(
+        f"{len(processed)} files transcribed, {len(results) - len(processed)} skipped, "
+        f"{failed} failed in {elapsed:.1f}s"
+    )
+    if processed:
+        print(
+            f"throughput: {len(processed) / elapsed * 3600:.1f} files/hour, "
+            f"{audio_seconds / 3600:.2f}h audio, RTF {elapsed / max(audio_seconds, 1e-9):.3f}"
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
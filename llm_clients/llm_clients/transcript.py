@@ -0,0 +1,216 @@
+import array
+import bisect
+import struct
+import sys
+from collections.abc import Iterable, Iterator
+
+from llm_clients import types
+
+# to_bytes の形式 先頭に _MAGIC と FORMAT_VERSION、区間の数、単語の数を書き、
+# その後に数値の列と UTF-8 の文字列を順に並べる
+_MAGIC = b"LCTT"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sHII")
+
+
+def _text(data: bytearray, ends: array.array, i: int) -> str:
+    """つなげた UTF-8 のバイト列から i 番目の文字列を取り出す
+
+    Parameters
+    ----------
+    data
+    ends
+        それぞれの文字列の終わりの位置
+    i
+    """
+    start = ends[i - 1] if i > 0 else 0
+    return data[start : ends[i]].decode()
+
+
+class TranscriptTable:
+    """文字起こしの区間と単語を列ごとの配列で持つ
+    1時間の音声でも区間・単語ごとに Python のオブジェクトを作らずに済む
+    区間と単語は時刻の順に追加する前提で、時刻の範囲で二分探索できる
+
+    Attributes
+    ----------
+    segment_start
+    segment_end
+    word_start
+    word_end
+    word_probability
+    word_segment
+        単語が含まれる区間の番号
+    """
+
+    def __init__(self) -> None:
+        """init"""
+        self.segment_start = array.array("d")
+        self.segment_end = array.array("d")
+        # 文字列は UTF-8 でつなげて持ち、それぞれの終わりの位置で切り出す
+        self._segment_texts = bytearray()
+        self._segment_text_ends = array.array("I")
+        # 区間ごとの単語の終わりの位置 i 番目の区間の単語は word_ends[i-1]:word_ends[i]
+        self._word_ends = array.array("I")
+        self.word_start = array.array("d")
+        self.word_end = array.array("d")
+        self.word_probability = array.array("f")
+        self.word_segment = array.array("I")
+        self._word_texts = bytearray()
+        self._word_text_ends = array.array("I")
+
+    def __len__(self) -> int:
+        """区間の数"""
+        return len(self.segment_start)
+
+    def append(self, start: float, end: float, text: str, words: Iterable[types.Word] = ()) -> None:
+        """区間を追加する
+
+        Parameters
+        ----------
+        start
+        end
+        text
+        words
+            区間に含まれる単語
+        """
+        index = len(self.segment_start)
+        self.segment_start.append(start)
+        self.segment_end.append(end)
+        self._segment_texts += text.encode()
+        self._segment_text_ends.append(len(self._segment_texts))
+        for word in words:
+            self.word_start.append(word.start)
+            self.word_end.append(word.end)
+            self.word_probability.append(word.probability)
+            self.word_segment.append(index)
+            self._word_texts += word.text.encode()
+            self._word_text_ends.append(len(self._word_texts))
+        self._word_ends.append(len(self.word_start))
+
+    def segment(self, i: int) -> types.Transcript:
+        """i 番目の区間を返す
+
+        Parameters
+        ----------
+        i
+        """
+        text = _text(self._segment_texts, self._segment_text_ends, i)
+        return types.Transcript(self.segment_start[i], self.segment_end[i], text)
+
+    def word(self, i: int) -> types.Word:
+        """i 番目の単語を返す
+
+        Parameters
+        ----------
+        i
+        """
+        text = _text(self._word_texts, self._word_text_ends, i)
+        return types.Word(self.word_start[i], self.word_end[i], text, self.word_probability[i])
+
+    def segment_words(self, i: int) -> list[types.Word]:
+        """i 番目の区間の単語を返す
+
+        Parameters
+        ----------
+        i
+        """
+        start = self._word_ends[i - 1] if i > 0 else 0
+        return [self.word(j) for j in range(start, self._word_ends[i])]
+
+    def transcripts(self) -> list[types.Transcript]:
+        """全ての区間を types.Transcript のリストで返す"""
+        return [self.segment(i) for i in range(len(self))]
+
+    def rows(self) -> Iterator[tuple[types.Transcript, list[types.Word]]]:
+        """区間とその単語を順に返す"""
+        for i in range(len(self)):
+            yield self.segment(i), self.segment_words(i)
+
+    @staticmethod
+    def _between(starts: array.array, ends: array.array, start: float, end: float) -> range:
+        """start から end の間と重なる要素の番号の範囲を返す
+
+        Parameters
+        ----------
+        starts
+        ends
+        start
+        end
+        """
+        return range(bisect.bisect_right(ends, start), bisect.bisect_left(starts, end))
+
+    def segments_between(self, start: float, end: float) -> list[types.Transcript]:
+        """start 秒から end 秒の間と重なる区間を返す
+
+        Parameters
+        ----------
+        start
+        end
+        """
+        return [
+            self.segment(i) for i in self._between(self.segment_start, self.segment_end, start, end)
+        ]
+
+    def words_between(self, start: float, end: float) -> list[types.Word]:
+        """start 秒から end 秒の間と重なる単語を返す
+
+        Parameters
+        ----------
+        start
+        end
+        """
+        return [self.word(i) for i in self._between(self.word_start, self.word_end, start, end)]
+
+    def _columns(self) -> list[array.array]:
+        """to_bytes で書き出す数値の列を順に返す"""
+        return [
+            self.segment_start,
+            self.segment_end,
+            self._word_ends,
+            self._segment_text_ends,
+            self.word_start,
+            self.word_end,
+            self.word_probability,
+            self.word_segment,
+            self._word_text_ends,
+        ]
+
+    def to_bytes(self) -> bytes:
+        """バイト列に変換する 数値の列はそのまま、文字列は UTF-8 でつなげて書く"""
+        parts = [_HEADER.pack(_MAGIC, FORMAT_VERSION, len(self), len(self.word_start))]
+        for column in self._columns():
+            if sys.byteorder == "big":
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            parts.append(column.tobytes())
+        parts += [bytes(self._segment_texts), bytes(self._word_texts)]
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "TranscriptTable":
+        """to_bytes で変換したバイト列から戻す
+
+        Parameters
+        ----------
+        data
+        """
+        magic, version, n_segments, n_words = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"unsupported transcript format: {magic!r} {version}")
+
+        table = cls()
+        offset = _HEADER.size
+        # _columns の順に区間の列が4つ、単語の列が5つ並んでいる
+        lengths = [n_segments] * 4 + [n_words] * 5
+        for column, n in zip(table._columns(), lengths):
+            size = column.itemsize * n
+            column.frombytes(data[offset : offset + size])
+            if sys.byteorder == "big":
+                column.byteswap()
+            offset += size
+
+        segment_texts_size = table._segment_text_ends[-1] if n_segments else 0
+        table._segment_texts = bytearray(data[offset : offset + segment_texts_size])
+        table._word_texts = bytearray(data[offset + segment_texts_size :])
+        return table
@@ -30,7 +30,20 @@ class TupleMessageTool(NamedTuple):
 TupleMessage = TupleMessageUser | TupleMessageAssistant | TupleMessageSystem | TupleMessageTool
 
 
+# ストリーミングの最後に返すトークン数
+class Usage(NamedTuple):
+    prompt_tokens: int
+    completion_tokens: int
+
+
 class Transcript(NamedTuple):
     start: float
     end: float
     text: str
+
+
+class Word(NamedTuple):
+    start: float
+    end: float
+    text: str
+    probability: float
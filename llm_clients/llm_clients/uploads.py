@@ -0,0 +1,143 @@
+import dataclasses
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+
+import google.generativeai
+
+from llm_clients import cache, logger
+
+
+@dataclasses.dataclass
+class UploadStats:
+    uploads: int = 0
+    reuses: int = 0
+    bytes_uploaded: int = 0
+    bytes_saved: int = 0
+
+
+class UploadRegistry:
+    """Gemini の File API にアップロードしたファイルを中身のハッシュで管理する
+    同じ中身のファイルは有効期限が切れるまでアップロード済みのものを使い回す
+    SQLite に保存するのでプロセスをまたいで共有される
+
+    Attributes
+    ----------
+    path
+    margin
+        有効期限までの残り秒数がこれを下回ったら再アップロードする
+    stats
+        アップロード・再利用の回数とバイト数
+    """
+
+    def __init__(self, path: str | None = None, margin: float = 60 * 60) -> None:
+        """init
+
+        Parameters
+        ----------
+        path
+            SQLite のファイルのパス None の場合は cache.CACHE_DIR 以下に作る
+        margin
+        """
+        self.path = path if path is not None else os.path.join(cache.CACHE_DIR, "uploads.sqlite3")
+        self.margin = margin
+        self.stats = UploadStats()
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "key TEXT PRIMARY KEY, file BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        """スレッド・プロセスごとのコネクションを返す"""
+        pid, conn = getattr(self._local, "conn", (None, None))
+        if conn is None or pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = (os.getpid(), conn)
+        return conn
+
+    @staticmethod
+    def _key(path: str, api_key: str) -> str:
+        """ファイルの中身と APIキーからキーを作る
+        アップロードしたファイルは APIキーごとに見え方が違うので APIキーのハッシュも含める
+
+        Parameters
+        ----------
+        path
+        api_key
+        """
+        api_key_digest = hashlib.sha256(api_key.encode()).hexdigest()
+        return f"{api_key_digest}:{cache.file_digest(path)}"
+
+    def upload(
+        self,
+        path: str,
+        api_key: str,
+        upload_file: Callable[[str], google.generativeai.types.File],
+    ) -> google.generativeai.types.File:
+        """アップロード済みで有効期限内ならそのファイルを、そうでなければアップロードして返す
+
+        Parameters
+        ----------
+        path
+        api_key
+        upload_file
+            パスを受け取って実際にアップロードする関数
+        """
+        key = self._key(path, api_key)
+        size = os.path.getsize(path)
+        conn = self._connect()
+
+        row = conn.execute("SELECT file, expires_at FROM files WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[1] - self.margin > time.time():
+            with self._stats_lock:
+                self.stats.reuses += 1
+                self.stats.bytes_saved += size
+            return google.generativeai.types.File(
+                google.generativeai.protos.File.deserialize(row[0])
+            )
+
+        logger.logger.debug(f"upload {path}")
+        file = upload_file(path)
+        conn.execute(
+            "INSERT OR REPLACE INTO files (key, file, expires_at) VALUES (?, ?, ?)",
+            (
+                key,
+                google.generativeai.protos.File.serialize(file.to_proto()),
+                file.expiration_time.timestamp(),
+            ),
+        )
+        with self._stats_lock:
+            self.stats.uploads += 1
+            self.stats.bytes_uploaded += size
+        return file
+
+    def invalidate(self, path: str, api_key: str) -> None:
+        """サーバー側で消えていたファイルを次回アップロードし直すように記録を消す
+
+        Parameters
+        ----------
+        path
+        api_key
+        """
+        self._connect().execute("DELETE FROM files WHERE key = ?", (self._key(path, api_key),))
+
+
+_default_registry: UploadRegistry | None = None
+_default_registry_lock = threading.Lock()
+
+
+def default_registry() -> UploadRegistry:
+    """Gemini クライアントが標準で使う UploadRegistry を返す 初回呼び出し時に作られる"""
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = UploadRegistry()
+        return _default_registry
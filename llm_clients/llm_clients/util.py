@@ -1,18 +1,18 @@
-import os
+from llm_clients import separation
 
-import demucs.separate
 
-
-def vocal_extract(audio_path: str, dirname: str) -> str:
+def vocal_extract(
+    audio_path: str, dirname: str, separator: separation.VocalSeparator | None = None
+) -> str:
     """ボーカル抽出してファイルのパスを返す
 
     audio_path
         ボーカル抽出したい音声ファイルのパス
     dirname
-        ボーカルのファイルを置きたいパス {dirname}/htdemucs/ 以下に作られる
+        ボーカルのファイルを置きたいパス {dirname}/htdemucs/{音声の中身のハッシュなどから作ったキー}/ に作られる
+    separator
+        None の場合は separation.default_separator() を使い、モデルをプロセス内で使い回す
     """
-    audio_fname, _ = os.path.splitext(os.path.basename(audio_path))
-    vocal_path = f"{dirname}/htdemucs/{audio_fname}/vocals.wav"
-    if not os.path.exists(vocal_path):
-        demucs.separate.main(["--two-stems", "vocals", audio_path, "-o", dirname])
-    return vocal_path
+    if separator is None:
+        separator = separation.default_separator()
+    return separator.extract([audio_path], dirname)[0]
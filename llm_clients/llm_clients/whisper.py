@@ -1,18 +1,48 @@
+import array
+import concurrent.futures
 import dataclasses
+import hashlib
+import json
 import os
 import re
+import threading
+import time
+from collections.abc import Callable, Iterator
+from typing import TYPE_CHECKING, Any
 
-import faster_whisper
-import faster_whisper.audio
-import faster_whisper.tokenizer
-import faster_whisper.vad
-import pydub
-import streamlit
+from llm_clients import (
+    audio_store,
+    cache,
+    ledger,
+    logger,
+    media,
+    transcript,
+    types,
+    whisper_models,
+)
 
-from llm_clients import logger, types
+if TYPE_CHECKING:
+    import faster_whisper.tokenizer
+    import numpy
+
+# faster_whisper と pydub は import が重いので、使うときに関数の中で import する
 
 SAMPLE_RATE = 16_000
 
+# 正規表現ごとの抑制するトークンの一覧の保存先
+SUPPRESS_TOKENS_DIR = os.path.join(cache.CACHE_DIR, "whisper", "suppress_tokens")
+# split_in_memory=False のときにVADで分割した音声の保存先 音声の中身のハッシュごとにディレクトリを分ける
+SEGMENTS_DIR = os.path.join(cache.CACHE_DIR, "whisper", "segments")
+
+# WhisperModel.transcribe に渡すオプション キャッシュのキーにも含める
+TRANSCRIBE_OPTIONS: dict[str, Any] = {
+    "temperature": 0,
+    "beam_size": 10,
+    "word_timestamps": True,
+    "condition_on_previous_text": False,
+    "no_repeat_ngram_size": 10,
+}
+
 
 @dataclasses.dataclass
 class SplittedFile:
@@ -21,46 +51,278 @@ class SplittedFile:
     end: float
 
 
-@streamlit.cache_resource(show_spinner=False)
-def _vad_split(audio_path: str, vocal_path: str) -> list[SplittedFile]:
-    """VADフィルターを実行し、分割した秒数とファイル名を返す
-    キャッシュがある場合はキャッシュを返す
+# audio は元の音声を SAMPLE_RATE で読み込んだ配列の一部分で、コピーせずに参照している
+@dataclasses.dataclass
+class SplittedAudio:
+    audio: "numpy.ndarray"
+    start: float
+    end: float
+
+
+def _vad_options() -> str:
+    """VADフィルターのオプションをキャッシュのキー用の文字列で返す"""
+    import faster_whisper.vad
+
+    return repr(faster_whisper.vad.VadOptions())
+
+
+def _cache_key(kind: str, **values: Any) -> str:
+    """文字起こしやVADの結果のキャッシュのキーを作る
+
+    Parameters
+    ----------
+    kind
+    values
+        結果が変わる値 ファイルは中身のハッシュで渡す
+    """
+    payload = json.dumps(
+        {"kind": kind, **values}, ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _speech_timestamps(
+    vocal_path: str, store: audio_store.AudioStore, results: cache.ResponseCache
+) -> list[tuple[int, int]]:
+    """VADフィルターを実行し、声がある区間の最初と最後のサンプルの位置を返す
+    結果は音声の中身とVADのオプションをキーに results に保存する
 
     Parameters
     ----------
-    audio_path
     vocal_path
+    store
+    results
     """
-    dir_path, _ = os.path.splitext(audio_path)
-    if not os.path.isdir(dir_path):
-        os.makedirs(dir_path)
+    import faster_whisper.vad
 
-    timestamps = faster_whisper.vad.get_speech_timestamps(
-        faster_whisper.audio.decode_audio(vocal_path, sampling_rate=SAMPLE_RATE),  # pyright: ignore
-        vad_options=faster_whisper.vad.VadOptions(),
+    key = _cache_key(
+        "vad",
+        vocal=cache.file_digest(vocal_path),
+        sample_rate=SAMPLE_RATE,
+        vad_options=_vad_options(),
     )
+    value = results.get(key)
+    if value is not None:
+        return [(start, end) for start, end in json.loads(value)]
 
-    audio: pydub.AudioSegment = pydub.AudioSegment.from_file(audio_path)
-    ret: list[SplittedFile] = []
+    timestamps = faster_whisper.vad.get_speech_timestamps(
+        store.load(vocal_path, SAMPLE_RATE), vad_options=faster_whisper.vad.VadOptions()
+    )
     for t in timestamps:
         logger.logger.debug(f"split: {t['start']} -> {t['end']}")
-        start = t["start"] / SAMPLE_RATE
-        end = t["end"] / SAMPLE_RATE
+    ret = [(t["start"], t["end"]) for t in timestamps]
+    results.set(key, json.dumps(ret).encode())
+    return ret
+
+
+def _vad_split_in_memory(
+    audio_path: str,
+    vocal_path: str,
+    store: audio_store.AudioStore,
+    results: cache.ResponseCache,
+) -> list[SplittedAudio]:
+    """VADフィルターを実行し、分割した秒数と音声を返す
+    音声は store から読み、ファイルに書き出さずに区間の部分をそのまま返す
+
+    Parameters
+    ----------
+    audio_path
+    vocal_path
+    store
+    results
+    """
+    audio = store.load(audio_path, SAMPLE_RATE)
+    return [
+        SplittedAudio(audio=audio[start:end], start=start / SAMPLE_RATE, end=end / SAMPLE_RATE)
+        for start, end in _speech_timestamps(vocal_path, store, results)
+    ]
+
+
+def _vad_split(
+    audio_path: str,
+    vocal_path: str,
+    store: audio_store.AudioStore,
+    results: cache.ResponseCache,
+) -> list[SplittedFile]:
+    """VADフィルターを実行し、分割した秒数とファイル名を返す
+    分割した音声は SEGMENTS_DIR の音声の中身のハッシュのディレクトリに書き出し、あれば使い回す
+
+    Parameters
+    ----------
+    audio_path
+    vocal_path
+    store
+    results
+    """
+    import pydub
+
+    dir_path = os.path.join(SEGMENTS_DIR, cache.file_digest(audio_path))
+    os.makedirs(dir_path, exist_ok=True)
+
+    audio: pydub.AudioSegment | None = None
+    ret: list[SplittedFile] = []
+    for t_start, t_end in _speech_timestamps(vocal_path, store, results):
+        start = t_start / SAMPLE_RATE
+        end = t_end / SAMPLE_RATE
         fname = f"{dir_path}/{start}-{end}.mp3"
 
-        splitted_audio = audio[start * 1000 : end * 1000]
-        splitted_audio.export(fname, "mp3")  # pyright: ignore
+        if not os.path.exists(fname):
+            if audio is None:
+                audio = pydub.AudioSegment.from_file(audio_path)
+            splitted_audio = audio[start * 1000 : end * 1000]
+            # 同時に書き出しても壊れたファイルを読まないように一時ファイルから置き換える
+            tmp_path = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+            splitted_audio.export(tmp_path, "mp3")  # pyright: ignore
+            os.replace(tmp_path, fname)
         ret.append(SplittedFile(fname=fname, start=start, end=end))
 
     return ret
 
 
-@streamlit.cache_resource(show_spinner=False)
-def _transcribe(
-    audio_path: str, vocal_path: str, regex: str, model_name: str, use_vad: bool
-) -> list[types.Transcript]:
-    """Whisper を実行する
-    キャッシュがある場合はキャッシュを返す
+# (正規表現, モデル名) ごとの抑制するトークンの一覧
+_suppress_tokens_cache: dict[tuple[str, str], list[int]] = {}
+_suppress_tokens_lock = threading.Lock()
+
+
+def _build_suppress_tokens(
+    tokenizer: "faster_whisper.tokenizer.Tokenizer", pattern: re.Pattern[str]
+) -> list[int]:
+    """正規表現にあう文字を1文字も含まないトークンの一覧を作る
+
+    Parameters
+    ----------
+    tokenizer
+    pattern
+    """
+    # 語彙は5万ほどあるが文字の種類は少ないので、文字ごとに判定を使い回す
+    matches: dict[str, bool] = {}
+
+    def match(text: str) -> bool:
+        for c in text:
+            matched = matches.get(c)
+            if matched is None:
+                matched = matches[c] = pattern.fullmatch(c) is not None
+            if matched:
+                return True
+        return False
+
+    texts = tokenizer.tokenizer.decode_batch([[i] for i in range(tokenizer.eot)])
+    return [-1] + [i for i, text in enumerate(texts) if not match(text)] + [50363, 50364]
+
+
+def _suppress_tokens(
+    tokenizer: "faster_whisper.tokenizer.Tokenizer", regex: str, model_name: str
+) -> list[int]:
+    """抑制するトークンの一覧を返す
+    プロセス内では (regex, model_name) ごとに1回だけ作り、SUPPRESS_TOKENS_DIR にも保存して他のプロセスと使い回す
+    保存したファイルは語彙の中身のハッシュで区別するので、同じモデル名で語彙が変わっても取り違えない
+
+    Parameters
+    ----------
+    tokenizer
+    regex
+    model_name
+    """
+    key = (regex, model_name)
+    with _suppress_tokens_lock:
+        tokens = _suppress_tokens_cache.get(key)
+    if tokens is not None:
+        return tokens
+
+    vocab_digest = hashlib.sha256(tokenizer.tokenizer.to_str().encode()).hexdigest()
+    digest = hashlib.sha256(f"{vocab_digest}\0{regex}".encode()).hexdigest()
+    path = os.path.join(SUPPRESS_TOKENS_DIR, f"{digest}.bin")
+    values = array.array("i")
+    try:
+        with open(path, "rb") as f:
+            values.frombytes(f.read())
+        tokens = values.tolist()
+        logger.logger.debug(f"load suppress tokens: {path}")
+    except (FileNotFoundError, ValueError):
+        tokens = _build_suppress_tokens(tokenizer, re.compile(regex))
+        values.extend(tokens)
+        os.makedirs(SUPPRESS_TOKENS_DIR, exist_ok=True)
+        # 途中で落ちても壊れたファイルが残らないように一時ファイルから置き換える
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(values.tobytes())
+        os.replace(tmp_path, path)
+
+    with _suppress_tokens_lock:
+        _suppress_tokens_cache[key] = tokens
+    return tokens
+
+
+# 終わった区間の数と区間の数を受け取る進捗のコールバック
+Progress = Callable[[int, int], None]
+
+
+def streamlit_progress() -> Progress:
+    """streamlit のプログレスバーに進捗を表示するコールバックを返す 終わったらバーを消す"""
+    import streamlit
+
+    progress_bar = streamlit.progress(0)
+
+    def progress(done: int, total: int) -> None:
+        if done >= total:
+            progress_bar.empty()
+        else:
+            progress_bar.progress(done / total)
+
+    return progress
+
+
+def _transcript_key(
+    audio_path: str,
+    vocal_path: str,
+    regex: str,
+    model_config: whisper_models.WhisperModelConfig,
+    use_vad: bool,
+    split_in_memory: bool,
+) -> str:
+    """文字起こしの結果のキャッシュのキーを作る
+    ファイルはパスではなく中身のハッシュで表し、結果が変わるオプションを全て含める
+    スレッド数など結果が変わらない設定は含めない
+
+    Parameters
+    ----------
+    audio_path
+    vocal_path
+    regex
+    model_config
+    use_vad
+    split_in_memory
+    """
+    return _cache_key(
+        "transcript",
+        audio=cache.file_digest(audio_path),
+        vocal=cache.file_digest(vocal_path) if use_vad else None,
+        regex=regex,
+        model_name=model_config.model_name,
+        compute_type=model_config.compute_type,
+        use_vad=use_vad,
+        vad_options=_vad_options() if use_vad else None,
+        split_in_memory=split_in_memory,
+        transcribe_options=TRANSCRIBE_OPTIONS,
+        format=transcript.FORMAT_VERSION,
+    )
+
+
+def _transcribe_stream(
+    audio_path: str,
+    vocal_path: str,
+    regex: str,
+    model_config: whisper_models.WhisperModelConfig,
+    use_vad: bool,
+    split_in_memory: bool,
+    model_registry: whisper_models.WhisperModelRegistry,
+    store: audio_store.AudioStore,
+    results: cache.ResponseCache,
+    progress: Progress | None,
+) -> Iterator[tuple[types.Transcript, list[types.Word]]]:
+    """Whisper を実行し、文字起こしの区間とその単語を時刻の順に返す
+    VADで分割した区間は model_config.num_workers 個のスレッドで並列に文字起こしし、
+    先頭から続けて終わった区間の分から返す
 
     Parameters
     ----------
@@ -68,83 +330,394 @@ def _transcribe(
     vocal_path
     regex
         正規表現 Whisper から生成される文字を制限する
-    model_name
+    model_config
     use_vad
         VADフィルターを使うかどうか
+    split_in_memory
+        VADで分割した音声をファイルに書き出さずにメモリ上で渡すかどうか
+    model_registry
+        読み込み済みのモデルを使い回すための置き場所
+    store
+        デコードした音声を使い回すための置き場所
+    results
+        VADの結果のキャッシュ
+    progress
+        終わった区間の数と区間の数を受け取るコールバック
     """
-    progress_bar = streamlit.progress(0)
+    import faster_whisper.tokenizer
 
-    model = faster_whisper.WhisperModel(model_name, compute_type="float32")
+    model = model_registry.get(model_config)
     tokenizer = faster_whisper.tokenizer.Tokenizer(
         model.hf_tokenizer, multilingual=True, task="transcribe", language="ja"
     )
 
     pattern = re.compile(regex)
-    tokens = (
-        [-1]
-        + [
-            i
-            for i in range(tokenizer.eot)
-            if not any(pattern.fullmatch(c) for c in tokenizer.decode([i]))
-        ]
-        + [50363, 50364]
-    )
+    tokens = _suppress_tokens(tokenizer, regex, model_config.model_name)
+    started = time.perf_counter()
 
-    transcipts: list[types.Transcript] = []
-
-    def transcribe(fname: str, start: float = 0.0):
-        segments, _ = model.transcribe(
-            fname,
-            temperature=0,
-            beam_size=10,
-            suppress_tokens=tokens,
-            word_timestamps=True,
-            condition_on_previous_text=False,
-            no_repeat_ngram_size=10,
-        )
+    def transcribe(
+        audio: "str | numpy.ndarray", start: float = 0.0
+    ) -> Iterator[tuple[types.Transcript, list[types.Word]]]:
+        # faster_whisper の segments は遅延評価なので、区間が終わるたびに返す
+        segments, _ = model.transcribe(audio, suppress_tokens=tokens, **TRANSCRIBE_OPTIONS)
 
         for segment in segments:
-            transcipts.append(
+            yield (
                 types.Transcript(
                     start=round(segment.start + start, 3),
                     end=round(segment.end + start, 3),
                     text="".join(pattern.findall(segment.text.strip())),
-                )
+                ),
+                [
+                    types.Word(
+                        start=round(word.start + start, 3),
+                        end=round(word.end + start, 3),
+                        text=word.word,
+                        probability=word.probability,
+                    )
+                    for word in segment.words or ()
+                ],
             )
 
     if use_vad:
-        splitted_files = _vad_split(audio_path, vocal_path)
-        for i, f in enumerate(splitted_files):
-            transcribe(f.fname, f.start)
-            progress_bar.progress((i + 1) / len(splitted_files))
-        progress_bar.empty()
+        splitted: list[tuple["str | numpy.ndarray", float]]
+        if split_in_memory:
+            splitted = [
+                (a.audio, a.start)
+                for a in _vad_split_in_memory(audio_path, vocal_path, store, results)
+            ]
+        else:
+            splitted = [
+                (f.fname, f.start) for f in _vad_split(audio_path, vocal_path, store, results)
+            ]
+        # モデルは num_workers 個まで同時に実行できる 区間ごとに独立して文字起こしするので結果は順番によらない
+        executor = concurrent.futures.ThreadPoolExecutor(max(model_config.num_workers, 1))
+        try:
+            # スレッドの中で最後まで文字起こしするように list にする
+            futures = [
+                executor.submit(lambda audio, start: list(transcribe(audio, start)), audio, start)
+                for audio, start in splitted
+            ]
+            for i, future in enumerate(futures):
+                yield from future.result()
+                if progress is not None:
+                    progress(i + 1, len(futures))
+        finally:
+            # 途中で受け取るのをやめた場合は、まだ始まっていない区間は実行しない
+            executor.shutdown(wait=False, cancel_futures=True)
 
     else:
-        transcribe(audio_path)
+        yield from transcribe(store.load(audio_path, SAMPLE_RATE))
+        if progress is not None:
+            progress(1, 1)
+
+    elapsed = time.perf_counter() - started
+    audio_seconds = media.duration(audio_path)
+    logger.logger.info(
+        f"transcribe {audio_path}: {audio_seconds:.1f}s audio in {elapsed:.1f}s "
+        f"(RTF {elapsed / max(audio_seconds, 1e-9):.3f}, {model_config.num_workers} workers)"
+    )
+
+
+_default_transcript_cache: cache.ResponseCache | None = None
+_default_transcript_cache_lock = threading.Lock()
+
+
+def default_transcript_cache() -> cache.ResponseCache:
+    """Whisper が標準で使う文字起こしのキャッシュを返す 初回呼び出し時に作られる
+    Whisper を実行し直すのは重いので、期限なしで保存する
+    """
+    global _default_transcript_cache
+    with _default_transcript_cache_lock:
+        if _default_transcript_cache is None:
+            _default_transcript_cache = cache.SQLiteCache(
+                os.path.join(cache.CACHE_DIR, "transcripts.sqlite3"), ttl=None
+            )
+        return _default_transcript_cache
+
+
+def set_default_transcript_cache(backend: cache.ResponseCache) -> None:
+    """Whisper が標準で使う文字起こしのキャッシュを差し替える
+
+    Parameters
+    ----------
+    backend
+    """
+    global _default_transcript_cache
+    with _default_transcript_cache_lock:
+        _default_transcript_cache = backend
+
+
+def speech_timestamps(
+    audio_path: str,
+    decoded_audio: audio_store.AudioStore | None = None,
+    results: cache.ResponseCache | None = None,
+) -> list[tuple[float, float]]:
+    """VADフィルターを実行し、声がある区間の最初と最後の秒を返す
+    結果は音声の中身とVADのオプションをキーに保存し、同じ音声では再び実行しない
 
-    return transcipts
+    Parameters
+    ----------
+    audio_path
+    decoded_audio
+        None の場合は audio_store.default_store() を使う
+    results
+        None の場合は default_transcript_cache() を使う
+    """
+    store = decoded_audio if decoded_audio is not None else audio_store.default_store()
+    results = results if results is not None else default_transcript_cache()
+    return [
+        (start / SAMPLE_RATE, end / SAMPLE_RATE)
+        for start, end in _speech_timestamps(audio_path, store, results)
+    ]
 
 
 class Whisper:
     """Whisper client
+    モデルは model_registry に読み込んだものを使い回すので、2回目以降は読み込み直さない
 
     Attributes
     ----------
     regex
+    compute_type
+    device
+    cpu_threads
+    num_workers
+    model_registry
+    decoded_audio
+    transcript_cache
+    usage_ledger
     """
 
-    def __init__(self, regex: str = "[a-zA-Zぁ-んァ-ン！？ ]+"):
+    def __init__(
+        self,
+        regex: str = "[a-zA-Zぁ-んァ-ン！？ ]+",
+        compute_type: whisper_models.ComputeType = "float32",
+        device: str = "auto",
+        cpu_threads: int = 0,
+        num_workers: int = 1,
+        model_registry: whisper_models.WhisperModelRegistry | None = None,
+        decoded_audio: audio_store.AudioStore | None = None,
+        transcript_cache: cache.ResponseCache | None = None,
+        usage_ledger: ledger.Ledger | None = None,
+        preload_models: tuple[str, ...] = (),
+    ):
         """init
 
         Parameters
         ----------
         regex
             正規表現 Whisper から生成される文字を制限する
+        compute_type
+            CPU では int8 か int8_float32 にすると、メモリが減り速くなる
+        device
+        cpu_threads
+            CPU で使うスレッド数 0 の場合は CTranslate2 の標準の値を使う
+        num_workers
+            1つのモデルを同時に実行できる数 VADで分割した区間をこの数のスレッドで並列に文字起こしする
+            cpu_threads はスレッドごとの数なので、合計がコア数を超えないようにする
+        model_registry
+            None の場合は whisper_models.default_registry() を使う
+        decoded_audio
+            デコードした音声の置き場所 None の場合は audio_store.default_store() を使う
+        transcript_cache
+            文字起こしとVADの結果のキャッシュ None の場合は default_transcript_cache() を使う
+        usage_ledger
+            文字起こしした音声の秒数とかかった時間の記録 None の場合は ledger.default_ledger() を使う
+            文字起こしした場合は latency / media_seconds が実時間比 (RTF) になる
+        preload_models
+            別スレッドで読み込みを始めておくモデル名
         """
         self.regex = regex
+        self.compute_type: whisper_models.ComputeType = compute_type
+        self.device = device
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        self.model_registry = (
+            model_registry if model_registry is not None else whisper_models.default_registry()
+        )
+        self.decoded_audio = (
+            decoded_audio if decoded_audio is not None else audio_store.default_store()
+        )
+        self.transcript_cache = (
+            transcript_cache if transcript_cache is not None else default_transcript_cache()
+        )
+        self.usage_ledger = usage_ledger if usage_ledger is not None else ledger.default_ledger()
+        if preload_models:
+            self.preload(*preload_models)
+
+    def model_config(self, model_name: str) -> whisper_models.WhisperModelConfig:
+        """このクライアントの設定で model_name のモデルを読み込むときの設定を返す
+
+        Parameters
+        ----------
+        model_name
+        """
+        return whisper_models.WhisperModelConfig(
+            model_name=model_name,
+            compute_type=self.compute_type,
+            device=self.device,
+            cpu_threads=self.cpu_threads,
+            num_workers=self.num_workers,
+        )
+
+    def preload(self, *model_names: str) -> None:
+        """モデルを別スレッドで読み込み始める 最初の transcribe を待たずに済む
+
+        Parameters
+        ----------
+        model_names
+            指定しない場合は large-v2
+        """
+        self.model_registry.preload(self.model_config(m) for m in model_names or ("large-v2",))
+
+    def _stream(
+        self,
+        audio_path: str,
+        vocal_path: str,
+        model_name: str,
+        use_vad: bool,
+        split_in_memory: bool,
+        progress: Progress | None,
+    ) -> Iterator[tuple[types.Transcript, list[types.Word]]]:
+        """文字起こしの区間とその単語を時刻の順に、区間が終わるたびに返す
+        最後まで受け取った場合は結果を transcript_cache に保存し、次からは Whisper を実行せずに返す
+        キャッシュのキーは音声の中身のハッシュなので、同じパスのファイルを置き換えても古い結果は返さない
+
+        Parameters
+        ----------
+        audio_path
+        vocal_path
+        model_name
+        use_vad
+        split_in_memory
+        progress
+        """
+        model_config = self.model_config(model_name)
+        with ledger.track(self.usage_ledger, "whisper", model_name, bind_record=False) as record:
+            key = _transcript_key(
+                audio_path, vocal_path, self.regex, model_config, use_vad, split_in_memory
+            )
+            value = self.transcript_cache.get(key)
+            if value is not None:
+                if progress is not None:
+                    progress(1, 1)
+                yield from transcript.TranscriptTable.from_bytes(value).rows()
+                return
+
+            record.cache_hit = False
+            record.media_seconds = media.duration(audio_path)
+            table = transcript.TranscriptTable()
+            for segment, words in _transcribe_stream(
+                audio_path,
+                vocal_path,
+                self.regex,
+                model_config,
+                use_vad,
+                split_in_memory,
+                self.model_registry,
+                self.decoded_audio,
+                self.transcript_cache,
+                progress,
+            ):
+                table.append(segment.start, segment.end, segment.text, words)
+                yield segment, words
+            self.transcript_cache.set(key, table.to_bytes())
+
+    def transcribe_stream(
+        self,
+        audio_path: str,
+        vocal_path: str,
+        model_name: str = "large-v2",
+        use_vad: bool = True,
+        split_in_memory: bool = True,
+        progress: Progress | None = None,
+    ) -> Iterator[types.Transcript]:
+        """文字起こしの結果を時刻の順に、区間が終わるたびに返す
+        最後まで受け取った場合は結果をキャッシュし、次からはキャッシュを返す
+
+        Parameters
+        ----------
+        audio_path
+        vocal_path
+        model_name
+        use_vad
+            VADフィルターを使うかどうか
+        split_in_memory
+            VADで分割した音声をメモリ上で Whisper に渡すかどうか
+            False の場合は以前と同じく区間ごとに mp3 に書き出して読み込み直す
+        progress
+            終わった区間の数と区間の数を受け取るコールバック
+            streamlit で表示する場合は streamlit_progress() を渡す
+        """
+        for segment, _ in self._stream(
+            audio_path, vocal_path, model_name, use_vad, split_in_memory, progress
+        ):
+            yield segment
+
+    def transcribe_words_stream(
+        self,
+        audio_path: str,
+        vocal_path: str,
+        model_name: str = "large-v2",
+        use_vad: bool = True,
+        split_in_memory: bool = True,
+        progress: Progress | None = None,
+    ) -> Iterator[tuple[types.Transcript, list[types.Word]]]:
+        """文字起こしの区間とその単語のタイムスタンプを、区間が終わるたびに返す
+
+        Parameters
+        ----------
+        audio_path
+        vocal_path
+        model_name
+        use_vad
+            VADフィルターを使うかどうか
+        split_in_memory
+            VADで分割した音声をメモリ上で Whisper に渡すかどうか
+        progress
+            終わった区間の数と区間の数を受け取るコールバック
+        """
+        return self._stream(audio_path, vocal_path, model_name, use_vad, split_in_memory, progress)
+
+    def transcribe_table(
+        self,
+        audio_path: str,
+        vocal_path: str,
+        model_name: str = "large-v2",
+        use_vad: bool = True,
+        split_in_memory: bool = True,
+        progress: Progress | None = None,
+    ) -> transcript.TranscriptTable:
+        """区間と単語のタイムスタンプを列ごとの配列で返す
+
+        Parameters
+        ----------
+        audio_path
+        vocal_path
+        model_name
+        use_vad
+            VADフィルターを使うかどうか
+        split_in_memory
+            VADで分割した音声をメモリ上で Whisper に渡すかどうか
+        progress
+            終わった区間の数と区間の数を受け取るコールバック
+        """
+        table = transcript.TranscriptTable()
+        for segment, words in self._stream(
+            audio_path, vocal_path, model_name, use_vad, split_in_memory, progress
+        ):
+            table.append(segment.start, segment.end, segment.text, words)
+        return table
 
     def transcribe(
-        self, audio_path: str, vocal_path: str, model_name: str = "large-v2", use_vad: bool = True
+        self,
+        audio_path: str,
+        vocal_path: str,
+        model_name: str = "large-v2",
+        use_vad: bool = True,
+        split_in_memory: bool = True,
+        progress: Progress | None = None,
     ) -> list[types.Transcript]:
         """run
 
@@ -155,5 +728,13 @@ class Whisper:
         model_name
         use_vad
             VADフィルターを使うかどうか
+        split_in_memory
+            VADで分割した音声をメモリ上で Whisper に渡すかどうか
+        progress
+            終わった区間の数と区間の数を受け取るコールバック
         """
-        return _transcribe(audio_path, vocal_path, self.regex, model_name, use_vad)
+        return list(
+            self.transcribe_stream(
+                audio_path, vocal_path, model_name, use_vad, split_in_memory, progress
+            )
+        )
@@ -0,0 +1,191 @@
+import concurrent.futures
+import dataclasses
+import os
+import threading
+from collections.abc import Iterable
+from typing import TYPE_CHECKING, Literal
+
+from llm_clients import logger
+
+if TYPE_CHECKING:
+    import faster_whisper
+
+# faster_whisper は import が重いので、モデルを読み込むときに関数の中で import する
+
+# CPU では float32 が一番遅い int8 系にすると重みが 1/4 になり、速度もおおむね上がる
+ComputeType = Literal[
+    "default", "auto", "float32", "float16", "bfloat16", "int8", "int8_float32", "int8_float16"
+]
+
+
+@dataclasses.dataclass(frozen=True)
+class WhisperModelConfig:
+    model_name: str = "large-v2"
+    compute_type: ComputeType = "float32"
+    device: str = "auto"
+    cpu_threads: int = 0
+    num_workers: int = 1
+
+
+def _load(config: WhisperModelConfig) -> "faster_whisper.WhisperModel":
+    """モデルを読み込む
+
+    Parameters
+    ----------
+    config
+    """
+    import faster_whisper
+
+    logger.logger.debug(f"load whisper model: {config}")
+    return faster_whisper.WhisperModel(
+        config.model_name,
+        device=config.device,
+        compute_type=config.compute_type,
+        cpu_threads=config.cpu_threads,
+        num_workers=config.num_workers,
+    )
+
+
+class WhisperModelRegistry:
+    """WhisperModelConfig ごとにモデルを1回だけ読み込み、プロセス内で使い回す
+    同じ設定のモデルを同時に要求された場合は、先に始めた読み込みを待つ
+    """
+
+    def __init__(self) -> None:
+        """init"""
+        self._models: dict[
+            WhisperModelConfig, concurrent.futures.Future["faster_whisper.WhisperModel"]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def _future(
+        self, config: WhisperModelConfig, background: bool
+    ) -> concurrent.futures.Future["faster_whisper.WhisperModel"]:
+        """config のモデルの Future を返す 読み込みが始まっていなければ始める
+
+        Parameters
+        ----------
+        config
+        background
+            True の場合は別スレッドで読み込む False の場合は呼び出したスレッドで読み込む
+        """
+        with self._lock:
+            future = self._models.get(config)
+            if future is not None:
+                return future
+            future = concurrent.futures.Future()
+            self._models[config] = future
+
+        def load() -> None:
+            try:
+                model = _load(config)
+            except BaseException as e:
+                # 失敗した場合は次の呼び出しで読み込み直す
+                with self._lock:
+                    self._models.pop(config, None)
+                future.set_exception(e)
+            else:
+                future.set_result(model)
+
+        if background:
+            threading.Thread(target=load, name=f"whisper-preload-{config.model_name}").start()
+        else:
+            load()
+        return future
+
+    def get(self, config: WhisperModelConfig) -> "faster_whisper.WhisperModel":
+        """モデルを返す 読み込んでいなければ読み込む
+
+        Parameters
+        ----------
+        config
+        """
+        return self._future(config, background=False).result()
+
+    def preload(
+        self, configs: WhisperModelConfig | Iterable[WhisperModelConfig]
+    ) -> list[concurrent.futures.Future["faster_whisper.WhisperModel"]]:
+        """モデルを別スレッドで読み込み始める 読み込み済みのモデルはそのまま使う
+
+        Parameters
+        ----------
+        configs
+        """
+        if isinstance(configs, WhisperModelConfig):
+            configs = [configs]
+        return [self._future(config, background=True) for config in configs]
+
+    def loaded(self) -> list[WhisperModelConfig]:
+        """読み込みが終わったモデルの設定を返す"""
+        with self._lock:
+            return [
+                config
+                for config, future in self._models.items()
+                if future.done() and future.exception() is None
+            ]
+
+    def unload(self, config: WhisperModelConfig | None = None) -> None:
+        """モデルを破棄する 使用中のモデルは使い終わった時点でメモリから消える
+
+        Parameters
+        ----------
+        config
+            None の場合は全て破棄する
+        """
+        with self._lock:
+            if config is None:
+                self._models.clear()
+            else:
+                self._models.pop(config, None)
+
+
+# 環境変数でモデル名を指定すると、標準の WhisperModelRegistry を作るときに読み込みを始める
+# 例: LLM_CLIENTS_WHISPER_PRELOAD=large-v2:int8,medium
+PRELOAD = os.environ.get("LLM_CLIENTS_WHISPER_PRELOAD", "")
+
+
+def _parse_preload(value: str) -> list[WhisperModelConfig]:
+    """LLM_CLIENTS_WHISPER_PRELOAD の値を WhisperModelConfig のリストにする
+
+    Parameters
+    ----------
+    value
+        "モデル名[:compute_type]" のカンマ区切り
+    """
+    configs: list[WhisperModelConfig] = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model_name, _, compute_type = item.partition(":")
+        if compute_type:
+            configs.append(WhisperModelConfig(model_name, compute_type))  # pyright: ignore
+        else:
+            configs.append(WhisperModelConfig(model_name))
+    return configs
+
+
+_default_registry: WhisperModelRegistry | None = None
+_default_registry_lock = threading.Lock()
+
+
+def default_registry() -> WhisperModelRegistry:
+    """Whisper が標準で使う WhisperModelRegistry を返す 初回呼び出し時に作られる"""
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = WhisperModelRegistry()
+            _default_registry.preload(_parse_preload(PRELOAD))
+        return _default_registry
+
+
+def set_default_registry(registry: WhisperModelRegistry) -> None:
+    """Whisper が標準で使う WhisperModelRegistry を差し替える
+
+    Parameters
+    ----------
+    registry
+    """
+    global _default_registry
+    with _default_registry_lock:
+        _default_registry = registry
@@ -1,6 +1,8 @@
 import math
 import re
 
+import llm_clients.ledger
+import llm_clients.separation_queue
 import llm_clients.types
 import streamlit
 
@@ -74,7 +76,7 @@ def write_srt(lyrics_list: list[types.Lyrics], prev_lyrics_list: list[types.Lyri
     streamlit.write(texts_str, unsafe_allow_html=True)
 
 
-def _display(content_id: str, lyrics: str, use_vocal: bool):
+def _display(content_id: str, lyrics: str, use_vocal: bool, use_windows: bool = False):
     """結果の表示
 
     Parameters
@@ -83,7 +85,11 @@ def _display(content_id: str, lyrics: str, use_vocal: bool):
     lyrics
     use_vocal
         ボーカル抽出した音声ファイルを入力するかどうか
+    use_windows
+        曲を区間に分けて位置合わせした結果を表示するかどうか
     """
+    # 設定ごとに結果を分けて持つ
+    key = f"{content_id}_{use_vocal}_{use_windows}"
     i = 0
     lyrics_list: list[types.Lyrics] = []
     for lyric in lyrics.split("\n"):
@@ -95,31 +101,27 @@ def _display(content_id: str, lyrics: str, use_vocal: bool):
     output, alignment, fee = streamlit.tabs(["出力", "位置合わせ結果", "料金"])
 
     with output:
-        if f"output_{content_id}_{use_vocal}" in streamlit.session_state:
-            write_srt(streamlit.session_state[f"output_{content_id}_{use_vocal}"])
+        if f"output_{key}" in streamlit.session_state:
+            write_srt(streamlit.session_state[f"output_{key}"])
 
     with alignment:
-        if f"alignment_{content_id}_{use_vocal}" in streamlit.session_state:
+        if f"alignment_{key}" in streamlit.session_state:
             with streamlit.expander("プロンプト"):
                 messages: list[llm_clients.types.TupleMessage] = streamlit.session_state[
-                    f"alignment_{content_id}_{use_vocal}"
+                    f"alignment_{key}"
                 ][1]
                 for message in messages:
                     if not message.role == "user" or isinstance(message.content, str):
                         streamlit.code(message.content)
-            write_srt(
-                streamlit.session_state[f"alignment_{content_id}_{use_vocal}"][0], lyrics_list
-            )
+            write_srt(streamlit.session_state[f"alignment_{key}"][0], lyrics_list)
 
     with fee:
-        if f"fee_{content_id}_{use_vocal}" in streamlit.session_state:
+        if f"fee_{key}" in streamlit.session_state:
             usd_jpy = float(streamlit.text_input("USD/JPY", value=150))  # pyright: ignore
 
             table_str = "処理 | 料金\n" "--- | ---\n"
             sum_fee = 0
-            for process, usd_fee in streamlit.session_state[
-                f"fee_{content_id}_{use_vocal}"
-            ].items():
+            for process, usd_fee in streamlit.session_state[f"fee_{key}"].items():
                 jpy_fee = usd_fee * usd_jpy
                 sum_fee += jpy_fee
                 table_str += f"{process} | ¥{round(jpy_fee,3)}\n"
@@ -127,7 +129,14 @@ def _display(content_id: str, lyrics: str, use_vocal: bool):
             streamlit.write(table_str)
 
 
-def _run(api_key: str, model: str, content_id: str, lyrics: str, use_vocal: bool):
+def _run(
+    api_key: str,
+    model: str,
+    content_id: str,
+    lyrics: str,
+    use_vocal: bool,
+    use_windows: bool = False,
+):
     """メインの処理
     結果は streamlit.session_state に格納される
 
@@ -139,7 +148,10 @@ def _run(api_key: str, model: str, content_id: str, lyrics: str, use_vocal: bool
     lyrics
     use_vocal
         ボーカル抽出した音声ファイルを入力するかどうか
+    use_windows
+        曲を区間に分けて並列に位置合わせするかどうか
     """
+    key = f"{content_id}_{use_vocal}_{use_windows}"
     fee_dict: dict[str, float] = {}
     with streamlit.spinner("動画をダウンロード中..."):
         pass
@@ -147,21 +159,33 @@ def _run(api_key: str, model: str, content_id: str, lyrics: str, use_vocal: bool
     audio_path = f"{ROOT_DIR}/music/{content_id}.mp3"
     streamlit.audio(audio_path)
     if use_vocal:
-        audio_path = llm_clients.vocal_extract(audio_path, ROOT_DIR)
+        # ボーカル抽出はモデルを読み込んだままのワーカープロセスで、バックフィルより先に処理する
+        with streamlit.spinner("ボーカル抽出中..."):
+            audio_path = (
+                llm_clients.separation_queue.default_queue()
+                .submit(audio_path, ROOT_DIR, priority=llm_clients.separation_queue.INTERACTIVE)
+                .result()
+            )
 
-    with streamlit.spinner("位置合わせ中..."):
+    with (
+        streamlit.spinner("位置合わせ中..."),
+        llm_clients.ledger.tags(content_id=content_id, stage="alignment"),
+    ):
         alignment_audio = entities.AlignmentWithAudio(api_key=api_key, model=model)
-        alignment_lyrics = alignment_audio.run(lyrics, audio_path)
+        if use_windows:
+            alignment_lyrics = alignment_audio.run_windows(lyrics, audio_path)
+        else:
+            alignment_lyrics = alignment_audio.run(lyrics, audio_path)
         alignment_messages = alignment_audio.messages
         fee_dict["位置合わせ"] = alignment_audio.llm.fee
 
-    streamlit.session_state[f"alignment_{content_id}_{use_vocal}"] = (
+    streamlit.session_state[f"alignment_{key}"] = (
         alignment_lyrics,
         alignment_messages,
     )
 
-    streamlit.session_state[f"output_{content_id}_{use_vocal}"] = alignment_lyrics
-    streamlit.session_state[f"fee_{content_id}_{use_vocal}"] = fee_dict
+    streamlit.session_state[f"output_{key}"] = alignment_lyrics
+    streamlit.session_state[f"fee_{key}"] = fee_dict
 
 
 if __name__ == "__main__":
@@ -177,6 +201,7 @@ if __name__ == "__main__":
         )
 
         use_vocal = streamlit.checkbox("ボーカル抽出")
+        use_windows = streamlit.checkbox("区間に分けて位置合わせ")
 
     content_id = streamlit.text_input("曲名")
     try:
@@ -189,6 +214,6 @@ if __name__ == "__main__":
         lyrics = ""
 
     if streamlit.button("run"):
-        _run(api_key, model, content_id, lyrics, use_vocal)
+        _run(api_key, model, content_id, lyrics, use_vocal, use_windows)
 
-    _display(content_id, lyrics, use_vocal)
+    _display(content_id, lyrics, use_vocal, use_windows)
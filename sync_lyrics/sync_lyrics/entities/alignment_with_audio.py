@@ -1,10 +1,21 @@
+import concurrent.futures
+import contextvars
+import dataclasses
+import os
 import re
+import tempfile
+from typing import TYPE_CHECKING
 
+import llm_clients.audio_store
 import llm_clients.gemini
+import llm_clients.media
 import llm_clients.types
-import pydub
+import llm_clients.whisper
 
-from sync_lyrics import types
+from sync_lyrics import get_logger, types
+
+if TYPE_CHECKING:
+    import numpy
 
 PROMPT = """\
 次の音声データの曲にタイムスタンプを付けて、例のようなSRT形式で出力してください。
@@ -24,6 +35,102 @@ PROMPT = """\
 {lyrics}
 """
 
+WINDOW_PROMPT = """\
+次の音声データは曲の{start}秒から{end}秒までの部分です。
+この音声の中で歌われている「歌詞」の行にタイムスタンプを付けて、例のようなSRT形式で出力してください。
+タイムスタンプはこの音声の先頭を 00:00:00,000 とした時刻にしてください。
+番号は「歌詞」に書かれた番号をそのまま使い、この音声で歌われていない行は出力しないでください。
+歌詞は一行ずつ、歌詞中の記号や空白を変えずに出力してください。
+## 例
+12
+00:00:10,003 --> 00:00:12,455
+あいうえお
+13
+00:00:12,562 --> 00:00:16,419
+かきくけこ
+
+「歌詞」
+{lyrics}
+"""
+
+# Gemini に渡す音声を切り出すときのサンプリング周波数
+WINDOW_SAMPLE_RATE = 16_000
+
+
+# 曲を分割した1区間 rows はこの区間で歌われると見積もった歌詞の行番号、
+# candidates はその前後も含めて Gemini に渡す行番号
+@dataclasses.dataclass
+class Window:
+    start: float
+    end: float
+    rows: range
+    candidates: range
+    messages: list[llm_clients.types.TupleMessage] = dataclasses.field(default_factory=list)
+    response: list[types.Lyrics] = dataclasses.field(default_factory=list)
+
+
+def split_windows(
+    duration: float,
+    speech: list[tuple[float, float]],
+    max_window: float,
+    min_gap: float = 0.5,
+) -> list[tuple[float, float]]:
+    """曲を max_window 秒以下の区間に分ける
+    区切りは声がない min_gap 秒以上の間の中央にし、そのような間がない場合は max_window 秒で区切る
+
+    Parameters
+    ----------
+    duration
+    speech
+        声がある区間の最初と最後の秒
+    max_window
+    min_gap
+    """
+    cuts = [
+        (end + next_start) / 2
+        for (_, end), (next_start, _) in zip(speech, speech[1:])
+        if next_start - end >= min_gap
+    ]
+    windows: list[tuple[float, float]] = []
+    start = 0.0
+    while duration - start > max_window:
+        # 短すぎる区間ができないように、区間の長さが max_window の 1/4 以上になる区切りだけを使う
+        candidates = [c for c in cuts if start + max_window / 4 < c <= start + max_window]
+        cut = candidates[-1] if candidates else start + max_window
+        windows.append((start, cut))
+        start = cut
+    windows.append((start, duration))
+    return windows
+
+
+def assign_rows(
+    windows: list[tuple[float, float]], speech: list[tuple[float, float]], n_rows: int
+) -> list[range]:
+    """それぞれの区間で歌われる歌詞の行番号 (1始まり) を、区間の中の声がある秒数の割合で見積もる
+
+    Parameters
+    ----------
+    windows
+    speech
+    n_rows
+    """
+    seconds = [
+        sum(max(min(end, e) - max(start, s), 0.0) for s, e in speech) for start, end in windows
+    ]
+    if sum(seconds) == 0:
+        seconds = [end - start for start, end in windows]
+    total = sum(seconds)
+
+    ret: list[range] = []
+    cumulative = 0.0
+    first = 1
+    for second in seconds:
+        cumulative += second
+        last = round(n_rows * cumulative / total)
+        ret.append(range(first, last + 1))
+        first = last + 1
+    return ret
+
 
 class AlignmentWithAudio:
     """音声ファイルを入力して歌詞にタイムスタンプをつける
@@ -50,10 +157,18 @@ class AlignmentWithAudio:
 
     def fetch(self) -> list[types.Lyrics]:
         """fetch 一度文字列でタイムスタンプをつけた後にJSONに成形する"""
-        response = self.llm.fetch(tuple(self.messages))
-        self.messages.append(llm_clients.types.TupleMessageAssistant(content=response))
-        response = self._srt2model(response)
-        return response
+        return self._fetch(self.messages)
+
+    def _fetch(self, messages: list[llm_clients.types.TupleMessage]) -> list[types.Lyrics]:
+        """messages で fetch し、応答を messages に追加して types.Lyrics のリストで返す
+
+        Parameters
+        ----------
+        messages
+        """
+        response = self.llm.fetch(tuple(messages))
+        messages.append(llm_clients.types.TupleMessageAssistant(content=response))
+        return self._srt2model(response)
 
     def run(self, lyrics: str, audio_path: str) -> list[types.Lyrics]:
         """実行
@@ -85,6 +200,206 @@ class AlignmentWithAudio:
 
         return response  # pyright: ignore[reportPossiblyUnboundVariable]
 
+    def run_windows(
+        self,
+        lyrics: str,
+        audio_path: str,
+        max_window: float = 60.0,
+        margin: int = 2,
+        max_concurrency: int = 4,
+    ) -> list[types.Lyrics]:
+        """曲を声がない所で区間に分け、区間ごとに並列に位置合わせしてつなげる
+        区間ごとの歌詞の行は声がある秒数の割合で見積もり、前後 margin 行も候補として渡す
+        バリデーションに失敗した区間や API の呼び出しが失敗した区間だけを2回までやり直す
+        どの区間でも位置合わせできなかった行はタイムスタンプを None にする
+
+        Parameters
+        ----------
+        lyrics
+        audio_path
+        max_window
+            区間の長さの上限 (秒)
+        margin
+            見積もった行の前後で候補として渡す行数
+        max_concurrency
+            同時に実行するリクエストの上限
+        """
+        rows = [l for l in lyrics.split("\n") if re.sub(r"^\s+$", "", l) != ""]
+        duration = llm_clients.media.duration(audio_path)
+        speech = llm_clients.whisper.speech_timestamps(audio_path)
+        spans = split_windows(duration, speech, max_window)
+        windows = [
+            Window(
+                start,
+                end,
+                assigned,
+                range(max(assigned.start - margin, 1), min(assigned.stop + margin, len(rows) + 1)),
+            )
+            for (start, end), assigned in zip(spans, assign_rows(spans, speech, len(rows)))
+        ]
+        windows = [w for w in windows if len(w.rows) > 0]
+
+        audio = llm_clients.audio_store.default_store().load(audio_path, WINDOW_SAMPLE_RATE)
+        with (
+            tempfile.TemporaryDirectory() as dirname,
+            concurrent.futures.ThreadPoolExecutor(max_concurrency) as executor,
+        ):
+            for i, window in enumerate(windows):
+                window_path = os.path.join(dirname, f"{i}.wav")
+                self._write_window(audio, window, window_path)
+                window.messages = [
+                    llm_clients.types.TupleMessageUser(
+                        content=WINDOW_PROMPT.format(
+                            start=round(window.start, 3),
+                            end=round(window.end, 3),
+                            lyrics="\n".join(f"{r}\n{rows[r - 1]}" for r in window.candidates),
+                        ),
+                    ),
+                    llm_clients.types.TupleMessageUser(
+                        content=(
+                            llm_clients.types.TupleContentParam(
+                                type="image_url", content=window_path
+                            ),
+                        ),
+                    ),
+                ]
+
+            pending = windows
+            for _ in range(3):  # 失敗した区間は２回までやり直す
+                # ledger.tags などの contextvars をスレッドに引き継ぐ
+                futures = [
+                    executor.submit(contextvars.copy_context().run, self._fetch, window.messages)
+                    for window in pending
+                ]
+                failed: dict[int, Window] = {}
+                for window, future in zip(pending, futures):
+                    try:
+                        window.response = future.result()
+                    except Exception as e:
+                        # 他の区間の結果は使えるので、この区間だけ同じメッセージでやり直す
+                        # 最後まで失敗した場合はこの区間の行のタイムスタンプは None になる
+                        get_logger().warning(
+                            f"window {window.start:.1f}-{window.end:.1f}s failed: "
+                            f"{type(e).__name__}: {e}"
+                        )
+                        window.response = []
+                        failed[id(window)] = window
+                        continue
+                    error_message = self._validate_window(window, rows)
+                    if error_message != "":
+                        window.messages.append(
+                            llm_clients.types.TupleMessageUser(content=error_message)
+                        )
+                        failed[id(window)] = window
+                # どの区間にも含まれなかった行は、その行を見積もった区間でやり直す
+                covered = {r.lyrics_row for w in windows if id(w) not in failed for r in w.response}
+                for window in windows:
+                    missing = [r for r in window.rows if r not in covered]
+                    if id(window) in failed or not missing:
+                        continue
+                    window.messages.append(
+                        llm_clients.types.TupleMessageUser(
+                            content="".join(
+                                f"歌詞が誤っています。{r}行目の歌詞「{rows[r - 1]}」が出力にありません。\n"
+                                for r in missing
+                            )
+                        )
+                    )
+                    failed[id(window)] = window
+                pending = list(failed.values())
+                if not pending:
+                    break
+
+        self.messages = [m for window in windows for m in window.messages]
+        return self._stitch(windows, rows)
+
+    @staticmethod
+    def _write_window(audio: "numpy.ndarray", window: Window, path: str) -> None:
+        """区間の音声を WAV に書き出す
+
+        Parameters
+        ----------
+        audio
+            WINDOW_SAMPLE_RATE で読み込んだ曲全体の音声
+        window
+        path
+        """
+        import soundfile
+
+        start = int(window.start * WINDOW_SAMPLE_RATE)
+        end = int(window.end * WINDOW_SAMPLE_RATE)
+        soundfile.write(path, audio[start:end], WINDOW_SAMPLE_RATE)
+
+    @staticmethod
+    def _validate_window(window: Window, rows: list[str]) -> str:
+        """区間の出力のバリデーション 誤りがある場合はその旨を、ない場合は空文字列を返す
+
+        Parameters
+        ----------
+        window
+        rows
+            空行を除いた歌詞
+        """
+        error_message = ""
+        seen: set[int] = set()
+        for resp in window.response:
+            i = resp.lyrics_row
+            if i not in window.candidates:
+                error_message += f"歌詞の番号が誤っています。{i}行目は「歌詞」にありません。\n"
+                continue
+            if i in seen:
+                error_message += f"出力の仕様が違います。出力に歌詞の{i}行目が複数含まれています。歌詞は分割せず一行ずつ出力してください。\n"
+                continue
+            seen.add(i)
+            if rows[i - 1].split() != resp.lyrics.split():
+                error_message += f"歌詞が誤っています。正しい{i}行目の歌詞は「{rows[i - 1]}」なのに対して、出力の{i}行目の歌詞は「{resp.lyrics}」になっています。\n"
+
+        duration = window.end - window.start
+        for resp, next_resp in zip(window.response, [*window.response[1:], None]):
+            if resp.start_second is None or resp.end_second is None:
+                continue
+            if duration < resp.end_second:
+                error_message += f"タイムスタンプが誤っています。音声ファイルの秒数{round(duration, 3)}秒を上回って{resp.lyrics_row}行目のタイムスタンプがつけられています。\n"
+            if next_resp is not None and next_resp.start_second is not None:
+                if resp.end_second > next_resp.start_second:
+                    error_message += f"タイムスタンプが誤っています。{resp.lyrics_row}行目の終了時刻「{resp.end_second}」を、{next_resp.lyrics_row}行目の開始時刻「{next_resp.start_second}」が下回っています。\n"
+        return error_message
+
+    @staticmethod
+    def _stitch(windows: list[Window], rows: list[str]) -> list[types.Lyrics]:
+        """区間ごとの結果に区間の開始秒を足して、歌詞の行の順につなげる
+        複数の区間に同じ行がある場合は、その行を見積もった区間の結果を使う
+
+        Parameters
+        ----------
+        windows
+        rows
+            空行を除いた歌詞
+        """
+        aligned: dict[int, types.Lyrics] = {}
+        for window in sorted(windows, key=lambda w: w.start):
+            for resp in window.response:
+                if resp.lyrics_row not in window.candidates:
+                    continue
+                if resp.lyrics_row in aligned and resp.lyrics_row not in window.rows:
+                    continue
+                aligned[resp.lyrics_row] = types.Lyrics(
+                    start_second=(
+                        window.start + resp.start_second if resp.start_second is not None else None
+                    ),
+                    end_second=(
+                        window.start + resp.end_second if resp.end_second is not None else None
+                    ),
+                    lyrics=rows[resp.lyrics_row - 1],
+                    lyrics_row=resp.lyrics_row,
+                )
+        return [
+            aligned.get(
+                i, types.Lyrics(start_second=None, end_second=None, lyrics=lyric, lyrics_row=i)
+            )
+            for i, lyric in enumerate(rows, start=1)
+        ]
+
     @staticmethod
     def _str2sec(second_str: str) -> float:
         """xx:xx:xx.xxx または xx:xx:xx,xxx 形式の文字列を秒に変換する
@@ -175,7 +490,7 @@ class AlignmentWithAudio:
         lyrics_list
         response
         """
-        audio_segment = pydub.AudioSegment.from_file(audio_path)
+        duration = llm_clients.media.duration(audio_path)
         error_message = ""
 
         i = 1
@@ -183,8 +498,8 @@ class AlignmentWithAudio:
         while last_second is None:
             last_second = response[-(i + 1)].end_second
             i += 1
-        if audio_segment.duration_seconds < last_second:
-            error_message += f"タイムスタンプが誤っています。音声ファイルの秒数{round(audio_segment.duration_seconds, 3)}秒を上回って出力のタイムスタンプがつけられています。\n"
+        if duration < last_second:
+            error_message += f"タイムスタンプが誤っています。音声ファイルの秒数{round(duration, 3)}秒を上回って出力のタイムスタンプがつけられています。\n"
 
         for i, resp in enumerate(response):
             if resp.end_second is None: